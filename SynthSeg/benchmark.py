@@ -0,0 +1,434 @@
+"""
+This file implements a benchmark of the SynthSeg inference pipeline (predict_synthseg.predict). It runs locally on CPU
+with randomly initialised networks, so that it does not require the trained models.
+Synthetic images of realistic shapes and resolutions are first built (see BENCHMARK_CASES), and each image is then
+segmented with each mode of SynthSeg (see BENCHMARK_MODES). Each run is launched in a separate process, so that peak
+memory usages are not mixed between runs. The total time, the time of each stage (see utils.Profiler), and the peak
+memory usage of all runs are written to a json file, which can be compared to a previous one to flag regressions.
+
+If you use this code, please cite one of the SynthSeg papers:
+https://github.com/BBillot/SynthSeg/blob/master/bibtex.bib
+
+Copyright 2020 Benjamin Billot
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+https://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under the
+License.
+"""
+
+
+# python imports
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import subprocess
+import numpy as np
+import tensorflow as tf
+
+# project imports
+from SynthSeg.predict_service import get_predict_arguments
+from SynthSeg.predict_synthseg import predict, build_model, LeanModel
+
+# third-party imports
+from ext.lab2im import utils
+from ext.neuron import models as nrn_models
+
+
+# synthetic inputs, given by their shape and resolution (in mm). Cases with n_images are folders of images, whose shapes
+# are randomly scaled by up to shape_jitter around the given shape.
+BENCHMARK_CASES = {'1mm': {'shape': [256, 256, 256], 'resolution': [1., 1., 1.]},
+                   'anisotropic': {'shape': [384, 384, 36], 'resolution': [.5, .5, 5.]},
+                   'large_fov': {'shape': [352, 352, 320], 'resolution': [1., 1., 1.]},
+                   'heterogeneous': {'shape': [224, 224, 192], 'resolution': [1., 1., 1.], 'n_images': 20,
+                                     'shape_jitter': 0.15}}
+
+# modes of SynthSeg, given by their options in scripts/commands/SynthSeg_predict.py
+BENCHMARK_MODES = {'fast': {'fast': True},
+                   'default': {},
+                   'robust': {'robust': True},
+                   'parc': {'parc': True},
+                   'qc': {'qc': True},
+                   'canonical': {'fast': True, 'canonical': 64},
+                   'compact': {'fast': True, 'compact': True},
+                   'lean': {'robust': True, 'parc': True, 'lean': True, 'slab': 64}}
+
+synthseg_home = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def run_benchmark(benchmark_dir,
+                  cases=None,
+                  modes=None,
+                  n_repeats=1,
+                  n_threads=1,
+                  path_results=None,
+                  path_baseline=None,
+                  tolerance=0.2,
+                  min_time=1.):
+    """Benchmark predict_synthseg.predict for all combinations of cases and modes.
+    :param benchmark_dir: folder where synthetic inputs, random weights, and outputs are written. Inputs and weights are
+    only built if they do not exist yet, so that they can be reused between benchmarks.
+    :param cases: (optional) list of cases to benchmark (keys of BENCHMARK_CASES). Default is all of them.
+    :param modes: (optional) list of modes to benchmark (keys of BENCHMARK_MODES). Default is all of them.
+    :param n_repeats: (optional) number of times each run is repeated. Reported times are the medians over repeats.
+    :param n_threads: (optional) number of threads used by tensorflow. Default is 1.
+    :param path_results: (optional) path of the json file where results are written.
+    Default is benchmark_dir/results.json.
+    :param path_baseline: (optional) path of the results of a previous benchmark, to compare the new results with.
+    :param tolerance: (optional) relative increase of time/memory above which a regression is flagged. Default is 0.2.
+    :param min_time: (optional) stages faster than this (in seconds) in the baseline are not checked for regressions,
+    since their timings are too noisy. Default is 1.
+    :return: the results, and a list of regressions compared to the baseline (empty if no baseline is given).
+    """
+
+    # initialisation
+    cases = list(BENCHMARK_CASES.keys()) if cases is None else utils.reformat_to_list(cases)
+    modes = list(BENCHMARK_MODES.keys()) if modes is None else utils.reformat_to_list(modes)
+    for case in cases:
+        assert case in BENCHMARK_CASES, 'unknown case %s, should be in %s' % (case, list(BENCHMARK_CASES.keys()))
+    for mode in modes:
+        assert mode in BENCHMARK_MODES, 'unknown mode %s, should be in %s' % (mode, list(BENCHMARK_MODES.keys()))
+    path_results = os.path.join(benchmark_dir, 'results.json') if path_results is None else path_results
+    image_dir = os.path.join(benchmark_dir, 'images')
+    models_dir = os.path.join(benchmark_dir, 'models')
+    runs_dir = os.path.join(benchmark_dir, 'runs')
+    utils.mkdir(image_dir)
+    utils.mkdir(runs_dir)
+
+    # build inputs and random networks if necessary
+    path_inputs = dict()
+    for case in cases:
+        if 'n_images' in BENCHMARK_CASES[case]:
+            path_inputs[case] = os.path.join(image_dir, case)
+            if not os.path.isdir(path_inputs[case]):
+                print('building synthetic images in ' + path_inputs[case])
+                build_synthetic_images(path_inputs[case], **BENCHMARK_CASES[case])
+        else:
+            path_inputs[case] = os.path.join(image_dir, case + '.nii.gz')
+            if not os.path.isfile(path_inputs[case]):
+                print('building synthetic image ' + path_inputs[case])
+                build_synthetic_image(path_inputs[case], **BENCHMARK_CASES[case])
+    build_random_models_if_needed(models_dir)
+
+    # run all combinations of cases and modes
+    results = list()
+    for case in cases:
+        for mode in modes:
+            print('benchmarking case %s in mode %s' % (case, mode))
+            runs = list()
+            for n in range(n_repeats):
+                path_run = os.path.join(runs_dir, '%s_%s_%s.json' % (case, mode, n))
+                run_in_subprocess('run_case', path_inputs[case], mode, models_dir,
+                                  os.path.join(runs_dir, '%s_%s' % (case, mode)), path_run, n_threads)
+                with open(path_run, 'r') as f:
+                    runs.append(json.load(f))
+            stages = list(runs[0]['stages'].keys())
+            results.append({'case': case,
+                            'mode': mode,
+                            'total_time': float(np.median([run['total_time'] for run in runs])),
+                            'all_total_times': [run['total_time'] for run in runs],
+                            'time_per_image': float(np.median([run['total_time'] / run['n_images'] for run in runs])),
+                            'stages': {s: float(np.median([run['stages'][s] for run in runs])) for s in stages},
+                            'peak_memory': float(np.max([run['peak_memory'] for run in runs])),
+                            'n_images': runs[0]['n_images'],
+                            'compact_fallbacks': runs[0]['compact_fallbacks']})
+
+    # write results
+    environment = {'platform': platform.platform(),
+                   'python': platform.python_version(),
+                   'tensorflow': tf.__version__,
+                   'numpy': np.__version__,
+                   'n_cpus': os.cpu_count(),
+                   'n_threads': n_threads,
+                   'n_repeats': n_repeats,
+                   'date': time.strftime('%Y-%m-%d %H:%M:%S')}
+    utils.mkdir(os.path.dirname(os.path.abspath(path_results)))
+    with open(path_results, 'w') as f:
+        json.dump({'environment': environment, 'results': results}, f, indent=1)
+
+    # compare to baseline
+    if path_baseline is not None:
+        with open(path_baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare_to_baseline(results, baseline, tolerance, min_time)
+    else:
+        regressions = list()
+
+    print_results(results, regressions)
+    print('\nbenchmark results saved in ' + path_results)
+
+    return results, regressions
+
+
+def build_synthetic_image(path_image, shape, resolution, seed=0):
+    """Build a synthetic head-like image (scalp, skull, CSF, cortex, white matter, and ventricles), with a smooth bias
+    field and noise, and save it as an int16 nifty file centred at the origin.
+    :param path_image: path where the image will be written.
+    :param shape: shape of the image.
+    :param resolution: resolution of the image in mm.
+    :param seed: (optional) seed of the random noise, so that images are reproducible.
+    """
+
+    # physical coordinates (in mm) of all voxels, centred in the middle of the field of view
+    shape = utils.reformat_to_list(shape, length=3, dtype='int')
+    resolution = utils.reformat_to_list(resolution, length=3, dtype='float')
+    x, y, z = [((np.arange(n) - (n - 1) / 2) * r).astype('float32') for n, r in zip(shape, resolution)]
+    x, y, z = x[:, np.newaxis, np.newaxis], y[np.newaxis, :, np.newaxis], z[np.newaxis, np.newaxis, :]
+
+    # nested ellipsoids, given by their radii (in mm) and intensities
+    image = np.zeros(shape, dtype='float32')
+    for radii, intensity in [([80, 100, 90], 600), ([75, 95, 85], 100), ([70, 90, 80], 300), ([67, 87, 77], 550),
+                             ([55, 75, 65], 800)]:
+        image[(x / radii[0]) ** 2 + (y / radii[1]) ** 2 + (z / radii[2]) ** 2 <= 1] = intensity
+    for centre in [-12, 12]:
+        image[((x - centre) / 6) ** 2 + (y / 25) ** 2 + ((z - 10) / 12) ** 2 <= 1] = 300
+
+    # add smooth bias field and noise
+    image *= 1 + 0.1 * np.sin(x / 50) * np.cos(y / 60) * np.sin(z / 70 + 1)
+    image += np.random.RandomState(seed).normal(0, 20, size=shape).astype('float32')
+    image = np.clip(image, 0, None)
+
+    aff = np.diag(resolution + [1.])
+    aff[:3, 3] = - np.array(resolution) * (np.array(shape) - 1) / 2
+    utils.save_volume(image, aff, None, path_image, dtype='int16')
+
+
+def build_synthetic_images(image_dir, shape, resolution, n_images, shape_jitter=0., seed=0):
+    """Build a folder of synthetic images (see build_synthetic_image) with heterogeneous shapes, which are obtained by
+    randomly scaling the given shape by a factor in [1 - shape_jitter, 1 + shape_jitter] along each axis.
+    Images are written in a temporary folder first, so that no partial folder is left if this is interrupted."""
+    tmp_dir = image_dir + '_tmp'
+    utils.mkdir(tmp_dir)
+    rng = np.random.RandomState(seed)
+    for n in range(n_images):
+        image_shape = np.round(np.array(shape) * rng.uniform(1 - shape_jitter, 1 + shape_jitter, size=3)).astype('int')
+        build_synthetic_image(os.path.join(tmp_dir, 'image_%04d.nii.gz' % n), image_shape, resolution, seed=seed + n)
+    os.rename(tmp_dir, image_dir)
+
+
+def build_random_models(models_dir, seed=0):
+    """Build randomly initialised SynthSeg networks, and save their weights in models_dir. We build two networks:
+    one for SynthSeg (with the parcellation and QC networks), and one for SynthSeg-robust."""
+
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+
+    # get labels as in predict_synthseg.predict
+    args = get_predict_arguments({'i': '', 'o': ''}, synthseg_home)
+    labels_segmentation, unique_idx = np.unique(utils.get_list_labels(args['labels_segmentation'])[0],
+                                                return_index=True)
+    build_kwargs = {'path_model_segmentation': None,
+                    'path_model_parcellation': None,
+                    'path_model_qc': None,
+                    'input_shape_qc': 224,
+                    'labels_segmentation': labels_segmentation,
+                    'labels_denoiser': np.unique(utils.get_list_labels(args['labels_denoiser'])[0]),
+                    'labels_parcellation': np.unique(utils.get_list_labels(args['labels_parcellation'])[0]),
+                    'labels_qc': utils.get_list_labels(args['labels_qc'])[0][unique_idx],
+                    'sigma_smoothing': 0.5,
+                    'flip_indices': None}
+
+    # weights are written in temporary files first, so that no partial model is left if this is interrupted
+    tmp_dir = models_dir + '_tmp'
+    utils.mkdir(tmp_dir)
+    net = build_model(**build_kwargs, robust=False, do_parcellation=True, do_qc=True)
+    net.save_weights(os.path.join(tmp_dir, 'synthseg_random.h5'))
+    net = build_model(**build_kwargs, robust=True, do_parcellation=False, do_qc=False)
+    net.save_weights(os.path.join(tmp_dir, 'synthseg_robust_random.h5'))
+    os.rename(tmp_dir, models_dir)
+
+
+def build_random_models_if_needed(models_dir):
+    """Build the random networks (see build_random_models) in their own process, if they do not exist yet."""
+    if not os.path.isdir(models_dir):
+        print('building random networks in ' + models_dir)
+        run_in_subprocess('build_random_models', models_dir)
+
+
+def check_manifest_rerun(benchmark_dir, mode='qc', n_threads=1):
+    """Check that segmenting an unchanged folder a second time with the same manifest skips all its subjects, and that
+    it writes the same csv files (volumes and QC scores) as the first run.
+    :param benchmark_dir: folder where synthetic inputs, random weights, and outputs are written (see run_benchmark).
+    :param mode: (optional) mode of SynthSeg used for both runs (key of BENCHMARK_MODES). Default is qc.
+    :param n_threads: (optional) number of threads used by tensorflow. Default is 1.
+    :return: a list of problems (as printable strings), which is empty if the check passed.
+    """
+
+    # build a small folder of images and random networks if necessary
+    image_dir = os.path.join(benchmark_dir, 'images', 'rerun')
+    if not os.path.isdir(image_dir):
+        print('building synthetic images in ' + image_dir)
+        build_synthetic_images(image_dir, shape=[160, 160, 160], resolution=[1., 1., 1.], n_images=3, shape_jitter=0.1)
+    models_dir = os.path.join(benchmark_dir, 'models')
+    build_random_models_if_needed(models_dir)
+
+    # segment the folder twice, starting from an empty manifest
+    result_dir = os.path.join(benchmark_dir, 'runs', 'rerun_%s' % mode)
+    if os.path.isdir(result_dir):
+        shutil.rmtree(result_dir)
+    options = {'manifest': os.path.join(result_dir, 'manifest.jsonl')}
+    csv_files = list()
+    runs = list()
+    for n in range(2):
+        print('checking manifest reruns in mode %s: run %d' % (mode, n + 1))
+        path_run = os.path.join(benchmark_dir, 'runs', 'rerun_%s_%s.json' % (mode, n))
+        run_in_subprocess('run_case', image_dir, mode, models_dir, result_dir, path_run, n_threads, options)
+        with open(path_run, 'r') as f:
+            runs.append(json.load(f))
+        csv_files.append(dict())
+        for name in ['vol.csv', 'qc.csv']:
+            if os.path.isfile(os.path.join(result_dir, name)):
+                with open(os.path.join(result_dir, name), 'r') as f:
+                    csv_files[n][name] = f.read()
+
+    # compare the two runs
+    problems = list()
+    if 'predict' in runs[1]['stages']:
+        problems.append('rerun_%s: subjects of the manifest were segmented again' % mode)
+    for name in sorted(set(csv_files[0].keys()) | set(csv_files[1].keys())):
+        if csv_files[0].get(name) != csv_files[1].get(name):
+            problems.append('rerun_%s: %s is different after the second run' % (mode, name))
+    if problems:
+        print('\nWARNING: the following problems were found when running again with a manifest:')
+        for problem in problems:
+            print(problem)
+    else:
+        print('\nrunning again with a manifest skipped all subjects and gave the same csv files')
+
+    return problems
+
+
+def check_lean_model(shape=64, slab_size=16, tolerance=1e-4, seed=0):
+    """Check that LeanModel gives the same posteriors as keras, on a randomly initialised UNet with the architecture of
+    the segmentation network of SynthSeg. The lean network is run both on whole images and in slabs.
+    :param shape: (optional) size of the random input image, which must be divisible by 16. Default is 64.
+    :param slab_size: (optional) size of the slabs used by the second lean network. Default is 16.
+    :param tolerance: (optional) maximum absolute difference allowed between posteriors. Default is 1e-4.
+    :param seed: (optional) seed of the random weights and image.
+    :return: a list of problems (as printable strings), which is empty if the check passed.
+    """
+
+    # build a random UNet, with random statistics in batch normalisations so that they are not identities
+    np.random.seed(seed)
+    tf.random.set_seed(seed)
+    net = nrn_models.unet(input_shape=[None, None, None, 1], nb_labels=33, nb_levels=5, nb_conv_per_level=2,
+                          conv_size=3, nb_features=24, feat_mult=2, activation='elu', batch_norm=-1, name='unet')
+    for layer in net.layers:
+        if layer.__class__.__name__ == 'BatchNormalization':
+            layer.set_weights([np.random.uniform(0.5, 1.5, w.shape) for w in layer.get_weights()])
+    image = np.random.normal(size=(1, shape, shape, shape, 1)).astype('float32')
+
+    # compare posteriors of keras and of LeanModel
+    posteriors = net.predict(image)
+    problems = list()
+    for name, lean_net in [('whole images', LeanModel(net)), ('slabs of %d' % slab_size, LeanModel(net, slab_size))]:
+        max_difference = np.max(np.abs(lean_net.predict(image) - posteriors))
+        print('LeanModel on %s: max absolute difference with keras %.2e' % (name, max_difference))
+        if max_difference > tolerance:
+            problems.append('LeanModel on %s: posteriors differ from keras by up to %.2e' % (name, max_difference))
+
+    return problems
+
+
+def run_case(path_image, mode, models_dir, result_dir, path_run, n_threads=1, options=None):
+    """Segment an image with a given mode of SynthSeg, and write the total time, the time of each stage, and the peak
+    memory usage in path_run. This is meant to be run in its own process (see run_in_subprocess).
+    Additional options of scripts/commands/SynthSeg_predict.py can be given in the options dictionary."""
+
+    # limit the number of threads
+    tf.config.threading.set_inter_op_parallelism_threads(n_threads)
+    tf.config.threading.set_intra_op_parallelism_threads(n_threads)
+
+    # get the same arguments as in scripts/commands/SynthSeg_predict.py, but with random weights
+    utils.mkdir(result_dir)
+    path_seg = os.path.join(result_dir, 'seg') if os.path.isdir(path_image) else os.path.join(result_dir, 'seg.nii.gz')
+    job = {'i': path_image, 'o': path_seg, 'vol': os.path.join(result_dir, 'vol.csv')}
+    job.update(BENCHMARK_MODES[mode])
+    job.update(options if options is not None else dict())
+    if job.get('qc', False):
+        job['qc'] = os.path.join(result_dir, 'qc.csv')
+    args = get_predict_arguments(job, synthseg_home, n_threads=n_threads)
+    args['path_model_segmentation'] = os.path.join(models_dir, 'synthseg_random.h5')
+    if args['robust']:
+        args['path_model_segmentation'] = os.path.join(models_dir, 'synthseg_robust_random.h5')
+    args['path_model_parcellation'] = args['path_model_qc'] = os.path.join(models_dir, 'synthseg_random.h5')
+    args['path_profile'] = os.path.join(result_dir, 'profile.jsonl')
+    if os.path.isfile(args['path_profile']):
+        os.remove(args['path_profile'])
+
+    # run prediction
+    start = time.time()
+    predict(**args, verbose=False)
+    total_time = time.time() - start
+
+    # gather the times of all stages, and the number of subjects predicted again with compact outputs
+    stages = dict()
+    n_compact_fallbacks = 0
+    with open(args['path_profile'], 'r') as f:
+        for line in f:
+            record = json.loads(line)
+            stages[record['stage']] = stages.get(record['stage'], 0.) + record['time']
+            n_compact_fallbacks += int(record['stage'] == 'predict_again')
+
+    with open(path_run, 'w') as f:
+        json.dump({'total_time': total_time, 'stages': stages, 'peak_memory': utils.get_peak_memory_usage() or 0.,
+                   'n_images': len(utils.list_images_in_folder(path_image)), 'compact_fallbacks': n_compact_fallbacks},
+                  f)
+
+
+def run_in_subprocess(function_name, *args):
+    """Run a function of this file in a new CPU-only python process, and wait for it to finish."""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([synthseg_home, env.get('PYTHONPATH', '')])
+    env['CUDA_VISIBLE_DEVICES'] = '-1'
+    code = 'from SynthSeg.benchmark import %s; %s(*%r)' % (function_name, function_name, args)
+    subprocess.run([sys.executable, '-c', code], env=env, check=True)
+
+
+def compare_to_baseline(results, baseline, tolerance=0.2, min_time=1.):
+    """Compare benchmark results to a baseline, and return the list of regressions (as printable strings).
+    The total time, the time of each stage, and the peak memory of each run are checked."""
+
+    regressions = list()
+    baseline = {(b['case'], b['mode']): b for b in baseline}
+    for result in results:
+        if (result['case'], result['mode']) not in baseline:
+            continue
+        base = baseline[(result['case'], result['mode'])]
+        metrics = [('total time', result['total_time'], base['total_time'], 's'),
+                   ('peak memory', result['peak_memory'], base['peak_memory'], 'MB')]
+        metrics += [('%s time' % s, result['stages'][s], base['stages'][s], 's')
+                    for s in result['stages'] if (s in base['stages']) and (base['stages'][s] >= min_time)]
+        for name, new, old, unit in metrics:
+            if new > old * (1 + tolerance):
+                increase = 100 * (new / old - 1)
+                regressions.append('%s/%s: %s went from %.1f%s to %.1f%s (+%.0f%%)'
+                                   % (result['case'], result['mode'], name, old, unit, new, unit, increase))
+    return regressions
+
+
+def print_results(results, regressions=None):
+    """Print a summary table of benchmark results, followed by the regressions if any."""
+    print('\n{:<14}{:<10}{:>12}{:>16}{:>12}{:>14}{:>16}'.format('case', 'mode', 'total (s)', 'per image (s)',
+                                                               'build (s)', 'predict (s)', 'peak mem (MB)'))
+    for result in results:
+        print('{:<14}{:<10}{:>12.1f}{:>16.1f}{:>12.1f}{:>14.1f}{:>16.1f}'.format(
+            result['case'], result['mode'], result['total_time'], result.get('time_per_image', result['total_time']),
+            result['stages'].get('build', 0.), result['stages'].get('predict', 0.), result['peak_memory']))
+
+    # subjects whose brain mask has several connected components are predicted twice with compact outputs
+    for result in results:
+        if BENCHMARK_MODES.get(result['mode'], dict()).get('compact', False) & ('n_images' in result):
+            print('{}/{}: {}/{} subjects were predicted again with posteriors (compact outputs fallback), which took '
+                  '{:.1f}s'.format(result['case'], result['mode'], result['compact_fallbacks'], result['n_images'],
+                                   result['stages'].get('predict_again', 0.)))
+    if regressions:
+        print('\nWARNING: the following regressions were found compared to the baseline:')
+        for regression in regressions:
+            print(regression)
@@ -62,7 +62,11 @@ def predict(path_images,
             list_correct_labels=None,
             compute_distances=False,
             recompute=True,
-            verbose=True):
+            verbose=True,
+            path_profile=None,
+            compression_level=None,
+            compression_threads=1,
+            uncompressed=False):
     """
     This function uses trained models to segment images.
     It is crucial that the inputs match the architecture parameters of the trained model.
@@ -127,11 +131,22 @@ def predict(path_images,
     :param recompute: (optional) whether to recompute segmentations that were already computed. This also applies to
     Dice scores, if gt_folder is not None. Default is True.
     :param verbose: (optional) whether to print out info about the remaining number of cases.
+    :param path_profile: (optional) path of a json-lines file where the time and peak memory of each stage are
+    recorded for each subject (see utils.Profiler). Default is None, where nothing is recorded.
+    :param compression_level: (optional) gzip compression level (from 0 to 9) of nii.gz outputs.
+    Default is None, where nibabel's default level is used.
+    :param compression_threads: (optional) number of threads used to compress each nii.gz output. Default is 1.
+    :param uncompressed: (optional) whether to write .nii outputs instead of .nii.gz (e.g. on local scratch), which is
+    much faster. Default is False.
     """
 
     # prepare input/output filepaths
     path_images, path_segmentations, path_posteriors, path_resampled, path_volumes, compute, unique_vol_file = \
-        prepare_output_files(path_images, path_segmentations, path_posteriors, path_resampled, path_volumes, recompute)
+        prepare_output_files(path_images, path_segmentations, path_posteriors, path_resampled, path_volumes, recompute,
+                             uncompressed)
+
+    # record time and memory of all stages if necessary
+    profiler = utils.Profiler(path_profile)
 
     # get label list
     labels_segmentation, _ = utils.get_list_labels(label_list=labels_segmentation)
@@ -146,6 +161,7 @@ def predict(path_images,
         names_segmentation = utils.load_array_if_path(names_segmentation)[unique_idx]
     if topology_classes is not None:
         topology_classes = utils.load_array_if_path(topology_classes, load_as_numpy=True)[unique_idx]
+    seg_dtype = utils.get_smallest_int_dtype(labels_segmentation)
 
     # prepare volumes if necessary
     if unique_vol_file & (path_volumes[0] is not None):
@@ -191,10 +207,13 @@ def predict(path_images,
                                                                          target_res=target_res,
                                                                          crop=cropping,
                                                                          min_pad=min_pad,
-                                                                         path_resample=path_resampled[i])
+                                                                         path_resample=path_resampled[i],
+                                                                         profiler=profiler)
 
             # prediction
+            profiler.start(path_images[i])
             post_patch = net.predict(image)
+            profiler.lap(path_images[i], 'predict')
 
             # postprocessing
             seg, posteriors, volumes = postprocess(post_patch=post_patch,
@@ -207,18 +226,28 @@ def predict(path_images,
                                                    aff=aff,
                                                    im_res=im_res,
                                                    topology_classes=topology_classes)
+            profiler.lap(path_images[i], 'postprocess')
 
             # write results to disk
-            utils.save_volume(seg, aff, h, path_segmentations[i], dtype='int32')
+            utils.save_volume(seg, aff, h, path_segmentations[i], dtype=seg_dtype,
+                              compression_level=compression_level, n_threads=compression_threads)
             if path_posteriors[i] is not None:
                 if n_channels > 1:
                     posteriors = utils.add_axis(posteriors, axis=[0, -1])
-                utils.save_volume(posteriors, aff, h, path_posteriors[i], dtype='float32')
+                utils.save_volume(posteriors, aff, h, path_posteriors[i], dtype='float32',
+                                  compression_level=compression_level, n_threads=compression_threads)
+            profiler.lap(path_images[i], 'save')
 
             # compute volumes
             if path_volumes[i] is not None:
                 row = [os.path.basename(path_images[i]).replace('.nii.gz', '')] + [str(vol) for vol in volumes]
                 write_csv(path_volumes[i], row, unique_vol_file, labels_segmentation, names_segmentation)
+                profiler.lap(path_images[i], 'csv')
+
+    peak_memory = utils.get_peak_memory_usage()
+    if verbose & (peak_memory is not None):
+        print('peak memory usage: %.1f MB' % peak_memory)
+    profiler.print_summary()
 
     # evaluate
     if gt_folder is not None:
@@ -252,7 +281,8 @@ def predict(path_images,
                             verbose=verbose)
 
 
-def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, out_volumes, recompute):
+def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, out_volumes, recompute,
+                         uncompressed=False):
 
     # check inputs
     assert path_images is not None, 'please specify an input file/folder (--i)'
@@ -281,6 +311,8 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
                 assert path[-4:] == '.txt', 'if path_images given as text file, so must be %s' % name
                 with open(path, 'r') as ff:
                     path = [line.replace('\n', '') for line in ff.readlines() if line != '\n']
+                if uncompressed:
+                    path = [p.replace('.nii.gz', '.nii') for p in path]
                 recompute_files = [not os.path.isfile(p) for p in path]
             else:
                 path = [None] * len(path_images)
@@ -321,6 +353,8 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
                     path = [p.replace('.nii', '_%s.nii' % suffix) for p in path]
                     path = [p.replace('.mgz', '_%s.mgz' % suffix) for p in path]
                     path = [p.replace('.npz', '_%s.npz' % suffix) for p in path]
+                    if uncompressed:
+                        path = [p.replace('.nii.gz', '.nii') for p in path]
                     recompute_files = [not os.path.isfile(p) for p in path]
                 utils.mkdir(os.path.dirname(path[0]))
             else:
@@ -359,6 +393,8 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
                         file_name = file_name.replace('.mgz', '_%s.mgz' % suffix)
                         file_name = file_name.replace('.npz', '_%s.npz' % suffix)
                         path = os.path.join(path, file_name)
+                    if uncompressed:
+                        path = path.replace('.nii.gz', '.nii')
                     recompute_files = [not os.path.isfile(path)]
                 utils.mkdir(os.path.dirname(path))
             else:
@@ -378,10 +414,14 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
     return path_images, out_seg, out_posteriors, out_resampled, out_volumes, recompute_list, unique_volume_file
 
 
-def preprocess(path_image, n_levels, target_res, crop=None, min_pad=None, path_resample=None):
+def preprocess(path_image, n_levels, target_res, crop=None, min_pad=None, path_resample=None, profiler=None,
+               percentile_tolerance=1e-4):
 
     # read image and corresponding info
-    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True)
+    profiler = profiler if profiler is not None else utils.Profiler()
+    profiler.start(path_image)
+    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True, dtype='float32')
+    profiler.lap(path_image, 'load')
 
     # resample image if necessary
     if target_res is not None:
@@ -391,10 +431,12 @@ def preprocess(path_image, n_levels, target_res, crop=None, min_pad=None, path_r
             im, aff = edit_volumes.resample_volume(im, aff, im_res)
             if path_resample is not None:
                 utils.save_volume(im, aff, h, path_resample)
+    profiler.lap(path_image, 'resample')
 
     # align image
     im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=np.eye(4), n_dims=n_dims, return_copy=False)
     shape = list(im.shape[:n_dims])
+    profiler.lap(path_image, 'align')
 
     # crop image if necessary
     if crop is not None:
@@ -403,14 +445,18 @@ def preprocess(path_image, n_levels, target_res, crop=None, min_pad=None, path_r
         im, crop_idx = edit_volumes.crop_volume(im, cropping_shape=crop_shape, return_crop_idx=True)
     else:
         crop_idx = None
+    profiler.lap(path_image, 'crop')
 
     # normalise image
     if n_channels == 1:
-        im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5)
+        im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5,
+                                         percentile_tolerance=percentile_tolerance)
     else:
         for i in range(im.shape[-1]):
             im[..., i] = edit_volumes.rescale_volume(im[..., i], new_min=0., new_max=1.,
-                                                     min_percentile=0.5, max_percentile=99.5)
+                                                     min_percentile=0.5, max_percentile=99.5,
+                                                     percentile_tolerance=percentile_tolerance)
+    profiler.lap(path_image, 'normalise')
 
     # pad image
     input_shape = im.shape[:n_dims]
@@ -423,6 +469,7 @@ def preprocess(path_image, n_levels, target_res, crop=None, min_pad=None, path_r
 
     # add batch and channel axes
     im = utils.add_axis(im) if n_channels > 1 else utils.add_axis(im, axis=[0, -1])
+    profiler.lap(path_image, 'pad')
 
     return im, aff, h, im_res, shape, pad_idx, crop_idx
 
@@ -475,21 +522,16 @@ def build_model(path_model,
 
     if flip_indices is not None:
 
-        # segment flipped image
+        # segment image and its flipped version in a single pass, by stacking them along the batch axis
         input_image = net.inputs[0]
-        seg = net.output
-        image_flipped = layers.RandomFlip(axis=0, prob=1)(input_image)
-        last_tensor = net(image_flipped)
-
-        # flip back and re-order channels
-        last_tensor = layers.RandomFlip(axis=0, prob=1)(last_tensor)
-        last_tensor = KL.Lambda(lambda x: tf.split(x, [1] * n_labels_seg, axis=-1), name='split')(last_tensor)
-        reordered_channels = [last_tensor[flip_indices[i]] for i in range(n_labels_seg)]
-        last_tensor = KL.Lambda(lambda x: tf.concat(x, -1), name='concat')(reordered_channels)
+        last_tensor = KL.Lambda(lambda x: tf.concat([x, tf.reverse(x, axis=[1])], axis=0),
+                                name='stack_flip')(input_image)
+        last_tensor = net(last_tensor)
 
-        # average two segmentations and build model
+        # flip back the second half of the batch, re-order its channels with a single gather, and average
         name_segm_prediction_layer = 'average_lr'
-        last_tensor = KL.Lambda(lambda x: 0.5 * (x[0] + x[1]), name=name_segm_prediction_layer)([seg, last_tensor])
+        last_tensor = KL.Lambda(lambda x: average_flipped_predictions(x, flip_indices),
+                                name=name_segm_prediction_layer)(last_tensor)
         net = Model(inputs=net.inputs, outputs=last_tensor)
 
     return net
@@ -498,58 +540,50 @@ def build_model(path_model,
 def postprocess(post_patch, shape, pad_idx, crop_idx, n_dims,
                 labels_segmentation, keep_biggest_component, aff, im_res, topology_classes=None):
 
-    # get posteriors
-    post_patch = np.squeeze(post_patch)
+    # get posteriors (all operations are done in place, in float32)
+    post_patch = np.squeeze(post_patch).astype('float32', copy=False)
     if topology_classes is None:
         post_patch = edit_volumes.crop_volume_with_idx(post_patch, pad_idx, n_dims=3, return_copy=False)
 
     # keep biggest connected component
     if keep_biggest_component:
-        tmp_post_patch = post_patch[..., 1:]
-        post_patch_mask = np.sum(tmp_post_patch, axis=-1) > 0.25
+        post_patch_mask = np.sum(post_patch[..., 1:], axis=-1) > 0.25
         post_patch_mask = edit_volumes.get_largest_connected_component(post_patch_mask)
-        post_patch_mask = np.stack([post_patch_mask]*tmp_post_patch.shape[-1], axis=-1)
-        tmp_post_patch = edit_volumes.mask_volume(tmp_post_patch, mask=post_patch_mask, return_copy=False)
-        post_patch[..., 1:] = tmp_post_patch
+        post_patch[np.logical_not(post_patch_mask), 1:] = 0
 
     # reset posteriors to zero outside the largest connected component of each topological class
     if topology_classes is not None:
-        post_patch_mask = post_patch > 0.25
-        for topology_class in np.unique(topology_classes)[1:]:
-            tmp_topology_indices = np.where(topology_classes == topology_class)[0]
-            tmp_mask = np.any(post_patch_mask[..., tmp_topology_indices], axis=-1)
-            tmp_mask = edit_volumes.get_largest_connected_component(tmp_mask)
-            for idx in tmp_topology_indices:
-                post_patch[..., idx] *= tmp_mask
+        edit_volumes.keep_largest_connected_component_per_class(post_patch, topology_classes, threshold=0.25)
         post_patch = edit_volumes.crop_volume_with_idx(post_patch, pad_idx, n_dims=3, return_copy=False)
 
     # normalise posteriors and get hard segmentation
     if keep_biggest_component | (topology_classes is not None):
-        post_patch /= np.sum(post_patch, axis=-1)[..., np.newaxis]
-    seg_patch = labels_segmentation[post_patch.argmax(-1).astype('int32')].astype('int32')
+        post_patch /= np.sum(post_patch, axis=-1, keepdims=True)
+    seg_patch = labels_segmentation.astype('int32')[post_patch.argmax(-1)]
 
     # paste patches back to matrix of original image size
     if crop_idx is not None:
         # we need to go through this because of the posteriors of the background, otherwise pad_volume would work
         seg = np.zeros(shape=shape, dtype='int32')
-        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]])
-        posteriors[..., 0] = np.ones(shape)  # place background around patch
+        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]], dtype='float32')
+        posteriors[..., 0] = 1  # place background around patch
         if n_dims == 2:
             seg[crop_idx[0]:crop_idx[2], crop_idx[1]:crop_idx[3]] = seg_patch
             posteriors[crop_idx[0]:crop_idx[2], crop_idx[1]:crop_idx[3], :] = post_patch
         elif n_dims == 3:
             seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
             posteriors[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5], :] = post_patch
+        del seg_patch, post_patch
     else:
         seg = seg_patch
         posteriors = post_patch
 
-    # align prediction back to first orientation
+    # align prediction back to first orientation (this only returns views of the arrays, not copies)
     seg = edit_volumes.align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=n_dims, return_copy=False)
     posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=n_dims, return_copy=False)
 
     # compute volumes
-    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)), dtype='float64')
     volumes = np.around(volumes * np.prod(im_res), 3)
 
     return seg, posteriors, volumes
@@ -591,6 +625,15 @@ def get_flip_indices(labels_segmentation, n_neutral_labels):
     return labels_segmentation, flip_indices, unique_idx
 
 
+def average_flipped_predictions(predictions, flip_indices):
+    """Average the predictions obtained for a batch of images (first half of the batch) and their right/left flipped
+    versions (second half), as stacked along the batch axis in build_model.
+    The flipped predictions are flipped back, and their channels are re-ordered with flip_indices."""
+    n_images = tf.shape(predictions)[0] // 2
+    flipped = tf.gather(tf.reverse(predictions[n_images:], axis=[1]), flip_indices, axis=-1)
+    return 0.5 * (predictions[:n_images] + flipped)
+
+
 def write_csv(path_csv, data, unique_file, labels, names, skip_first=True, last_first=False):
 
     # initialisation
@@ -57,12 +57,16 @@ def predict(path_predictions,
             list_correct_labels=None,
             compute_distances=False,
             recompute=True,
-            verbose=True):
+            verbose=True,
+            path_profile=None):
 
     # prepare input/output filepaths
     path_predictions, path_corrections, path_posteriors, path_volumes, compute, unique_vol_file = \
         prepare_output_files(path_predictions, path_corrections, path_posteriors, path_volumes, recompute)
 
+    # record time and memory of all stages if necessary
+    profiler = utils.Profiler(path_profile)
+
     # get label list
     input_segmentation_labels = utils.get_list_labels(label_list=input_segmentation_labels)[0]
     input_segmentation_labels, unique_idx = np.unique(input_segmentation_labels, return_index=True)
@@ -120,10 +124,13 @@ def predict(path_predictions,
             prediction, aff, h, im_res, shape, pad_idx, crop_idx = preprocess(path_prediction=path_predictions[i],
                                                                               n_levels=n_levels,
                                                                               crop=cropping,
-                                                                              min_pad=min_pad)
+                                                                              min_pad=min_pad,
+                                                                              profiler=profiler)
 
             # prediction
+            profiler.start(path_predictions[i])
             post_patch = net.predict(prediction)
+            profiler.lap(path_predictions[i], 'predict')
 
             # postprocessing
             seg, posteriors, volumes = postprocess(post_patch=post_patch,
@@ -136,18 +143,24 @@ def predict(path_predictions,
                                                    aff=aff,
                                                    im_res=im_res,
                                                    topology_classes=topology_classes)
+            profiler.lap(path_predictions[i], 'postprocess')
 
             # write results to disk
-            utils.save_volume(seg, aff, h, path_corrections[i], dtype='int32')
+            utils.save_volume(seg, aff, h, path_corrections[i],
+                              dtype=utils.get_smallest_int_dtype(target_segmentation_labels))
             if path_posteriors[i] is not None:
                 if n_channels > 1:
                     posteriors = utils.add_axis(posteriors, axis=[0, -1])
                 utils.save_volume(posteriors, aff, h, path_posteriors[i], dtype='float32')
+            profiler.lap(path_predictions[i], 'save')
 
             # compute volumes
             if path_volumes[i] is not None:
                 row = [os.path.basename(path_predictions[i]).replace('.nii.gz', '')] + [str(vol) for vol in volumes]
                 write_csv(path_volumes[i], row, unique_vol_file, target_segmentation_labels, names_segmentation)
+                profiler.lap(path_predictions[i], 'csv')
+
+    profiler.print_summary()
 
     # evaluate
     if gt_folder is not None:
@@ -303,14 +316,18 @@ def prepare_output_files(path_predictions, out_corrections, out_posteriors, out_
     return path_predictions, out_corrections, out_posteriors, out_volumes, recompute_list, unique_volume_file
 
 
-def preprocess(path_prediction, n_levels, crop=None, min_pad=None):
+def preprocess(path_prediction, n_levels, crop=None, min_pad=None, profiler=None):
 
     # read image and corresponding info
+    profiler = profiler if profiler is not None else utils.Profiler()
+    profiler.start(path_prediction)
     pred, _, aff_pred, n_dims, _, h_pred, res_pred = utils.get_volume_info(path_prediction, True)
+    profiler.lap(path_prediction, 'load')
 
     # align image
     pred = edit_volumes.align_volume_to_ref(pred, aff_pred, aff_ref=np.eye(4), n_dims=n_dims)
     shape = list(pred.shape[:n_dims])
+    profiler.lap(path_prediction, 'align')
 
     # crop image if necessary
     if crop is not None:
@@ -320,6 +337,7 @@ def preprocess(path_prediction, n_levels, crop=None, min_pad=None):
     else:
         crop_idx = None
         input_shape = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in shape]
+    profiler.lap(path_prediction, 'crop')
 
     # pad image
     if min_pad is not None:  # in SynthSeg predict use crop flag and then if used do min_pad=crop else min_pad = 192
@@ -329,6 +347,7 @@ def preprocess(path_prediction, n_levels, crop=None, min_pad=None):
 
     # add batch and channel axes
     pred = utils.add_axis(pred, axis=0)  # channel axis will be added later when computing one-hot
+    profiler.lap(path_prediction, 'pad')
 
     return pred, aff_pred, h_pred, res_pred, shape, pad_idx, crop_idx
 
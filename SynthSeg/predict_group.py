@@ -58,12 +58,16 @@ def predict(path_images,
             list_correct_labels=None,
             compute_distances=False,
             recompute=True,
-            verbose=True):
+            verbose=True,
+            path_profile=None):
 
     # prepare input/output filepaths
     path_images, path_masks, path_segmentations, path_posteriors, path_volumes, compute, unique_vol_file = \
         prepare_output_files(path_images, path_masks, path_segmentations, path_posteriors, path_volumes, recompute)
 
+    # record time and memory of all stages if necessary
+    profiler = utils.Profiler(path_profile)
+
     # get label list
     labels_mask, _ = utils.get_list_labels(label_list=labels_mask)
     mask_labels_unique = np.unique(labels_mask)
@@ -112,10 +116,13 @@ def predict(path_images,
                                                                                path_mask=path_masks[i],
                                                                                n_levels=n_levels,
                                                                                crop=cropping,
-                                                                               min_pad=min_pad)
+                                                                               min_pad=min_pad,
+                                                                               profiler=profiler)
 
             # prediction
+            profiler.start(path_images[i])
             post_patch = net.predict([image, mask])
+            profiler.lap(path_images[i], 'predict')
 
             # postprocessing
             seg, posteriors, volumes = postprocess(post_patch=post_patch,
@@ -129,18 +136,27 @@ def predict(path_images,
                                                    keep_biggest_component=keep_biggest_component,
                                                    aff=aff,
                                                    im_res=im_res)
+            profiler.lap(path_images[i], 'postprocess')
 
             # write results to disk
-            utils.save_volume(seg, aff, h, path_segmentations[i], dtype='int32')
+            utils.save_volume(seg, aff, h, path_segmentations[i],
+                              dtype=utils.get_smallest_int_dtype(labels_segmentation))
             if path_posteriors[i] is not None:
                 if n_channels > 1:
                     posteriors = utils.add_axis(posteriors, axis=[0, -1])
                 utils.save_volume(posteriors, aff, h, path_posteriors[i], dtype='float32')
+            profiler.lap(path_images[i], 'save')
 
             # compute volumes
             if path_volumes[i] is not None:
                 row = [os.path.basename(path_images[i]).replace('.nii.gz', '')] + [str(vol) for vol in volumes]
                 write_csv(path_volumes[i], row, unique_vol_file, labels_segmentation, names_segmentation)
+                profiler.lap(path_images[i], 'csv')
+
+    peak_memory = utils.get_peak_memory_usage()
+    if verbose & (peak_memory is not None):
+        print('peak memory usage: %.1f MB' % peak_memory)
+    profiler.print_summary()
 
     # evaluate
     if gt_folder is not None:
@@ -314,16 +330,20 @@ def prepare_output_files(path_images, path_masks, out_seg, out_posteriors, out_v
     return path_images, path_masks, out_seg, out_posteriors, out_volumes, recompute_list, unique_volume_file
 
 
-def preprocess(path_image, path_mask, n_levels, crop=None, min_pad=None):
+def preprocess(path_image, path_mask, n_levels, crop=None, min_pad=None, profiler=None, percentile_tolerance=1e-4):
 
     # read image and corresponding info
-    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True)
+    profiler = profiler if profiler is not None else utils.Profiler()
+    profiler.start(path_image)
+    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True, dtype='float32')
     mask = utils.load_volume(path_mask, True)
+    profiler.lap(path_image, 'load')
 
     # align image
     im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=np.eye(4), n_dims=n_dims, return_copy=False)
     mask = edit_volumes.align_volume_to_ref(mask, aff, aff_ref=np.eye(4), n_dims=n_dims, return_copy=False)
     shape = list(im.shape[:n_dims])
+    profiler.lap(path_image, 'align')
 
     # crop image if necessary
     if crop is not None:
@@ -333,14 +353,18 @@ def preprocess(path_image, path_mask, n_levels, crop=None, min_pad=None):
         mask = edit_volumes.crop_volume_with_idx(mask, crop_idx, n_dims=n_dims)
     else:
         crop_idx = None
+    profiler.lap(path_image, 'crop')
 
     # normalise image
     if n_channels == 1:
-        im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5)
+        im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5,
+                                         percentile_tolerance=percentile_tolerance)
     else:
         for i in range(im.shape[-1]):
             im[..., i] = edit_volumes.rescale_volume(im[..., i], new_min=0., new_max=1.,
-                                                     min_percentile=0.5, max_percentile=99.5)
+                                                     min_percentile=0.5, max_percentile=99.5,
+                                                     percentile_tolerance=percentile_tolerance)
+    profiler.lap(path_image, 'normalise')
 
     # pad image
     input_shape = im.shape[:n_dims]
@@ -355,6 +379,7 @@ def preprocess(path_image, path_mask, n_levels, crop=None, min_pad=None):
     # add batch and channel axes
     im = utils.add_axis(im) if n_channels > 1 else utils.add_axis(im, axis=[0, -1])
     mask = utils.add_axis(mask, axis=0)  # channel axis will be added later when computing one-hot
+    profiler.lap(path_image, 'pad')
 
     return im, mask, aff, h, im_res, shape, pad_idx, crop_idx
 
@@ -409,27 +434,23 @@ def build_model(path_model,
 def postprocess(post_patch, mask, shape, pad_idx, crop_idx, n_dims,
                 labels_segmentation, strict_masking, keep_biggest_component, aff, im_res):
 
-    # get posteriors
-    post_patch = np.squeeze(post_patch)
+    # get posteriors (all operations are done in place, in float32)
+    post_patch = np.squeeze(post_patch).astype('float32', copy=False)
     mask = np.squeeze(mask)
 
     # reset posteriors of background to 1 outside mask and to 0 inside
     if strict_masking:
-        post_patch[..., 0] = np.ones_like(post_patch[..., 0])
-        post_patch[..., 0] = edit_volumes.mask_volume(post_patch[..., 0], mask=mask < 0.1, return_copy=False)
+        post_patch[..., 0] = mask < 0.1
     # keep biggest connected component (use it with smoothing!)
     elif keep_biggest_component:
-        tmp_post_patch = post_patch[..., 1:]
-        post_patch_mask = np.sum(tmp_post_patch, axis=-1) > 0.25
+        post_patch_mask = np.sum(post_patch[..., 1:], axis=-1) > 0.25
         post_patch_mask = edit_volumes.get_largest_connected_component(post_patch_mask)
-        post_patch_mask = np.stack([post_patch_mask]*tmp_post_patch.shape[-1], axis=-1)
-        tmp_post_patch = edit_volumes.mask_volume(tmp_post_patch, mask=post_patch_mask, return_copy=False)
-        post_patch[..., 1:] = tmp_post_patch
+        post_patch[np.logical_not(post_patch_mask), 1:] = 0
 
     # normalise posteriors and get hard segmentation
     if strict_masking | keep_biggest_component:
-        post_patch /= np.sum(post_patch, axis=-1)[..., np.newaxis]
-    seg_patch = labels_segmentation[post_patch.argmax(-1).astype('int32')].astype('int32')
+        post_patch /= np.sum(post_patch, axis=-1, keepdims=True)
+    seg_patch = labels_segmentation.astype('int32')[post_patch.argmax(-1)]
 
     # paste patches back to matrix of original image size
     seg_patch = edit_volumes.crop_volume_with_idx(seg_patch, pad_idx, n_dims=n_dims, return_copy=False)
@@ -437,24 +458,25 @@ def postprocess(post_patch, mask, shape, pad_idx, crop_idx, n_dims,
     if crop_idx is not None:
         # we need to go through this because of the posteriors of the background, otherwise pad_volume would work
         seg = np.zeros(shape=shape, dtype='int32')
-        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]])
-        posteriors[..., 0] = np.ones(shape)  # place background around patch
+        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]], dtype='float32')
+        posteriors[..., 0] = 1  # place background around patch
         if n_dims == 2:
             seg[crop_idx[0]:crop_idx[2], crop_idx[1]:crop_idx[3]] = seg_patch
             posteriors[crop_idx[0]:crop_idx[2], crop_idx[1]:crop_idx[3], :] = post_patch
         elif n_dims == 3:
             seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
             posteriors[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5], :] = post_patch
+        del seg_patch, post_patch
     else:
         seg = seg_patch
         posteriors = post_patch
 
-    # align prediction back to first orientation
+    # align prediction back to first orientation (this only returns views of the arrays, not copies)
     seg = edit_volumes.align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=n_dims, return_copy=False)
     posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=n_dims, return_copy=False)
 
     # compute volumes
-    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)), dtype='float64')
     volumes = np.around(volumes * np.prod(im_res), 3)
 
     return seg, posteriors, volumes
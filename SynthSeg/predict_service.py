@@ -0,0 +1,300 @@
+"""
+This file implements a long-running local segmentation service for SynthSeg. Networks are built once per set of options
+and kept in memory, which avoids paying for the tensorflow import and the model building at each segmentation.
+Jobs are submitted through a localhost HTTP API, which accepts the following requests:
+    - POST /jobs: submit a job, given as a json dictionary with the same keys as the options of
+      scripts/commands/SynthSeg_predict.py (i, o, parc, robust, fast, ct, vol, qc, post, resample, crop, v1, manifest,
+      profile, compression, compression_threads, uncompressed, post_format, post_topk, parc_margin, auto_crop,
+      canonical, lean, slab, tile, tile_overlap, tile_blending, compact). Only i and o are mandatory.
+      Returns the id of the job.
+    - GET /jobs/<id>: get the status of a job (queued, running, done, or failed), its timings, and possible errors.
+    - GET /stats: get the queue depth, the number of processed jobs, and latency statistics for each stage (queue, run,
+      and total, as well as the stages of predict_synthseg.predict, e.g. load, resample, predict, postprocess, save).
+    - GET /health: check that the service is up.
+Jobs are processed one at a time with predict_synthseg.predict, so results are identical to those of the CLI.
+
+If you use this code, please cite one of the SynthSeg papers:
+https://github.com/BBillot/SynthSeg/blob/master/bibtex.bib
+
+Copyright 2020 Benjamin Billot
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+https://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under the
+License.
+"""
+
+
+# python imports
+import os
+import json
+import time
+import queue
+import threading
+import traceback
+import numpy as np
+from collections import deque
+from socketserver import ThreadingMixIn
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+# project imports
+from SynthSeg.predict_synthseg import predict
+
+# third-party imports
+from ext.lab2im import utils
+
+
+def get_predict_arguments(job, synthseg_home, n_threads=1):
+    """Convert a job into the arguments of predict_synthseg.predict, with the right models and labels. This is used by
+    scripts/commands/SynthSeg_predict.py as well, so that the CLI and the service always run the same predictions.
+    :param job: dictionary with the same keys as the options of SynthSeg_predict.py (except for threads, cpu, and
+    model_cache, which are process-wide settings). Only 'i' and 'o' are mandatory.
+    :param synthseg_home: path of the SynthSeg folder, which contains the models and data folders.
+    :param n_threads: (optional) number of threads used to resample the images. Default is 1.
+    :return: a dictionary of arguments for predict_synthseg.predict.
+    """
+
+    # check inputs
+    unknown_keys = set(job.keys()) - {'i', 'o', 'parc', 'robust', 'fast', 'ct', 'vol', 'qc', 'post', 'resample', 'crop',
+                                      'v1', 'prefetch', 'writers', 'batch', 'batch_voxels', 'manifest', 'profile',
+                                      'compression', 'compression_threads', 'uncompressed', 'post_format',
+                                      'post_topk', 'parc_margin', 'auto_crop', 'canonical', 'lean', 'slab', 'tile',
+                                      'tile_overlap', 'tile_blending', 'compact'}
+    assert not unknown_keys, 'unknown job options: %s' % ', '.join(sorted(unknown_keys))
+    assert job.get('i') is not None, 'please specify an input file/folder (i)'
+    assert job.get('o') is not None, 'please specify an output file/folder (o)'
+    robust = bool(job.get('robust', False))
+    v1 = bool(job.get('v1', False))
+    assert not (robust & v1), 'v1 cannot be used with robust since SynthSeg-robust only came out with 2.0.'
+    canonical_sizes = job.get('canonical')
+    if isinstance(canonical_sizes, list) and (len(canonical_sizes) == 1):
+        canonical_sizes = canonical_sizes[0]
+    model_dir = os.path.join(synthseg_home, 'models')
+    labels_dir = os.path.join(synthseg_home, 'data/labels_classes_priors')
+
+    args = {'path_images': job['i'],
+            'path_segmentations': job['o'],
+            'path_model_segmentation': os.path.join(model_dir,
+                                                    'synthseg_robust_2.0.h5' if robust else 'synthseg_2.0.h5'),
+            'labels_segmentation': os.path.join(labels_dir, 'synthseg_segmentation_labels_2.0.npy'),
+            'robust': robust,
+            'fast': robust | bool(job.get('fast', False)),
+            'v1': v1,
+            'do_parcellation': bool(job.get('parc', False)),
+            'n_neutral_labels': 19,
+            'names_segmentation': os.path.join(labels_dir, 'synthseg_segmentation_names_2.0.npy'),
+            'labels_denoiser': os.path.join(labels_dir, 'synthseg_denoiser_labels_2.0.npy'),
+            'path_posteriors': job.get('post'),
+            'path_resampled': job.get('resample'),
+            'path_volumes': job.get('vol'),
+            'path_model_parcellation': os.path.join(model_dir, 'synthseg_parc_2.0.h5'),
+            'labels_parcellation': os.path.join(labels_dir, 'synthseg_parcellation_labels.npy'),
+            'names_parcellation': os.path.join(labels_dir, 'synthseg_parcellation_names.npy'),
+            'path_model_qc': os.path.join(model_dir, 'synthseg_qc_2.0.h5'),
+            'labels_qc': os.path.join(labels_dir, 'synthseg_qc_labels_2.0.npy'),
+            'path_qc_scores': job.get('qc'),
+            'names_qc': os.path.join(labels_dir, 'synthseg_qc_names_2.0.npy'),
+            'cropping': job.get('crop'),
+            'topology_classes': os.path.join(labels_dir, 'synthseg_topological_classes_2.0.npy'),
+            'ct': bool(job.get('ct', False)),
+            'n_prefetch': int(job.get('prefetch', 0)),
+            'n_writers': int(job.get('writers', 0)),
+            'batch_size': int(job.get('batch', 1)),
+            'max_batch_voxels': job.get('batch_voxels'),
+            'path_manifest': job.get('manifest'),
+            'path_profile': job.get('profile'),
+            'compression_level': job.get('compression'),
+            'compression_threads': int(job.get('compression_threads', 1)),
+            'uncompressed': bool(job.get('uncompressed', False)),
+            'posteriors_format': job.get('post_format', 'float32'),
+            'posteriors_top_k': int(job.get('post_topk', 4)),
+            'parcellation_margin': job.get('parc_margin'),
+            'auto_crop_margin': job.get('auto_crop'),
+            'canonical_sizes': canonical_sizes,
+            'lean': bool(job.get('lean', False)),
+            'slab_size': job.get('slab'),
+            'tile_shape': job.get('tile'),
+            'tile_overlap': job.get('tile_overlap', 32),
+            'tile_blending': job.get('tile_blending', 'gaussian'),
+            'compact_outputs': bool(job.get('compact', False)),
+            'n_threads': n_threads}
+
+    # use previous model if needed
+    if v1:
+        args['path_model_segmentation'] = os.path.join(model_dir, 'synthseg_1.0.h5')
+        for key in ['labels_segmentation', 'labels_qc', 'names_segmentation', 'names_qc', 'topology_classes']:
+            args[key] = args[key].replace('_2.0.npy', '.npy')
+        args['n_neutral_labels'] = 18
+
+    return args
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    """HTTP server handling each request in its own thread (http.server.ThreadingHTTPServer needs python 3.7)."""
+    daemon_threads = True
+
+
+class SegmentationService:
+    """Queue of segmentation jobs, which are processed one at a time by predict_synthseg.predict.
+    Built networks are kept in memory, so that they are only built once per set of options."""
+
+    def __init__(self, synthseg_home, path_model_cache=None, max_latency_records=1000, n_threads=1):
+        """
+        :param synthseg_home: path of the SynthSeg folder, which contains the models and data folders.
+        :param path_model_cache: (optional) folder where networks are cached on disk (see predict_synthseg.predict).
+        :param n_threads: (optional) number of threads used to resample the images. Default is 1.
+        :param max_latency_records: (optional) number of most recent jobs used to compute latency statistics.
+        """
+        self.synthseg_home = synthseg_home
+        self.path_model_cache = path_model_cache
+        self.loaded_models = dict()
+        self.jobs = dict()
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.n_submitted = 0
+        self.n_done = 0
+        self.n_failed = 0
+        self.latencies = dict()
+        self.max_latency_records = max_latency_records
+        self.n_threads = n_threads
+        self.start_time = time.time()
+
+    def submit(self, job):
+        """Add a job to the queue, and return its id. Raises an exception if the job options are not valid."""
+        args = get_predict_arguments(job, self.synthseg_home, n_threads=self.n_threads)
+        with self.lock:
+            self.n_submitted += 1
+            job_id = str(self.n_submitted)
+            self.jobs[job_id] = {'id': job_id, 'status': 'queued', 'options': job, 'submitted': time.time(),
+                                 'latencies': dict(), 'error': None}
+        self.queue.put((job_id, args))
+        return job_id
+
+    def get_job(self, job_id):
+        """Return a copy of the record of a job, or None if this job does not exist."""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return json.loads(json.dumps(job)) if job is not None else None
+
+    def get_stats(self):
+        """Return the queue depth, the number of processed jobs, and latency statistics (in seconds) per stage."""
+        with self.lock:
+            latencies = {stage: {'mean': float(np.mean(values)),
+                                 'median': float(np.median(values)),
+                                 'max': float(np.max(values)),
+                                 'n_jobs': len(values)} for stage, values in self.latencies.items() if len(values) > 0}
+            return {'queue_depth': self.queue.qsize(),
+                    'submitted': self.n_submitted,
+                    'done': self.n_done,
+                    'failed': self.n_failed,
+                    'loaded_models': len(self.loaded_models),
+                    'latencies': latencies}
+
+    def get_health(self):
+        return {'status': 'ok', 'uptime': time.time() - self.start_time}
+
+    def record_latency(self, job_id, stage, latency):
+        with self.lock:
+            self.jobs[job_id]['latencies'][stage] = latency
+            self.latencies.setdefault(stage, deque(maxlen=self.max_latency_records)).append(latency)
+
+    def run_next_job(self, timeout=None):
+        """Process the next job of the queue. Returns False if no job was available after timeout seconds."""
+        try:
+            job_id, args = self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return False
+
+        # run job
+        start = time.time()
+        with self.lock:
+            self.jobs[job_id]['status'] = 'running'
+        self.record_latency(job_id, 'queue', start - self.jobs[job_id]['submitted'])
+        profiler = utils.Profiler(args.pop('path_profile'), keep_records=True)
+        try:
+            predict(**args, path_model_cache=self.path_model_cache, loaded_models=self.loaded_models, profiler=profiler)
+            error = None
+        except SystemExit:  # predict exits when some of the inputs could not be segmented
+            error = 'some inputs could not be segmented, see the service logs for details'
+        except Exception:
+            error = traceback.format_exc()
+            print(error)
+
+        # update job record (with the time spent in each stage of predict, summed over all the images of the job)
+        for stage, latency in profiler.get_stage_times().items():
+            self.record_latency(job_id, stage, latency)
+        self.record_latency(job_id, 'run', time.time() - start)
+        self.record_latency(job_id, 'total', time.time() - self.jobs[job_id]['submitted'])
+        with self.lock:
+            self.jobs[job_id]['status'] = 'done' if error is None else 'failed'
+            self.jobs[job_id]['error'] = error
+            if error is None:
+                self.n_done += 1
+            else:
+                self.n_failed += 1
+        self.queue.task_done()
+        return True
+
+    def serve(self, host='127.0.0.1', port=8000):
+        """Start the HTTP server in a background thread, and process jobs in the calling thread (so that all the
+        tensorflow work happens in the same thread) until interrupted."""
+        handler = type('Handler', (ServiceRequestHandler,), {'service': self})
+        server = ThreadingHTTPServer((host, port), handler)
+        server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+        server_thread.start()
+        print('SynthSeg service listening on http://%s:%s' % (host, port))
+        try:
+            while True:
+                self.run_next_job(timeout=1)
+        except KeyboardInterrupt:
+            print('\nshutting down SynthSeg service')
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface of a SegmentationService, which is given as a class attribute."""
+
+    service = None
+
+    def do_GET(self):
+        if self.path == '/health':
+            self.send_json(200, self.service.get_health())
+        elif self.path == '/stats':
+            self.send_json(200, self.service.get_stats())
+        elif self.path.startswith('/jobs/'):
+            job = self.service.get_job(self.path[len('/jobs/'):])
+            if job is None:
+                self.send_json(404, {'error': 'unknown job'})
+            else:
+                self.send_json(200, job)
+        else:
+            self.send_json(404, {'error': 'unknown endpoint'})
+
+    def do_POST(self):
+        if self.path != '/jobs':
+            self.send_json(404, {'error': 'unknown endpoint'})
+            return
+        try:
+            job = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            assert isinstance(job, dict), 'job should be given as a json dictionary'
+            job_id = self.service.submit(job)
+        except Exception as e:
+            self.send_json(400, {'error': str(e)})
+            return
+        self.send_json(202, {'id': job_id})
+
+    def send_json(self, code, data):
+        body = json.dumps(data).encode()
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # keep the service logs for segmentation outputs
@@ -17,16 +17,22 @@ License.
 # python imports
 import os
 import sys
+import json
+import time
+import hashlib
+import itertools
 import traceback
+import subprocess
 import numpy as np
 import tensorflow as tf
+import keras
 import keras.layers as KL
 import keras.backend as K
 from keras.models import Model
 
 # project imports
 from SynthSeg import evaluate
-from SynthSeg.predict import write_csv, get_flip_indices
+from SynthSeg.predict import write_csv, get_flip_indices, average_flipped_predictions
 
 # third-party imports
 from ext.lab2im import utils
@@ -34,6 +40,11 @@ from ext.lab2im import layers
 from ext.lab2im import edit_volumes
 from ext.neuron import models as nrn_models
 
+# version of the graphs built by build_model, which is part of the keys of cached networks and of the manifest options.
+# This must be increased whenever build_model or the layers it uses (ext/lab2im, ext/neuron) change the built graphs,
+# so that frozen networks and outputs computed with previous graphs are not reused.
+MODEL_CACHE_VERSION = 1
+
 
 def predict(path_images,
             path_segmentations,
@@ -68,11 +79,35 @@ def predict(path_images,
             list_correct_labels=None,
             compute_distances=False,
             recompute=True,
-            verbose=True):
+            verbose=True,
+            n_prefetch=0,
+            n_writers=0,
+            batch_size=1,
+            max_batch_voxels=None,
+            path_model_cache=None,
+            loaded_models=None,
+            tile_shape=None,
+            tile_overlap=32,
+            tile_blending='gaussian',
+            path_manifest=None,
+            path_profile=None,
+            compression_level=None,
+            compression_threads=1,
+            uncompressed=False,
+            posteriors_format='float32',
+            posteriors_top_k=4,
+            compact_outputs=False,
+            parcellation_margin=None,
+            auto_crop_margin=None,
+            canonical_sizes=None,
+            lean=False,
+            slab_size=None,
+            profiler=None,
+            n_threads=1):
 
     # prepare input/output filepaths
     outputs = prepare_output_files(path_images, path_segmentations, path_posteriors, path_resampled,
-                                   path_volumes, path_qc_scores, recompute)
+                                   path_volumes, path_qc_scores, recompute, uncompressed, posteriors_format)
     path_images = outputs[0]
     path_segmentations = outputs[1]
     path_posteriors = outputs[2]
@@ -83,6 +118,9 @@ def predict(path_images,
     unique_qc_file = outputs[7]
     compute = outputs[8]
 
+    # record time and memory of all stages if necessary (a profiler can be given to read the laps afterwards)
+    profiler = profiler if profiler is not None else utils.Profiler(path_profile)
+
     # get label lists
     labels_segmentation, _ = utils.get_list_labels(label_list=labels_segmentation)
     if (n_neutral_labels is not None) & (not fast) & (not robust):
@@ -112,7 +150,11 @@ def predict(path_images,
         labels_volumes = np.concatenate([labels_volumes, np.array([np.max(labels_volumes + 1)])])
         if names_segmentation is not None:
             names_volumes = np.concatenate([names_volumes, np.array(['total intracranial'])])
+    seg_dtype = utils.get_smallest_int_dtype(labels_volumes)
     do_qc = True if path_qc_scores[0] is not None else False
+    if (tile_shape is not None) & do_qc:
+        raise Exception('QC scores cannot be computed with tiled inference, since the QC network needs the whole '
+                        'segmentation. Please run without tile_shape to compute QC scores.')
     if do_qc:
         labels_qc = utils.get_list_labels(labels_qc)[0][unique_idx]
         if names_qc is not None:
@@ -124,82 +166,253 @@ def predict(path_images,
     if unique_qc_file & do_qc:
         write_csv(path_qc_scores[0], None, True, labels_qc, names_qc)
 
-    # build network
-    net = build_model(path_model_segmentation=path_model_segmentation,
-                      path_model_parcellation=path_model_parcellation,
-                      path_model_qc=path_model_qc,
-                      input_shape_qc=input_shape_qc,
-                      labels_segmentation=labels_segmentation,
-                      labels_denoiser=labels_denoiser,
-                      labels_parcellation=labels_parcellation,
-                      labels_qc=labels_qc,
-                      sigma_smoothing=sigma_smoothing,
-                      flip_indices=flip_indices,
-                      robust=robust,
-                      do_parcellation=do_parcellation,
-                      do_qc=do_qc)
+    # options of the network
+    build_kwargs = {'path_model_segmentation': path_model_segmentation,
+                    'path_model_parcellation': path_model_parcellation,
+                    'path_model_qc': path_model_qc,
+                    'input_shape_qc': input_shape_qc,
+                    'labels_segmentation': labels_segmentation,
+                    'labels_denoiser': labels_denoiser,
+                    'labels_parcellation': labels_parcellation,
+                    'labels_qc': labels_qc,
+                    'sigma_smoothing': sigma_smoothing,
+                    'flip_indices': flip_indices,
+                    'robust': robust,
+                    'do_parcellation': do_parcellation,
+                    'do_qc': do_qc,
+                    'parcellation_margin': parcellation_margin}
+
+    # compute label maps and volumes inside the network when posteriors are not needed (see build_model). Subjects whose
+    # brain mask has several connected components are predicted again with posteriors, so that results are unchanged
+    build_kwargs['compact_outputs'] = compact_outputs & (fast | (topology_classes is None)) & (tile_shape is None) & \
+        all(path is None for path in path_posteriors)
 
     # set cropping/padding
+    assert (cropping is None) | (auto_crop_margin is None), 'cropping and auto_crop_margin cannot be used together'
     if cropping is not None:
         cropping = utils.reformat_to_list(cropping, length=3, dtype='int')
         min_pad = cropping
     else:
         min_pad = 128
 
-    # perform segmentation
-    if len(path_images) <= 10:
-        loop_info = utils.LoopInfo(len(path_images), 1, 'predicting', True)
-    else:
-        loop_info = utils.LoopInfo(len(path_images), 10, 'predicting', True)
-    list_errors = list()
-    for i in range(len(path_images)):
+    # only recompute subjects whose inputs, weights, options or outputs changed since they were added to the manifest
+    # (inputs and outputs are only hashed again if their size or modification time changed, see is_up_to_date)
+    finished_subjects = dict()
+    if path_manifest is not None:
+        manifest, n_lines = load_manifest(path_manifest)
+        n_manifest_lines = [n_lines]  # updated as entries are appended to the manifest
+        network_kwargs = {key: value for key, value in build_kwargs.items() if key != 'compact_outputs'}
+        options_hash = get_manifest_options_hash(network_kwargs, fast=fast, v1=v1, ct=ct, cropping=cropping,
+                                                 topology_classes=topology_classes, tile_shape=tile_shape,
+                                                 tile_overlap=tile_overlap, tile_blending=tile_blending,
+                                                 posteriors_format=posteriors_format, posteriors_top_k=posteriors_top_k,
+                                                 auto_crop_margin=auto_crop_margin, canonical_sizes=canonical_sizes)
+        input_records = [None] * len(path_images)  # inputs to segment are hashed by the reading threads
+        path_outputs = [[path for path in [path_segmentations[i], path_posteriors[i], path_resampled[i]]
+                         if path is not None] for i in range(len(path_images))]
+        for i in range(len(path_images)):
+            entry = manifest.get(path_images[i])
+            compute[i] = not is_up_to_date(entry, path_images[i], options_hash, path_outputs[i])
+            if not compute[i]:
+                finished_subjects[i] = ((np.array(entry['volumes']), entry['qc_scores'], None), None)
         if verbose:
-            loop_info.update(i)
-
-        # compute segmentation only if needed
-        if compute[i]:
-
+            print('%d subjects are up to date in the manifest, skipping them' % len(finished_subjects))
+
+    # build network, or load it from cache if possible (only if some subjects need to be segmented)
+    # lean networks are run layer by layer by LeanModel, which needs the keras model (so they are not cached on disk)
+    def get_network(**kwargs):
+        model_key = get_model_cache_key(hash_weights=False, lean=lean, slab_size=slab_size, **kwargs) \
+            if loaded_models is not None else None
+        if (loaded_models is not None) and (model_key in loaded_models):
+            return loaded_models[model_key]
+        if lean:
+            network = LeanModel(build_model(**kwargs), slab_size=slab_size)
+        elif path_model_cache is not None:
+            network = load_model_from_cache(path_model_cache, **kwargs)
+        else:
+            network = build_model(**kwargs)
+        if loaded_models is not None:
+            loaded_models[model_key] = network
+        return network
+
+    if any(compute):
+        start = time.time()
+        profiler.start('network')
+        net = get_network(**build_kwargs)
+        profiler.lap('network', 'build')
+        if verbose:
+            print('network ready in %.1f seconds' % (time.time() - start))
+
+    # group subjects to segment in batches of images with the same padded shape
+    list_subjects = [i for i in range(len(path_images)) if compute[i]]
+    list_batches = get_batches(path_images, list_subjects, batch_size, max_batch_voxels, crop=cropping, min_pad=min_pad,
+                               canonical_sizes=canonical_sizes)
+
+    # network returning posteriors, only built if some subjects cannot be processed with compact outputs
+    full_net = [None]
+
+    def get_full_network():
+        if full_net[0] is None:
+            full_net[0] = get_network(**dict(build_kwargs, compact_outputs=False))
+        return full_net[0]
+
+    def run_network(network, image, pad_indices, compact):
+        inputs = [image]
+        if do_qc:
+            inputs.append(np.stack([np.array(image.shape[1:-1])] * image.shape[0], axis=0))
+        if compact:
+            inputs.append(np.stack(pad_indices, axis=0).astype('int32'))
+        outputs = network.predict(inputs if len(inputs) > 1 else image, batch_size=image.shape[0])
+        outputs = outputs if isinstance(outputs, list) else [outputs]
+        qc_score = outputs.pop() if do_qc else None
+        return outputs, qc_score
+
+    # define the three stages of the pipeline: reading/preprocessing, prediction, and postprocessing/writing
+    def read_batch(batch):
+        preprocessed = list()
+        for i in batch:
             try:
+                if path_manifest is not None:
+                    input_records[i] = get_file_record(path_images[i])
+                preprocessed.append((i, preprocess(path_image=path_images[i],
+                                                   ct=ct,
+                                                   crop=cropping,
+                                                   min_pad=min_pad,
+                                                   path_resample=path_resampled[i],
+                                                   profiler=profiler,
+                                                   auto_crop_margin=auto_crop_margin,
+                                                   canonical_sizes=canonical_sizes,
+                                                   n_threads=n_threads), None))
+            except Exception:
+                preprocessed.append((i, None, traceback.format_exc()))
+        return preprocessed
+
+    def predict_batch(batch, preprocessed):
+
+        # regroup images by their actual shape (predicted shapes can be off for unusual headers)
+        predictions = dict()
+        groups = dict()
+        for i, inputs, error in preprocessed:
+            if error is None:
+                groups.setdefault(inputs[0].shape, list()).append((i, inputs))
+            else:
+                predictions[i] = (None, error)
 
-                # preprocessing
-                image, aff, h, im_res, shape, pad_idx, crop_idx = preprocess(path_image=path_images[i],
-                                                                             ct=ct,
-                                                                             crop=cropping,
-                                                                             min_pad=min_pad,
-                                                                             path_resample=path_resampled[i])
-
-                # prediction
-                shape_input = utils.add_axis(np.array(image.shape[1:-1]))
-                if do_parcellation & do_qc:
-                    post_patch_segmentation, post_patch_parcellation, qc_score = net.predict([image, shape_input])
-                elif do_parcellation & (not do_qc):
-                    post_patch_segmentation, post_patch_parcellation = net.predict(image)
+        for group in groups.values():
+            try:
+                for _ in group:
+                    if verbose:
+                        loop_info.update(n_predicted[0])
+                    n_predicted[0] += 1
+                for i, _ in group:
+                    profiler.start(path_images[i])
+                image = np.concatenate([inputs[0] for _, inputs in group], axis=0)
+                pad_indices = [inputs[5] for _, inputs in group]
+                if tile_shape is not None:
+                    outputs = predict_tiled(net, image, tile_shape, tile_overlap, tile_blending)
                     qc_score = None
-                elif (not do_parcellation) & do_qc:
-                    post_patch_segmentation, qc_score = net.predict([image, shape_input])
-                    post_patch_parcellation = None
                 else:
-                    post_patch_segmentation = net.predict(image)
-                    post_patch_parcellation = qc_score = None
-
-                # postprocessing
-                seg, posteriors, volumes = postprocess(post_patch_seg=post_patch_segmentation,
-                                                       post_patch_parc=post_patch_parcellation,
-                                                       shape=shape,
-                                                       pad_idx=pad_idx,
-                                                       crop_idx=crop_idx,
-                                                       labels_segmentation=labels_segmentation,
-                                                       labels_parcellation=labels_parcellation,
-                                                       aff=aff,
-                                                       im_res=im_res,
-                                                       fast=fast,
-                                                       topology_classes=topology_classes,
-                                                       v1=v1)
-
-                # write predictions to disc
-                utils.save_volume(seg, aff, h, path_segmentations[i], dtype='int32')
-                if path_posteriors[i] is not None:
-                    utils.save_volume(posteriors, aff, h, path_posteriors[i], dtype='float32')
+                    outputs, qc_score = run_network(net, image, pad_indices, build_kwargs['compact_outputs'])
+
+                # get posteriors, or compact outputs (posteriors are recomputed if the brain mask is not connected)
+                post_seg = [None] * len(group)
+                post_parc = [None] * len(group)
+                if build_kwargs['compact_outputs']:
+                    compact = [get_compact_outputs(outputs, j, pad_indices[j], do_parcellation)
+                               for j in range(len(group))]
+                    for i, _ in group:
+                        profiler.lap(path_images[i], 'predict', batch_size=len(group))
+                    redo = [j for j in range(len(group)) if compact[j] is None]
+                    n_compact_fallbacks[0] += len(redo)
+                    if len(redo) > 0:
+                        outputs, _ = run_network(get_full_network(), image[redo], None, False)
+                        for k, j in enumerate(redo):
+                            post_seg[j] = outputs[0][k:k + 1]
+                            post_parc[j] = outputs[1][k:k + 1] if do_parcellation else None
+                            profiler.lap(path_images[group[j][0]], 'predict_again', batch_size=len(redo))
+                else:
+                    compact = [None] * len(group)
+                    for j in range(len(group)):
+                        post_seg[j] = outputs[0][j:j + 1]
+                        post_parc[j] = outputs[1][j:j + 1] if do_parcellation else None
+                    for i, _ in group:
+                        profiler.lap(path_images[i], 'predict', batch_size=len(group))
+                del image, outputs
+                for j, (i, inputs) in enumerate(group):
+                    predictions[i] = ((inputs[1:],
+                                       post_seg[j],
+                                       post_parc[j],
+                                       qc_score[j] if qc_score is not None else None,
+                                       compact[j]), None)
+            except Exception:
+                for i, _ in group:
+                    predictions[i] = (None, traceback.format_exc())
+
+        return [(i, *predictions[i]) for i in batch]
+
+    def write_batch(batch, predictions):
+        results = list()
+        for i, outputs, error in predictions:
+            if error is None:
+                try:
+                    results.append((i, write_subject(i, *outputs), None))
+                except Exception:
+                    results.append((i, None, traceback.format_exc()))
+            else:
+                results.append((i, None, error))
+        return results
+
+    def write_subject(i, preprocessing_info, post_patch_segmentation, post_patch_parcellation, qc_score, compact):
+        aff, h, im_res, shape, pad_idx, crop_idx = preprocessing_info
+        profiler.start(path_images[i])
+
+        # postprocessing
+        if compact is not None:
+            seg, posteriors, volumes = postprocess_compact(*compact,
+                                                           shape=shape,
+                                                           crop_idx=crop_idx,
+                                                           labels_segmentation=labels_segmentation,
+                                                           aff=aff,
+                                                           im_res=im_res,
+                                                           v1=v1)
+        else:
+            seg, posteriors, volumes = postprocess(post_patch_seg=post_patch_segmentation,
+                                                   post_patch_parc=post_patch_parcellation,
+                                                   shape=shape,
+                                                   pad_idx=pad_idx,
+                                                   crop_idx=crop_idx,
+                                                   labels_segmentation=labels_segmentation,
+                                                   labels_parcellation=labels_parcellation,
+                                                   aff=aff,
+                                                   im_res=im_res,
+                                                   fast=fast,
+                                                   topology_classes=topology_classes,
+                                                   v1=v1,
+                                                   return_posteriors=path_posteriors[i] is not None)
+        profiler.lap(path_images[i], 'postprocess')
+
+        # write predictions to disc
+        utils.save_volume(seg, aff, h, path_segmentations[i], dtype=seg_dtype, compression_level=compression_level,
+                          n_threads=compression_threads)
+        if path_posteriors[i] is not None:
+            utils.save_posteriors(posteriors, aff, h, path_posteriors[i], posteriors_format, labels_segmentation,
+                                  posteriors_top_k, compression_level=compression_level, n_threads=compression_threads)
+        profiler.lap(path_images[i], 'save')
+
+        # hash outputs for the manifest here, so that this is done by the writing threads if any
+        if path_manifest is not None:
+            output_records = {path: get_file_record(path) for path in path_outputs[i]}
+            profiler.lap(path_images[i], 'hash')
+        else:
+            output_records = None
+
+        return volumes, qc_score, output_records
+
+    def write_rows(i, outputs, error):
+        if error is None:
+            try:
+                volumes, qc_score, output_records = outputs
+                profiler.start(path_images[i])
 
                 # write volumes to disc if necessary
                 if path_volumes[i] is not None:
@@ -208,18 +421,70 @@ def predict(path_images,
 
                 # write QC scores to disc if necessary
                 if path_qc_scores[i] is not None:
-                    qc_score = np.around(np.clip(np.squeeze(qc_score)[1:], 0, 1), 4)
-                    row = [os.path.basename(path_images[i]).replace('.nii.gz', '')] + ['%.4f' % q for q in qc_score]
+                    qc_row = np.around(np.clip(np.squeeze(qc_score)[1:], 0, 1), 4)  # the manifest keeps raw scores
+                    row = [os.path.basename(path_images[i]).replace('.nii.gz', '')] + ['%.4f' % q for q in qc_row]
                     write_csv(path_qc_scores[i], row, unique_qc_file, labels_qc, names_qc)
-
-            except Exception as e:
-                list_errors.append(path_images[i])
-                print('\nthe following problem occurred with image %s :' % path_images[i])
-                print(traceback.format_exc())
-                print('resuming program execution\n')
-                continue
+                profiler.lap(path_images[i], 'csv')
+
+                # record subject in manifest once all its outputs have been written
+                if (path_manifest is not None) & compute[i]:
+                    manifest[path_images[i]] = {
+                        'subject': path_images[i],
+                        'input': input_records[i],
+                        'options_hash': options_hash,
+                        'outputs': output_records,
+                        'volumes': volumes.tolist(),
+                        'qc_scores': np.squeeze(qc_score).tolist() if qc_score is not None else None}
+                    append_to_manifest(path_manifest, manifest[path_images[i]])
+                    n_manifest_lines[0] += 1
+                    profiler.lap(path_images[i], 'manifest')
+
+            except Exception:
+                error = traceback.format_exc()
+
+        if error is not None:
+            list_errors.append(path_images[i])
+            print('\nthe following problem occurred with image %s :' % path_images[i])
+            print(error)
+            print('resuming program execution\n')
+
+    # perform segmentation (compute segmentation only if needed)
+    if len(list_subjects) <= 10:
+        loop_info = utils.LoopInfo(len(list_subjects), 1, 'predicting', True)
+    else:
+        loop_info = utils.LoopInfo(len(list_subjects), 10, 'predicting', True)
+    n_predicted = [0]
+    n_compact_fallbacks = [0]
+    list_errors = list()
+    list_row_subjects = [i for i in range(len(path_images)) if compute[i] | (i in finished_subjects)]
+    n_written_rows = 0
+    pipeline = utils.run_pipeline(list_batches, read_batch, predict_batch, write_batch, n_prefetch, n_writers)
+    pipeline = itertools.chain([(list(), list(), None)], pipeline)  # first iteration only writes up-to-date subjects
+    for batch, results, batch_error in pipeline:
+        if batch_error is not None:
+            results = [(i, None, batch_error) for i in batch]
+        for i, outputs, error in results:
+            finished_subjects[i] = (outputs, error)
+
+        # csv rows are written here to keep the same order as the inputs, even if subjects are processed in batches
+        while (n_written_rows < len(list_row_subjects)) and (list_row_subjects[n_written_rows] in finished_subjects):
+            i = list_row_subjects[n_written_rows]
+            write_rows(i, *finished_subjects.pop(i))
+            n_written_rows += 1
+
+    # rewrite the manifest once at the end, without the older entries of the subjects that were segmented again
+    if path_manifest is not None:
+        if n_manifest_lines[0] > len(manifest):
+            save_manifest(path_manifest, manifest)
 
     # print output info
+    peak_memory = utils.get_peak_memory_usage()
+    if verbose & (peak_memory is not None):
+        print('\npeak memory usage: %.1f MB' % peak_memory)
+    if verbose & build_kwargs['compact_outputs'] & (len(list_subjects) > 0):
+        print('%d/%d subjects had a brain mask with several connected components, and were predicted again with '
+              'posteriors' % (n_compact_fallbacks[0], len(list_subjects)))
+    profiler.print_summary()
     if len(path_segmentations) == 1:  # only one image is processed
         print('\nsegmentation  saved in:    ' + path_segmentations[0])
         if path_posteriors[0] is not None:
@@ -291,11 +556,14 @@ def predict(path_images,
                             verbose=verbose)
 
 
-def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, out_volumes, out_qc, recompute):
+def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, out_volumes, out_qc, recompute,
+                         uncompressed=False, posteriors_format='float32'):
 
     # check inputs
     assert path_images is not None, 'please specify an input file/folder (--i)'
     assert out_seg is not None, 'please specify an output file/folder (--o)'
+    assert posteriors_format in ['float32', 'uint8', 'uint16', 'topk'], \
+        'posteriors_format should be float32, uint8, uint16, or topk, had %s' % posteriors_format
 
     # convert path to absolute paths
     path_images = os.path.abspath(path_images)
@@ -321,6 +589,8 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
                 assert path[-4:] == '.txt', 'if path_images given as text file, so must be %s' % name
                 with open(path, 'r') as ff:
                     path = [line.replace('\n', '') for line in ff.readlines() if line != '\n']
+                if uncompressed:
+                    path = [p.replace('.nii.gz', '.nii') for p in path]
                 recompute_files = [not os.path.isfile(p) for p in path]
             else:
                 path = [None] * len(path_images)
@@ -362,6 +632,8 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
                     path = [p.replace('.nii', '_%s.nii' % suffix) for p in path]
                     path = [p.replace('.mgz', '_%s.mgz' % suffix) for p in path]
                     path = [p.replace('.npz', '_%s.npz' % suffix) for p in path]
+                    if uncompressed:
+                        path = [p.replace('.nii.gz', '.nii') for p in path]
                     recompute_files = [not os.path.isfile(p) for p in path]
                 utils.mkdir(os.path.dirname(path[0]))
             else:
@@ -401,6 +673,8 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
                         file_name = file_name.replace('.mgz', '_%s.mgz' % suffix)
                         file_name = file_name.replace('.npz', '_%s.npz' % suffix)
                         path = os.path.join(path, file_name)
+                    if uncompressed:
+                        path = path.replace('.nii.gz', '.nii')
                     recompute_files = [not os.path.isfile(path)]
                 utils.mkdir(os.path.dirname(path))
             else:
@@ -415,6 +689,11 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
         out_volumes, recompute_volume, unique_volume_file = helper_im(out_volumes, 'path_volumes', 'csv', '')
         out_qc, recompute_qc, unique_qc_file = helper_im(out_qc, 'path_qc_scores', 'csv', '')
 
+    # sparse posteriors are written as npz archives
+    if posteriors_format == 'topk':
+        out_posteriors = [utils.strip_extension(path) + '.npz' if path is not None else None for path in out_posteriors]
+        recompute_post = [(path is not None) and not os.path.isfile(path) for path in out_posteriors]
+
     recompute_list = [recompute | re_seg | re_post | re_res | re_vol | re_qc
                       for (re_seg, re_post, re_res, re_vol, re_qc)
                       in zip(recompute_seg, recompute_post, recompute_resampled, recompute_volume, recompute_qc)]
@@ -423,10 +702,103 @@ def prepare_output_files(path_images, out_seg, out_posteriors, out_resampled, ou
            out_qc, unique_qc_file, recompute_list
 
 
-def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=None, path_resample=None):
-
-    # read image and corresponding info
-    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True)
+def load_manifest(path_manifest):
+    """Load a manifest of segmented subjects, or return an empty one if it does not exist yet.
+    The manifest is a json-lines file, where each line is the entry of a subject, with: the path of its input image,
+    the record of the input image (see get_file_record), the hash of the options/weights used to segment it, the
+    records of all its output files, and its volumes and raw QC scores (so that rows of csv files can be written again
+    without recomputing anything). Entries are appended as subjects are segmented, so that a subject can have several
+    lines, in which case the last one is used. Incomplete lines (e.g. if the program was killed) are ignored.
+    :return: a dictionary with the last entry of each subject, indexed by the path of its input image, and the number of
+    lines of the manifest."""
+    manifest = dict()
+    n_lines = 0
+    if os.path.isfile(path_manifest):
+        with open(path_manifest, 'r') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    manifest[entry['subject']] = entry
+                    n_lines += 1
+                except (ValueError, KeyError, TypeError):
+                    continue
+    return manifest, n_lines
+
+
+def append_to_manifest(path_manifest, entry):
+    """Append the entry of a subject to a manifest, without rewriting the previous entries."""
+    utils.mkdir(os.path.dirname(os.path.abspath(path_manifest)))
+    with open(path_manifest, 'a') as f:
+        f.write(json.dumps(entry) + '\n')
+
+
+def save_manifest(path_manifest, manifest):
+    """Write all the entries of a manifest atomically, so that it is never left half-written if the program is killed.
+    This is used to remove the older entries of the subjects that have several lines."""
+    utils.mkdir(os.path.dirname(os.path.abspath(path_manifest)))
+    path_tmp = path_manifest + '.tmp'
+    with open(path_tmp, 'w') as f:
+        for entry in manifest.values():
+            f.write(json.dumps(entry) + '\n')
+    os.replace(path_tmp, path_manifest)
+
+
+def get_manifest_options_hash(build_kwargs, **postprocessing_options):
+    """Return a hash of the content of the weight files, of all the options of the network, and of all the options that
+    influence the outputs of predict (given as keyword arguments)."""
+    options = {'network': get_model_cache_key(hash_weights=True, **build_kwargs)}
+    for key, value in postprocessing_options.items():
+        options[key] = value.tolist() if isinstance(value, np.ndarray) else value
+    options = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+def get_file_record(path):
+    """Return the hash, size, and modification time of a file, or None if it does not exist."""
+    if not os.path.isfile(path):
+        return None
+    stat = os.stat(path)
+    return {'hash': utils.get_file_hash(path), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+
+def is_file_unchanged(path, record):
+    """Check if a file still has the content given by its record (see get_file_record). The file is only hashed again
+    if its size is the same but its modification time has changed."""
+    if not os.path.isfile(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != record['size']:
+        return False
+    if stat.st_mtime_ns == record['mtime']:
+        return True
+    return utils.get_file_hash(path) == record['hash']
+
+
+def is_up_to_date(entry, path_image, options_hash, path_outputs):
+    """Check if a subject of the manifest was segmented with the same input and options, with the same outputs as the
+    requested ones, and that neither its input nor its outputs have been modified or deleted since."""
+    if entry is None:
+        return False
+    if entry['options_hash'] != options_hash:
+        return False
+    if sorted(entry['outputs'].keys()) != sorted(path_outputs):
+        return False
+    if not is_file_unchanged(path_image, entry['input']):
+        return False
+    for path, record in entry['outputs'].items():
+        if (record is not None) and (not is_file_unchanged(path, record)):
+            return False
+    return True
+
+
+def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=None, path_resample=None, profiler=None,
+               percentile_tolerance=1e-4, auto_crop_margin=None, max_head_extent=200, canonical_sizes=None,
+               n_threads=1):
+
+    # read image and corresponding info (in memory, so that the image is fully read by the prefetching threads if any)
+    profiler = profiler if profiler is not None else utils.Profiler()
+    profiler.start(path_image)
+    im, _, aff, n_dims, n_channels, h, im_res = utils.get_volume_info(path_image, True, dtype='float32', mmap=False)
     if n_dims == 2 and 1 < n_channels < 4:
         raise Exception('either the input is 2D with several channels, or is 3D with at most 3 slices. '
                         'Either way, results are going to be poor...')
@@ -443,46 +815,209 @@ def preprocess(path_image, ct, target_res=1., n_levels=5, crop=None, min_pad=Non
     elif n_channels > 1:
         print('WARNING: detected more than 1 channel, only keeping the first channel.')
         im = im[..., 0]
+    profiler.lap(path_image, 'load')
 
     # resample image if necessary
     target_res = np.squeeze(utils.reformat_to_n_channels_array(target_res, n_dims))
     if np.any((im_res > target_res + 0.05) | (im_res < target_res - 0.05)):
         im_res = target_res
-        im, aff = edit_volumes.resample_volume(im, aff, im_res)
+        im, aff = edit_volumes.resample_volume(im, aff, im_res, n_threads=n_threads)
         if path_resample is not None:
             utils.save_volume(im, aff, h, path_resample)
+    profiler.lap(path_image, 'resample')
 
     # align image
     im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=np.eye(4), n_dims=n_dims, return_copy=False)
     shape = list(im.shape[:n_dims])
+    profiler.lap(path_image, 'align')
 
     # crop image if necessary
     if crop is not None:
         crop = utils.reformat_to_list(crop, length=n_dims, dtype='int')
         crop_shape = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in crop]
         im, crop_idx = edit_volumes.crop_volume(im, cropping_shape=crop_shape, return_crop_idx=True)
+    elif auto_crop_margin is not None:
+        # crop around the head (max_head_extent is in mm), to exclude the neck, shoulders, and background
+        crop_idx = edit_volumes.get_head_bounding_box(im, margin=auto_crop_margin,
+                                                      max_extent=max_head_extent / target_res[2])
+        if crop_idx is not None:
+            im = edit_volumes.crop_volume_with_idx(im, crop_idx, n_dims=n_dims, return_copy=False)
     else:
         crop_idx = None
+    profiler.lap(path_image, 'crop')
 
     # normalise image
     if ct:
         im = np.clip(im, 0, 80)
-    im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5)
+    im = edit_volumes.rescale_volume(im, new_min=0., new_max=1., min_percentile=0.5, max_percentile=99.5,
+                                     percentile_tolerance=percentile_tolerance)
+    profiler.lap(path_image, 'normalise')
 
     # pad image
-    input_shape = im.shape[:n_dims]
-    pad_shape = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in input_shape]
-    min_pad = utils.reformat_to_list(min_pad, length=n_dims, dtype='int')
-    min_pad = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in min_pad]
-    pad_shape = np.maximum(pad_shape, min_pad)
+    pad_shape = get_pad_shape(im.shape[:n_dims], n_levels, min_pad, canonical_sizes)
     im, pad_idx = edit_volumes.pad_volume(im, padding_shape=pad_shape, return_pad_idx=True)
 
     # add batch and channel axes
     im = utils.add_axis(im, axis=[0, -1])
+    profiler.lap(path_image, 'pad')
 
     return im, aff, h, im_res, shape, pad_idx, crop_idx
 
 
+def predict_tiled(net, image, tile_shape, tile_overlap=32, blending='gaussian', n_levels=5):
+    """Run a network on overlapping tiles of an image, and blend the predictions of all tiles. Tiles are given one by
+    one to the network, so that its memory usage only depends on the tile size (blended outputs still have full size).
+    :param net: network to run, which must not take any other input than the image.
+    :param image: input image of shape [batch, x, y, z, channels], where x, y, z are divisible by 2**n_levels.
+    :param tile_shape: shape of the tiles. Can be an int or a sequence of length 3. Each tile dimension is rounded up to
+    the closest multiple of 2**n_levels, and is capped to the image size.
+    :param tile_overlap: (optional) minimum number of overlapping voxels between neighbouring tiles. Can be an int or a
+    sequence of length 3. Default is 32.
+    :param blending: (optional) weighting of the tile predictions, can be 'gaussian' (weights decrease with the distance
+    to the tile centre) or 'linear' (weights linearly decrease in the overlapping regions). Default is 'gaussian'.
+    :param n_levels: (optional) number of levels of the network.
+    :return: a list with the blended outputs of the network, each of shape [batch, x, y, z, channels].
+    """
+
+    # get tile shape and positions
+    image_shape = image.shape[1:-1]
+    tile_shape = utils.reformat_to_list(tile_shape, length=3, dtype='int')
+    tile_shape = [min(utils.find_closest_number_divisible_by_m(t, 2 ** n_levels, 'higher'), s)
+                  for t, s in zip(tile_shape, image_shape)]
+    tile_overlap = utils.reformat_to_list(tile_overlap, length=3, dtype='int')
+    tile_starts = list()
+    for size, tile, overlap in zip(image_shape, tile_shape, tile_overlap):
+        step = max(tile - overlap, 1)
+        tile_starts.append(sorted(set(list(range(0, size - tile, step)) + [size - tile])))
+
+    # build blending weights for a tile
+    weights = list()
+    for tile, overlap in zip(tile_shape, tile_overlap):
+        x = np.arange(tile, dtype='float32')
+        if blending == 'gaussian':
+            sigma = tile / 8
+            weights.append(np.exp(-(x - (tile - 1) / 2) ** 2 / (2 * sigma ** 2)))
+        elif blending == 'linear':
+            weights.append(np.clip(np.minimum(x + 1, tile - x) / (overlap + 1), 0, 1))
+        else:
+            raise Exception('blending should be gaussian or linear, got %s' % blending)
+    weights = np.maximum(np.einsum('i,j,k->ijk', *weights), 1e-6).astype('float32')
+
+    # predict tiles one by one and accumulate weighted predictions
+    outputs = None
+    sum_weights = np.zeros(image_shape, dtype='float32')
+    for start in itertools.product(*tile_starts):
+        tile_idx = tuple([slice(s, s + t) for s, t in zip(start, tile_shape)])
+        tile_outputs = net.predict(image[(slice(None),) + tile_idx], batch_size=image.shape[0])
+        tile_outputs = tile_outputs if isinstance(tile_outputs, list) else [tile_outputs]
+        if outputs is None:
+            outputs = [np.zeros([image.shape[0], *image_shape, o.shape[-1]], dtype='float32') for o in tile_outputs]
+        for output, tile_output in zip(outputs, tile_outputs):
+            output[(slice(None),) + tile_idx] += tile_output * weights[np.newaxis, ..., np.newaxis]
+        sum_weights[tile_idx] += weights
+
+    # normalise predictions
+    for output in outputs:
+        output /= sum_weights[np.newaxis, ..., np.newaxis]
+
+    return outputs
+
+
+def get_padded_shape(path_image, target_res=1., n_levels=5, crop=None, min_pad=None, canonical_sizes=None):
+    """Predict the shape of the image returned by preprocess, by only reading the header of path_image.
+    Returns None if the shape cannot be predicted (e.g. for inputs that are not 3D)."""
+
+    # read header info in the orientation of the preprocessed image
+    shape, _, n_dims, _, _, im_res = utils.get_volume_info(path_image, aff_ref=np.eye(4))
+    if n_dims != 3:
+        return None
+
+    # resampling
+    target_res = np.squeeze(utils.reformat_to_n_channels_array(target_res, n_dims))
+    if np.any((im_res > target_res + 0.05) | (im_res < target_res - 0.05)):
+        shape = np.ceil(np.array(shape) * im_res / target_res).astype('int')
+
+    # cropping and padding
+    if crop is not None:
+        crop = utils.reformat_to_list(crop, length=n_dims, dtype='int')
+        crop_shape = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in crop]
+        shape = np.minimum(shape, crop_shape)
+
+    return tuple(int(s) for s in get_pad_shape(shape, n_levels, min_pad, canonical_sizes))
+
+
+def get_pad_shape(shape, n_levels=5, min_pad=None, canonical_sizes=None):
+    """Get the shape to which an image is padded before being fed to the network. Each axis is padded to the closest
+    size divisible by 2**n_levels, which is at least equal to min_pad.
+    If canonical_sizes is given, sizes are further rounded up to a small set of canonical sizes, so that images of
+    different shapes are fed to the network with the same shape. This enables tensorflow to reuse the kernels and
+    memory it prepares for each new input shape, and to batch more images together (see get_batches).
+    :param shape: shape of the image (without batch and channel axes).
+    :param n_levels: (optional) number of levels of the UNet. Default is 5.
+    :param min_pad: (optional) minimum padded shape. Can be a number or a sequence.
+    :param canonical_sizes: (optional) either a number, in which case sizes are rounded up to multiples of this number
+    (which must be divisible by 2**n_levels), or a list of sizes, in which case sizes are rounded up to the closest size
+    of the list. Sizes above the largest canonical size are only rounded to multiples of 2**n_levels.
+    :return: the padded shape, as a numpy array.
+    """
+    n_dims = len(shape)
+    pad_shape = [utils.find_closest_number_divisible_by_m(int(s), 2 ** n_levels, 'higher') for s in shape]
+    if min_pad is not None:
+        min_pad = utils.reformat_to_list(min_pad, length=n_dims, dtype='int')
+        min_pad = [utils.find_closest_number_divisible_by_m(s, 2 ** n_levels, 'higher') for s in min_pad]
+        pad_shape = np.maximum(pad_shape, min_pad)
+    if canonical_sizes is not None:
+        if isinstance(canonical_sizes, (int, float)):
+            assert canonical_sizes % 2 ** n_levels == 0, \
+                'canonical_sizes should be divisible by %s, had %s' % (2 ** n_levels, canonical_sizes)
+            pad_shape = [utils.find_closest_number_divisible_by_m(int(s), int(canonical_sizes), 'higher')
+                         for s in pad_shape]
+        else:
+            canonical_sizes = np.sort(np.array(utils.reformat_to_list(canonical_sizes, dtype='int')))
+            assert np.all(canonical_sizes % 2 ** n_levels == 0), \
+                'canonical_sizes should all be divisible by %s, had %s' % (2 ** n_levels, canonical_sizes)
+            pad_shape = [canonical_sizes[np.argmax(canonical_sizes >= s)] if s <= canonical_sizes[-1] else s
+                         for s in pad_shape]
+    return np.array(pad_shape, dtype='int')
+
+
+def get_batches(path_images, list_subjects, batch_size=1, max_batch_voxels=None, crop=None, min_pad=None,
+                canonical_sizes=None):
+    """Group subjects in batches of images that will have the same shape after preprocessing.
+    :param path_images: list of paths of all input images.
+    :param list_subjects: indices of the subjects to segment.
+    :param batch_size: (optional) maximum number of images per batch. Default is 1, where subjects are returned one by
+    one in their original order.
+    :param max_batch_voxels: (optional) maximum number of voxels in a batch (i.e. batch size times the number of voxels
+    of the padded images), which is used as a proxy to limit the memory used by the network. Default is None.
+    :param crop: (optional) cropping used in preprocess.
+    :param min_pad: (optional) minimum padding used in preprocess.
+    :param canonical_sizes: (optional) canonical sizes used in preprocess.
+    :return: a list of batches, each batch being a list of subject indices.
+    """
+    if batch_size <= 1:
+        return [[i] for i in list_subjects]
+
+    # group subjects by padded shape, subjects with unknown shape are processed separately
+    groups = dict()
+    for i in list_subjects:
+        try:
+            shape = get_padded_shape(path_images[i], crop=crop, min_pad=min_pad, canonical_sizes=canonical_sizes)
+        except Exception:
+            shape = None
+        groups.setdefault(shape if shape is not None else i, list()).append(i)
+
+    # split groups into batches
+    list_batches = list()
+    for shape, group in groups.items():
+        n = batch_size
+        if (max_batch_voxels is not None) & isinstance(shape, tuple):
+            n = int(max(min(batch_size, max_batch_voxels // np.prod(shape)), 1))
+        list_batches += [group[j:j + n] for j in range(0, len(group), n)]
+
+    return list_batches
+
+
 def build_model(path_model_segmentation,
                 path_model_parcellation,
                 path_model_qc,
@@ -495,9 +1030,18 @@ def build_model(path_model_segmentation,
                 flip_indices,
                 robust,
                 do_parcellation,
-                do_qc):
-
-    assert os.path.isfile(path_model_segmentation), "The provided model path does not exist."
+                do_qc,
+                compact_outputs=False,
+                parcellation_margin=None):
+    """Build the SynthSeg network. If a model path is None, the corresponding network keeps its random initialisation,
+    which is only useful for testing/benchmarking purposes.
+    If compact_outputs is True, the network takes the padding indices of each image as an additional (last) input, and
+    returns the label map, the brain mask, and the soft volumes (see CompactOutputs) instead of the posteriors.
+    If parcellation_margin is not None, the parcellation network only runs on the bounding box of the predicted cortex,
+    expanded by this margin (in voxels), and its posteriors are set to background outside of it (see CropAroundMask)."""
+
+    assert (path_model_segmentation is None) or os.path.isfile(path_model_segmentation), \
+        "The provided model path does not exist."
 
     # get labels
     n_labels_seg = len(labels_segmentation)
@@ -559,7 +1103,8 @@ def build_model(path_model_segmentation,
                               activation='elu',
                               batch_norm=-1,
                               name='unet2')
-        net.load_weights(path_model_segmentation, by_name=True)
+        if path_model_segmentation is not None:
+            net.load_weights(path_model_segmentation, by_name=True)
         name_segm_prediction_layer = 'unet2_prediction'
 
     else:
@@ -575,7 +1120,8 @@ def build_model(path_model_segmentation,
                               activation='elu',
                               batch_norm=-1,
                               name='unet')
-        net.load_weights(path_model_segmentation, by_name=True)
+        if path_model_segmentation is not None:
+            net.load_weights(path_model_segmentation, by_name=True)
         input_image = net.inputs[0]
         name_segm_prediction_layer = 'unet_prediction'
 
@@ -588,20 +1134,15 @@ def build_model(path_model_segmentation,
 
         if flip_indices is not None:
 
-            # segment flipped image
-            seg = net.output
-            image_flipped = layers.RandomFlip(axis=0, prob=1)(input_image)
-            last_tensor = net(image_flipped)
+            # segment image and its flipped version in a single pass, by stacking them along the batch axis
+            last_tensor = KL.Lambda(lambda x: tf.concat([x, tf.reverse(x, axis=[1])], axis=0),
+                                    name='stack_flip')(input_image)
+            last_tensor = net(last_tensor)
 
-            # flip back and re-order channels
-            last_tensor = layers.RandomFlip(axis=0, prob=1)(last_tensor)
-            last_tensor = KL.Lambda(lambda x: tf.split(x, [1] * n_labels_seg, axis=-1), name='split')(last_tensor)
-            reordered_channels = [last_tensor[flip_indices[i]] for i in range(n_labels_seg)]
-            last_tensor = KL.Lambda(lambda x: tf.concat(x, -1), name='concat')(reordered_channels)
-
-            # average two segmentations and build model
+            # flip back the second half of the batch, re-order its channels with a single gather, and average
             name_segm_prediction_layer = 'average_lr'
-            last_tensor = KL.Lambda(lambda x: 0.5 * (x[0] + x[1]), name=name_segm_prediction_layer)([seg, last_tensor])
+            last_tensor = KL.Lambda(lambda x: average_flipped_predictions(x, flip_indices),
+                                    name=name_segm_prediction_layer)(last_tensor)
             net = Model(inputs=net.inputs, outputs=last_tensor)
 
     # add aparc segmenter if needed
@@ -616,6 +1157,11 @@ def build_model(path_model_segmentation,
         last_tensor = layers.ConvertLabels(labels_segmentation, parcellation_masking_values)(last_tensor)
         last_tensor = KL.Lambda(lambda x: tf.one_hot(tf.cast(x, 'int32'), depth=2, axis=-1))(last_tensor)
         last_tensor = KL.Lambda(lambda x: tf.cast(tf.concat(x, axis=-1), 'float32'))([input_image, last_tensor])
+
+        # only parcellate a box around the cortex if necessary
+        if parcellation_margin is not None:
+            parcellation_input = last_tensor
+            last_tensor, crop_start = CropAroundMask(parcellation_margin, name='parc_crop')(last_tensor)
         net = Model(inputs=net.inputs, outputs=last_tensor)
 
         # build UNet
@@ -630,12 +1176,20 @@ def build_model(path_model_segmentation,
                               activation='elu',
                               batch_norm=-1,
                               name='unet_parc')
-        net.load_weights(path_model_parcellation, by_name=True)
+        if path_model_parcellation is not None:
+            net.load_weights(path_model_parcellation, by_name=True)
 
         # smooth predictions
         last_tensor = net.output
         last_tensor._keras_shape = tuple(last_tensor.get_shape().as_list())
         last_tensor = layers.GaussianBlur(sigma=0.5)(last_tensor)
+        name_parc_prediction_layer = 'unet_parc_prediction'
+
+        # paste parcellation back into the whole volume if necessary
+        if parcellation_margin is not None:
+            name_parc_prediction_layer = 'parc_uncrop'
+            last_tensor = UncropWithBackground(name=name_parc_prediction_layer)([last_tensor, crop_start,
+                                                                                 parcellation_input])
         net = Model(inputs=net.inputs, outputs=[net.get_layer(name_segm_prediction_layer).output, last_tensor])
 
     # add CNN regressor for automated QC if needed
@@ -676,85 +1230,494 @@ def build_model(path_model_segmentation,
         # build model
         if do_parcellation:
             outputs = [net.get_layer(name_segm_prediction_layer).output,
-                       net.get_layer('unet_parc_prediction').output,
+                       net.get_layer(name_parc_prediction_layer).output,
                        last_tensor]
         else:
             outputs = [net.get_layer(name_segm_prediction_layer).output, last_tensor]
         net = Model(inputs=net.inputs, outputs=outputs)
-        net.load_weights(path_model_qc, by_name=True)
+        if path_model_qc is not None:
+            net.load_weights(path_model_qc, by_name=True)
+
+    # reduce posteriors inside the network, so that only compact tensors are copied out of it
+    if compact_outputs:
+        pad_idx = KL.Input([6], dtype='int32')
+        posteriors = net.outputs[:2] if do_parcellation else net.outputs[:1]
+        last_tensors = CompactOutputs(labels_segmentation, labels_parcellation if do_parcellation else None,
+                                      name='compact_outputs')([*posteriors, pad_idx])
+        net = Model(inputs=[*net.inputs, pad_idx], outputs=[*last_tensors, *net.outputs[len(posteriors):]])
 
     return net
 
 
-def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
-                labels_segmentation, labels_parcellation, aff, im_res, fast, topology_classes, v1):
+def get_model_cache_key(hash_weights=True, **build_kwargs):
+    """Return a key identifying the network built by build_model with the given arguments. The key depends on the
+    content of the used weight files (or only on their path if hash_weights is False), on all the other options, on
+    the tensorflow version, and on the version of the graphs built by build_model (see MODEL_CACHE_VERSION)."""
+    used_models = {'path_model_segmentation': True,
+                   'path_model_parcellation': build_kwargs['do_parcellation'],
+                   'path_model_qc': build_kwargs['do_qc']}
+    options = {'tensorflow': tf.__version__, 'version': MODEL_CACHE_VERSION}
+    for key, value in build_kwargs.items():
+        if key in used_models:
+            if not used_models[key]:
+                value = None
+            elif hash_weights:
+                value = utils.get_file_hash(value)
+        elif isinstance(value, np.ndarray):
+            value = value.tolist()
+        options[key] = value
+    options = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+def load_model_from_cache(path_model_cache, **build_kwargs):
+    """Load the network built by build_model from an on-disk cache of frozen graphs. If the network is not in the cache
+    yet, it is built and frozen in a separate process (because freezing requires graph mode), and then loaded.
+    If caching fails, we fall back to build_model.
+    :param path_model_cache: path of the directory where the frozen networks are stored.
+    :param build_kwargs: all the arguments of build_model.
+    :return: a FrozenModel (or a keras model if caching failed), both of which have the same predict method.
+    """
+
+    # export model if it is not already cached
+    path_frozen_model = os.path.join(path_model_cache, get_model_cache_key(**build_kwargs))
+    if not os.path.isdir(path_frozen_model):
+        print('network not found in cache, building and caching it in ' + path_frozen_model)
+        utils.mkdir(path_model_cache)
+        path_build_kwargs = path_frozen_model + '_%s.pkl' % os.getpid()
+        utils.write_pickle(path_build_kwargs, build_kwargs)
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                             env.get('PYTHONPATH', '')])
+        code = 'from SynthSeg.predict_synthseg import export_frozen_model; export_frozen_model(%r, %r)' \
+               % (path_frozen_model, path_build_kwargs)
+        subprocess.run([sys.executable, '-c', code], env=env)
+        os.remove(path_build_kwargs)
+
+    # load frozen model
+    if os.path.isdir(path_frozen_model):
+        return FrozenModel(path_frozen_model)
+    else:
+        print('WARNING: could not cache the network, building it instead.')
+        return build_model(**build_kwargs)
+
+
+def export_frozen_model(path_frozen_model, path_build_kwargs):
+    """Build the network in graph mode with the arguments pickled in path_build_kwargs, and save it as a frozen graph
+    in the folder path_frozen_model. As it disables eager execution, this should be run in a separate process."""
+
+    # build network in graph mode
+    tf.compat.v1.disable_eager_execution()
+    net = build_model(**utils.read_pickle(path_build_kwargs))
+
+    # replace variables by constants
+    sess = tf.compat.v1.keras.backend.get_session()
+    output_names = [tensor.op.name for tensor in net.outputs]
+    graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(sess, sess.graph.as_graph_def(), output_names)
+
+    # write graph and the names of its inputs/outputs in a temporary folder, which is then renamed in one go
+    tmp_dir = path_frozen_model + '_tmp_%s' % os.getpid()
+    utils.mkdir(tmp_dir)
+    tf.io.write_graph(graph_def, tmp_dir, 'model.pb', as_text=False)
+    info = {'inputs': [tensor.name for tensor in net.inputs],
+            'input_dtypes': [tensor.dtype.name for tensor in net.inputs],
+            'outputs': [tensor.name for tensor in net.outputs]}
+    with open(os.path.join(tmp_dir, 'model.json'), 'w') as f:
+        json.dump(info, f)
+    try:
+        os.rename(tmp_dir, path_frozen_model)
+    except OSError:  # the same network has been cached by another process in the meantime
+        for filename in os.listdir(tmp_dir):
+            os.remove(os.path.join(tmp_dir, filename))
+        os.rmdir(tmp_dir)
+
+
+class FrozenModel:
+    """Inference-ready network loaded from a frozen graph saved by export_frozen_model.
+    It has the same predict method as the keras model it comes from."""
+
+    def __init__(self, path_frozen_model):
+
+        # read graph and inputs/outputs info
+        with open(os.path.join(path_frozen_model, 'model.json'), 'r') as f:
+            info = json.load(f)
+        graph_def = tf.compat.v1.GraphDef()
+        with open(os.path.join(path_frozen_model, 'model.pb'), 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        self.input_dtypes = info['input_dtypes']
+        self.n_outputs = len(info['outputs'])
+
+        # wrap graph into a function
+        def import_graph_def():
+            tf.compat.v1.import_graph_def(graph_def, name='')
+        wrapped_import = tf.compat.v1.wrap_function(import_graph_def, [])
+        graph = wrapped_import.graph
+        self.function = wrapped_import.prune([graph.as_graph_element(name) for name in info['inputs']],
+                                             [graph.as_graph_element(name) for name in info['outputs']])
+
+    def predict(self, inputs, batch_size=None):
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        inputs = [tf.constant(x, dtype=dtype) for x, dtype in zip(inputs, self.input_dtypes)]
+        outputs = [output.numpy() for output in self.function(*inputs)]
+        return outputs[0] if self.n_outputs == 1 else outputs
+
+
+class LeanModel:
+    """Inference-only executor of a keras model, with the same predict method. Layers are run one at a time (in the same
+    order as in keras), and each intermediate tensor is released as soon as all the layers using it have been run.
+    Chains of local layers (convolutions, batch normalisations, activations, poolings, upsamplings, concatenations, and
+    additions), where each intermediate tensor is only used by the next layer of the chain, are fused into a single
+    step, so that these intermediate tensors are never kept longer than needed. If slab_size is given, these chains are
+    also run on slabs of slab_size voxels along the first spatial axis (with enough overlap to obtain exactly the same
+    results as on the whole image), so that their intermediate tensors are never computed on the whole image. This
+    greatly reduces the peak memory at the highest-resolution levels of UNets, where the concatenated skip connections
+    and the features of the decoder are the largest tensors of the network.
+    This walks the internal graph of keras models (nodes and their tensors), so it only supports keras 2.3."""
+
+    def __init__(self, model, slab_size=None):
+        """
+        :param model: keras model to run.
+        :param slab_size: (optional) size of the slabs (in voxels along the first spatial axis) in which local layers
+        are run. Default is None, where all layers are run on whole images.
+        """
+        if not keras.__version__.startswith('2.3.'):
+            raise Exception('the lean mode relies on the internals of keras 2.3 (see requirements), but keras %s is '
+                            'installed. Please run without the lean mode.' % keras.__version__)
+        self.slab_size = slab_size
+        self.input_ids = [id(tensor) for tensor in model.inputs]
+        self.output_ids = [id(tensor) for tensor in model.outputs]
+        self.steps = get_lean_steps(model)
+        self.functions = dict()
+        self.sub_models = {i: LeanModel(step['nodes'][0].outbound_layer, slab_size)
+                           for i, step in enumerate(self.steps) if step['kind'] == 'model'}
+
+        # count the number of steps using each tensor (outputs of the model are used once more, so they are never freed)
+        self.n_consumers = {tensor_id: 1 for tensor_id in self.output_ids}
+        for step in self.steps:
+            for tensor_id in step['inputs']:
+                self.n_consumers[tensor_id] = self.n_consumers.get(tensor_id, 0) + 1
+
+    def predict(self, inputs, batch_size=None):
+        inputs = inputs if isinstance(inputs, list) else [inputs]
+        values = {tensor_id: x for tensor_id, x in zip(self.input_ids, inputs)}
+        n_remaining = dict(self.n_consumers)
+        for i, step in enumerate(self.steps):
+
+            # run step
+            step_inputs = [values[tensor_id] for tensor_id in step['inputs']]
+            if step['kind'] == 'model':
+                step_outputs = self.sub_models[i].predict(step_inputs)
+                step_outputs = step_outputs if isinstance(step_outputs, list) else [step_outputs]
+            elif (step['kind'] == 'local') & (self.slab_size is not None):
+                step_outputs = [self.run_in_slabs(i, step_inputs)]
+            else:
+                step_outputs = self.get_function(i)(step_inputs)
+            del step_inputs
+
+            # store outputs, and release all the tensors that are not needed anymore
+            for tensor_id, x in zip(step['outputs'], step_outputs):
+                if n_remaining.get(tensor_id, 0) > 0:
+                    values[tensor_id] = x
+            del step_outputs
+            for tensor_id in step['inputs']:
+                n_remaining[tensor_id] -= 1
+                if n_remaining[tensor_id] == 0:
+                    del values[tensor_id]
+
+        outputs = [values[tensor_id] for tensor_id in self.output_ids]
+        return outputs[0] if len(outputs) == 1 else outputs
+
+    def get_function(self, i):
+        """Build (only once) a keras function running the layers of the i-th step, by calling them on new inputs."""
+        from keras.utils.generic_utils import has_arg
+        if i not in self.functions:
+            step = self.steps[i]
+            tensors = {tensor_id: KL.Input(batch_shape=K.int_shape(tensor), dtype=K.dtype(tensor))
+                       for tensor_id, tensor in zip(step['inputs'], step['input_tensors'])}
+            inputs = [tensors[tensor_id] for tensor_id in step['inputs']]
+            for node in step['nodes']:
+                layer = node.outbound_layer
+                layer_inputs = [tensors[id(tensor)] for tensor in node.input_tensors]
+                kwargs = dict(node.arguments) if node.arguments else dict()
+                if has_arg(layer.call, 'training'):
+                    kwargs['training'] = False
+                layer_outputs = layer(layer_inputs[0] if len(layer_inputs) == 1 else layer_inputs, **kwargs)
+                layer_outputs = layer_outputs if isinstance(layer_outputs, list) else [layer_outputs]
+                for tensor, output in zip(node.output_tensors, layer_outputs):
+                    tensors[id(tensor)] = output
+            self.functions[i] = K.function(inputs, [tensors[tensor_id] for tensor_id in step['outputs']])
+        return self.functions[i]
+
+    def run_in_slabs(self, i, inputs):
+        """Run a chain of local layers (i-th step) on slabs along the first spatial axis. Each slab is extended by a
+        halo on both sides, so that it includes the whole receptive field of its outputs, and is cropped afterwards."""
+        step = self.steps[i]
+
+        # the size of the output (along the slab axis) should match the sizes of all the inputs given their scales
+        size = inputs[0].shape[1] / step['scales'][0]
+        multiple = step['multiple']
+        if any(x.shape[1] != size * scale for x, scale in zip(inputs, step['scales'])) | (size % multiple != 0) | \
+                (size <= self.slab_size):
+            return self.get_function(i)(inputs)[0]
+        size = int(size)
+
+        # run slabs (boundaries are multiples of the largest downsampling factor, so that inputs of all scales align)
+        slab_size = utils.find_closest_number_divisible_by_m(self.slab_size, multiple, 'higher')
+        halo = utils.find_closest_number_divisible_by_m(step['halo'], multiple, 'higher')
+        output = None
+        for start in range(0, size, slab_size):
+            end = min(start + slab_size, size)
+            first, last = max(start - halo, 0), min(end + halo, size)
+            slab = [x[:, int(first * scale):int(last * scale), ...] for x, scale in zip(inputs, step['scales'])]
+            slab = self.get_function(i)(slab)[0]
+            if output is None:
+                output = np.zeros((slab.shape[0], size, *slab.shape[2:]), dtype=slab.dtype)
+            output[:, start:end, ...] = slab[:, start - first:end - first, ...]
+        return output
+
+
+def get_lean_steps(model):
+    """Split a keras model in the steps run by LeanModel. Each step is either a nested model (which is run by its own
+    LeanModel), a fused chain of local layers (see get_local_layer_info), or a single other layer. Steps are returned in
+    an order where all their inputs have been computed by previous steps. Each step is a dictionary with the nodes of
+    its layers, the ids of its input/output tensors, and for chains of local layers, the scale of each input relative to
+    the output, the size of the halo needed around slabs (at the output scale), and the number that slab boundaries
+    must be divisible by."""
+
+    # get all the nodes in the order where keras runs them (input layers are skipped)
+    nodes = list()
+    for depth in sorted(model._nodes_by_depth.keys(), reverse=True):
+        nodes += [node for node in model._nodes_by_depth[depth]
+                  if node.outbound_layer.__class__.__name__ != 'InputLayer']
+
+    # count how many layers use each tensor
+    n_consumers = {id(tensor): 1 for tensor in model.outputs}
+    for node in nodes:
+        for tensor in node.input_tensors:
+            n_consumers[id(tensor)] = n_consumers.get(id(tensor), 0) + 1
+
+    # group nodes into steps: a local layer joins the chain of one of its inputs if it is the only one to use it, except
+    # for poolings and upsamplings which always start a new chain (chains spanning several resolutions would need halos
+    # growing with the downsampling factors)
+    steps = list()
+    open_chains = dict()
+    for node in nodes:
+        layer = node.outbound_layer
+        if isinstance(layer, Model):
+            steps.append({'kind': 'model', 'nodes': [node]})
+            continue
+        info = get_local_layer_info(layer)
+        if (info is None) | (len(node.output_tensors) != 1):
+            steps.append({'kind': 'layer', 'nodes': [node]})
+            continue
+        chain = None
+        for tensor in node.input_tensors if info[0] not in ['pool', 'upsampling'] else list():
+            if (id(tensor) in open_chains) and (n_consumers[id(tensor)] == 1):
+                chain = open_chains.pop(id(tensor))
+                steps = [step for step in steps if step is not chain]  # chains run at the position of their last layer
+                break
+        if chain is None:
+            chain = {'kind': 'local', 'nodes': list()}
+        chain['nodes'].append(node)
+        steps.append(chain)
+        open_chains[id(node.output_tensors[0])] = chain
+
+    # get inputs/outputs of each step
+    for step in steps:
+        produced = {id(tensor) for node in step['nodes'] for tensor in node.output_tensors}
+        step['input_tensors'] = list()
+        for node in step['nodes']:
+            for tensor in node.input_tensors:
+                if (id(tensor) not in produced) and all(tensor is not t for t in step['input_tensors']):
+                    step['input_tensors'].append(tensor)
+        step['inputs'] = [id(tensor) for tensor in step['input_tensors']]
+        step['outputs'] = [id(tensor) for tensor in step['nodes'][-1].output_tensors]
+        if step['kind'] == 'local':
+            get_slab_parameters(step)
+
+    return steps
+
+
+def get_slab_parameters(step):
+    """Compute the scale of all the tensors of a chain of local layers relative to its output (along the first spatial
+    axis), and the margin that each of them needs on both sides of a slab for the output of this slab to be exact.
+    These are propagated from the output of the chain back to its inputs."""
+    scales = {step['outputs'][0]: 1.}
+    margins = {step['outputs'][0]: 0}
+    for node in reversed(step['nodes']):
+        kind, factor = get_local_layer_info(node.outbound_layer)
+        output_id = id(node.output_tensors[0])
+        for tensor in node.input_tensors:
+            if kind == 'conv':
+                scale, margin = scales[output_id], margins[output_id] + factor
+            elif kind == 'pool':
+                scale, margin = scales[output_id] * factor, margins[output_id] * factor
+            elif kind == 'upsampling':
+                scale, margin = scales[output_id] / factor, int(np.ceil(margins[output_id] / factor))
+            else:
+                scale, margin = scales[output_id], margins[output_id]
+            scales[id(tensor)] = scale
+            margins[id(tensor)] = max(margin, margins.get(id(tensor), 0))
+    step['scales'] = [scales[tensor_id] for tensor_id in step['inputs']]
+    step['multiple'] = int(max([1.] + [1 / scale for scale in scales.values()]))
+    step['halo'] = int(max([np.ceil(margins[tensor_id] / scales[tensor_id]) for tensor_id in scales]))
+
+
+def get_local_layer_info(layer):
+    """Check if a keras layer is local along the first spatial axis, i.e. if a slab of its output only depends on a
+    slab of its inputs. Returns None if not, or the type of the layer (conv, pool, upsampling, or pointwise) and either
+    the radius of the receptive field of convolutions, or the resampling factor of poolings and upsamplings."""
+    name = layer.__class__.__name__
+    if name not in ['Conv1D', 'Conv2D', 'Conv3D', 'MaxPooling1D', 'MaxPooling2D', 'MaxPooling3D', 'AveragePooling1D',
+                    'AveragePooling2D', 'AveragePooling3D', 'UpSampling1D', 'UpSampling2D', 'UpSampling3D',
+                    'BatchNormalization', 'Concatenate', 'Activation', 'Dropout', 'Add', 'Subtract', 'Multiply',
+                    'Average', 'Maximum', 'Minimum']:
+        return None
+    config = layer.get_config()
+    if config.get('data_format', 'channels_last') != 'channels_last':
+        return None
+    if name in ['Conv1D', 'Conv2D', 'Conv3D']:
+        if (config['padding'] == 'same') & all(s == 1 for s in utils.reformat_to_list(config['strides'])):
+            dilation = utils.reformat_to_list(config['dilation_rate'])[0]
+            return 'conv', dilation * (utils.reformat_to_list(config['kernel_size'])[0] - 1) // 2
+    elif 'Pooling' in name:
+        pool_size = utils.reformat_to_list(config['pool_size'])[0]
+        if pool_size == utils.reformat_to_list(config['strides'])[0]:
+            return 'pool', pool_size
+    elif 'UpSampling' in name:
+        if config.get('interpolation', 'nearest') == 'nearest':
+            return 'upsampling', utils.reformat_to_list(config['size'])[0]
+    elif name == 'BatchNormalization':
+        if 1 not in utils.reformat_to_list(config['axis']):
+            return 'pointwise', 0
+    elif name == 'Concatenate':
+        if (config['axis'] == -1) | (config['axis'] > 1):
+            return 'pointwise', 0
+    else:
+        return 'pointwise', 0
+    return None
+
+
+def get_compact_outputs(outputs, idx, pad_idx, do_parcellation):
+    """Get the compact outputs of the network (see CompactOutputs) for the idx-th image of a batch, and crop the label
+    map to the unpadded region. If the brain mask has several connected components, we return None, since the volumes
+    computed by the network then include components that are removed by postprocess.
+    :return: the cropped label map, the soft volumes of the segmentation labels, and the soft volumes of the
+    parcellation labels (None if do_parcellation is False).
+    """
+    seg_patch = edit_volumes.crop_volume_with_idx(outputs[0][idx], pad_idx, n_dims=3, return_copy=False)
+    mask = edit_volumes.crop_volume_with_idx(outputs[1][idx], pad_idx, n_dims=3, return_copy=False) > 0
+    if not np.array_equal(edit_volumes.get_largest_connected_component(mask), mask):
+        return None
+    return seg_patch, outputs[2][idx], outputs[3][idx] if do_parcellation else None
+
+
+def postprocess_compact(seg_patch, volumes, volumes_parc, shape, crop_idx, labels_segmentation, aff, im_res, v1):
+    """Same as postprocess in fast mode without posteriors, but for the compact outputs of the network given by
+    get_compact_outputs. Only the label map needs to be pasted back into the space of the input image, since volumes
+    are already computed. The returned posteriors are None."""
+
+    # paste patch back to matrix of original image size
+    if crop_idx is not None:
+        seg = np.zeros(shape=shape, dtype='int32')
+        seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
+    else:
+        seg = seg_patch.astype('int32', copy=False)
+
+    # align prediction back to first orientation (this only returns a view of the array, not a copy)
+    seg = edit_volumes.align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+
+    volumes = get_volumes(volumes.astype('float64'), volumes_parc, labels_segmentation, im_res, v1)
 
-    # get posteriors
-    post_patch_seg = np.squeeze(post_patch_seg)
+    return seg, None, volumes
+
+
+def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
+                labels_segmentation, labels_parcellation, aff, im_res, fast, topology_classes, v1,
+                return_posteriors=True):
+    """Postprocess the outputs of the network, and paste them back into the space of the input image.
+    If return_posteriors is False, volumes are directly computed from the cropped posteriors (the posteriors of all
+    foreground labels being zero outside the patch), and only the hard segmentation is pasted and reoriented.
+    In this case, the returned posteriors are None."""
+
+    # get posteriors (all operations are done in place, in float32)
+    post_patch_seg = np.squeeze(post_patch_seg).astype('float32', copy=False)
     if fast | (topology_classes is None):
         post_patch_seg = edit_volumes.crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
 
     # keep biggest connected component
-    tmp_post_patch_seg = post_patch_seg[..., 1:]
-    post_patch_seg_mask = np.sum(tmp_post_patch_seg, axis=-1) > 0.25
+    post_patch_seg_mask = np.sum(post_patch_seg[..., 1:], axis=-1) > 0.25
     post_patch_seg_mask = edit_volumes.get_largest_connected_component(post_patch_seg_mask)
-    post_patch_seg_mask = np.stack([post_patch_seg_mask]*tmp_post_patch_seg.shape[-1], axis=-1)
-    tmp_post_patch_seg = edit_volumes.mask_volume(tmp_post_patch_seg, mask=post_patch_seg_mask, return_copy=False)
-    post_patch_seg[..., 1:] = tmp_post_patch_seg
+    post_patch_seg[np.logical_not(post_patch_seg_mask), 1:] = 0
 
     # reset posteriors to zero outside the largest connected component of each topological class
     if (not fast) & (topology_classes is not None):
-        post_patch_seg_mask = post_patch_seg > 0.25
-        for topology_class in np.unique(topology_classes)[1:]:
-            tmp_topology_indices = np.where(topology_classes == topology_class)[0]
-            tmp_mask = np.any(post_patch_seg_mask[..., tmp_topology_indices], axis=-1)
-            tmp_mask = edit_volumes.get_largest_connected_component(tmp_mask)
-            for idx in tmp_topology_indices:
-                post_patch_seg[..., idx] *= tmp_mask
+        edit_volumes.keep_largest_connected_component_per_class(post_patch_seg, topology_classes, threshold=0.25)
         post_patch_seg = edit_volumes.crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
     else:
-        post_patch_seg_mask = post_patch_seg > 0.2
-        post_patch_seg[..., 1:] *= post_patch_seg_mask[..., 1:]
+        np.multiply(post_patch_seg[..., 1:], post_patch_seg[..., 1:] > 0.2, out=post_patch_seg[..., 1:])
+    del post_patch_seg_mask
 
     # get hard segmentation
-    post_patch_seg /= np.sum(post_patch_seg, axis=-1)[..., np.newaxis]
-    seg_patch = labels_segmentation[post_patch_seg.argmax(-1).astype('int32')].astype('int32')
+    post_patch_seg /= np.sum(post_patch_seg, axis=-1, keepdims=True)
+    seg_patch = labels_segmentation.astype('int32')[post_patch_seg.argmax(-1)]
 
     # postprocess parcellation
     if post_patch_parc is not None:
-        post_patch_parc = np.squeeze(post_patch_parc)
+        post_patch_parc = np.squeeze(post_patch_parc).astype('float32', copy=False)
         post_patch_parc = edit_volumes.crop_volume_with_idx(post_patch_parc, pad_idx, n_dims=3, return_copy=False)
         mask = (seg_patch == 3) | (seg_patch == 42)
-        post_patch_parc[..., 0] = np.ones_like(post_patch_parc[..., 0])
-        post_patch_parc[..., 0] = edit_volumes.mask_volume(post_patch_parc[..., 0], mask=mask < 0.1, return_copy=False)
-        post_patch_parc /= np.sum(post_patch_parc, axis=-1)[..., np.newaxis]
-        parc_patch = labels_parcellation[post_patch_parc.argmax(-1).astype('int32')].astype('int32')
-        seg_patch[mask] = parc_patch[mask]
+        post_patch_parc[..., 0] = np.logical_not(mask)
+        post_patch_parc /= np.sum(post_patch_parc, axis=-1, keepdims=True)
+        seg_patch[mask] = labels_parcellation.astype('int32')[post_patch_parc[mask].argmax(-1)]
+
+    # compute volumes of the foreground labels (these are all zero outside the patch)
+    volumes = np.sum(post_patch_seg[..., 1:], axis=(0, 1, 2), dtype='float64')
 
     # paste patches back to matrix of original image size
     if crop_idx is not None:
-        # we need to go through this because of the posteriors of the background, otherwise pad_volume would work
         seg = np.zeros(shape=shape, dtype='int32')
-        posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]])
-        posteriors[..., 0] = np.ones(shape)  # place background around patch
         seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
-        posteriors[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5], :] = post_patch_seg
+        del seg_patch
+        if return_posteriors:
+            # we need to go through this because of the posteriors of the background, otherwise pad_volume would work
+            posteriors = np.zeros(shape=[*shape, labels_segmentation.shape[0]], dtype='float32')
+            posteriors[..., 0] = 1  # place background around patch
+            posteriors[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5], :] = post_patch_seg
+        else:
+            posteriors = None
+        del post_patch_seg
     else:
         seg = seg_patch
-        posteriors = post_patch_seg
+        posteriors = post_patch_seg if return_posteriors else None
 
-    # align prediction back to first orientation
+    # align prediction back to first orientation (this only returns views of the arrays, not copies)
     seg = edit_volumes.align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
-    posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+    if posteriors is not None:
+        posteriors = edit_volumes.align_volume_to_ref(posteriors, np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
 
-    # compute volumes
-    volumes = np.sum(posteriors[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+    # compute volumes of the parcellation labels
+    if post_patch_parc is not None:
+        volumes_parc = np.sum(post_patch_parc[..., 1:], axis=(0, 1, 2), dtype='float64')
+    else:
+        volumes_parc = None
+    volumes = get_volumes(volumes, volumes_parc, labels_segmentation, im_res, v1)
+
+    return seg, posteriors, volumes
+
+
+def get_volumes(volumes, volumes_parc, labels_segmentation, im_res, v1):
+    """Build the row of volumes written in the csv files, from the soft volumes (in voxels) of the foreground
+    segmentation labels, and of the foreground parcellation labels (can be None). Parcellation volumes are rescaled so
+    that they sum to the total volume of the cortex in each hemisphere."""
+
+    # compute total volumes of the cortex
     total_volume_cortex_left = np.sum(volumes[np.where(labels_segmentation == 3)[0] - 1])
     total_volume_cortex_right = np.sum(volumes[np.where(labels_segmentation == 42)[0] - 1])
     if not v1:
         volumes = np.concatenate([np.array([np.sum(volumes)]), volumes])
-    if post_patch_parc is not None:
-        volumes_parc = np.sum(post_patch_parc[..., 1:], axis=tuple(range(0, len(posteriors.shape) - 1)))
+    if volumes_parc is not None:
+        volumes_parc = np.asarray(volumes_parc, dtype='float64')
         volumes_parc_left = volumes_parc[:int(len(volumes_parc) / 2)]
         volumes_parc_right = volumes_parc[int(len(volumes_parc) / 2):]
         volumes_parc_left = volumes_parc_left / np.sum(volumes_parc_left) * total_volume_cortex_left
@@ -762,7 +1725,126 @@ def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
         volumes = np.concatenate([volumes, volumes_parc_left, volumes_parc_right])
     volumes = np.around(volumes * np.prod(im_res), 3)
 
-    return seg, posteriors, volumes
+    return volumes
+
+
+class CompactOutputs(KL.Layer):
+    """Reduce the posteriors of the network with the same operations as postprocess in fast mode, except for the
+    removal of the connected components outside the largest one (see get_compact_outputs).
+    Inputs are the posteriors of the segmentation, those of the parcellation (if labels_parcellation is not None), and
+    the padding indices of each image, of shape [batch, 6].
+    Outputs are the label map (int32), the brain mask (uint8), the soft volumes of the foreground segmentation labels
+    within the unpadded region, and the same for the parcellation labels (if labels_parcellation is not None)."""
+
+    def __init__(self, labels_segmentation, labels_parcellation=None, **kwargs):
+        self.labels_segmentation = labels_segmentation
+        self.labels_parcellation = labels_parcellation
+        super(CompactOutputs, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["labels_segmentation"] = self.labels_segmentation
+        config["labels_parcellation"] = self.labels_parcellation
+        return config
+
+    def call(self, inputs, **kwargs):
+        post_seg = inputs[0]
+        pad_idx = inputs[-1]
+
+        # mask of the unpadded region
+        region = tf.ones(tf.shape(post_seg)[:-1], dtype='bool')
+        for axis in range(3):
+            idx = tf.range(tf.shape(post_seg)[axis + 1])[tf.newaxis]
+            axis_mask = tf.logical_and(idx >= pad_idx[:, axis:axis + 1], idx < pad_idx[:, axis + 3:axis + 4])
+            for other_axis in [ax for ax in range(3) if ax != axis]:
+                axis_mask = tf.expand_dims(axis_mask, other_axis + 1)
+            region = tf.logical_and(region, axis_mask)
+        region = tf.cast(region, 'float32')[..., tf.newaxis]
+
+        # brain mask, and thresholded posteriors (foreground posteriors are zero outside the brain mask)
+        mask = tf.reduce_sum(post_seg[..., 1:], axis=-1) > 0.25
+        post_fg = post_seg[..., 1:] * tf.cast(post_seg[..., 1:] > 0.2, 'float32')
+        post_fg = post_fg * tf.cast(mask, 'float32')[..., tf.newaxis]
+        post_seg = tf.concat([post_seg[..., :1], post_fg], axis=-1)
+        post_seg = post_seg / tf.reduce_sum(post_seg, axis=-1, keepdims=True)
+
+        # label map and soft volumes
+        seg = tf.gather(tf.convert_to_tensor(self.labels_segmentation, 'int32'), tf.argmax(post_seg, axis=-1))
+        outputs = [tf.reduce_sum(post_seg[..., 1:] * region, axis=[1, 2, 3])]
+
+        # parcellate cortex
+        if self.labels_parcellation is not None:
+            cortex = tf.logical_or(tf.equal(seg, 3), tf.equal(seg, 42))
+            post_parc = inputs[1]
+            post_parc = tf.concat([1 - tf.cast(cortex, 'float32')[..., tf.newaxis], post_parc[..., 1:]], axis=-1)
+            post_parc = post_parc / tf.reduce_sum(post_parc, axis=-1, keepdims=True)
+            parc = tf.gather(tf.convert_to_tensor(self.labels_parcellation, 'int32'), tf.argmax(post_parc, axis=-1))
+            seg = tf.where(cortex, parc, seg)
+            outputs.append(tf.reduce_sum(post_parc[..., 1:] * region, axis=[1, 2, 3]))
+
+        return [seg, tf.cast(mask, 'uint8'), *outputs]
+
+    def compute_output_shape(self, input_shape):
+        output_shape = [input_shape[0][:-1], input_shape[0][:-1], (input_shape[0][0], input_shape[0][-1] - 1)]
+        if self.labels_parcellation is not None:
+            output_shape.append((input_shape[1][0], input_shape[1][-1] - 1))
+        return output_shape
+
+
+class CropAroundMask(KL.Layer):
+    """Crop a tensor to the bounding box of the mask given by its last channel, expanded by a margin (in voxels), and
+    with a shape divisible by 2**n_levels, so that it can be processed by a UNet with n_levels levels. The same box is
+    used for all the elements of the batch. If the mask is empty, the whole tensor is kept.
+    Outputs are the cropped tensor and the start indices of the box, of shape [batch, 3] (see UncropWithBackground)."""
+
+    def __init__(self, margin, n_levels=5, **kwargs):
+        self.margin = margin
+        self.n_levels = n_levels
+        super(CropAroundMask, self).__init__(**kwargs)
+
+    def get_config(self):
+        config = super().get_config()
+        config["margin"] = self.margin
+        config["n_levels"] = self.n_levels
+        return config
+
+    def call(self, inputs, **kwargs):
+
+        # find bounding box of the mask
+        shape = tf.shape(inputs)[1:4]
+        indices = tf.cast(tf.where(tf.reduce_any(inputs[..., -1] > 0, axis=0)), 'int32')
+        empty = tf.equal(tf.shape(indices)[0], 0)
+        min_idx = K.switch(empty, tf.zeros([3], dtype='int32'), tf.reduce_min(indices, axis=0) - self.margin)
+        max_idx = K.switch(empty, shape, tf.reduce_max(indices, axis=0) + 1 + self.margin)
+
+        # expand box to a shape divisible by 2**n_levels around its centre, and shift it inside the tensor
+        divisor = 2 ** self.n_levels
+        size = tf.minimum((max_idx - min_idx + divisor - 1) // divisor * divisor, shape)
+        start = tf.clip_by_value(min_idx - (size - max_idx + min_idx) // 2, 0, shape - size)
+
+        cropped = inputs[:, start[0]:start[0] + size[0], start[1]:start[1] + size[1], start[2]:start[2] + size[2], :]
+        return [cropped, tf.tile(start[tf.newaxis], [tf.shape(inputs)[0], 1])]
+
+    def compute_output_shape(self, input_shape):
+        return [(input_shape[0], None, None, None, input_shape[-1]), (input_shape[0], 3)]
+
+
+class UncropWithBackground(KL.Layer):
+    """Paste posteriors cropped by CropAroundMask back into a tensor with the spatial shape of a reference tensor.
+    Outside the box, the first channel (background) is set to 1, and all the others to 0.
+    Inputs are the cropped posteriors, the start indices of the box, and the reference tensor."""
+
+    def call(self, inputs, **kwargs):
+        posteriors, start, reference = inputs
+        start = start[0]
+        end = tf.shape(reference)[1:4] - start - tf.shape(posteriors)[1:4]
+        paddings = tf.stack([[0, 0], [start[0], end[0]], [start[1], end[1]], [start[2], end[2]], [0, 0]], axis=0)
+        background = tf.pad(posteriors[..., :1], paddings, constant_values=1)
+        foreground = tf.pad(posteriors[..., 1:], paddings)
+        return tf.concat([background, foreground], axis=-1)
+
+    def compute_output_shape(self, input_shape):
+        return (*input_shape[2][:-1], input_shape[0][-1])
 
 
 class MakeShape(KL.Layer):
@@ -4,13 +4,19 @@ These functions are sorted in five categories:
 1- volume editing: this can be applied to any volume (i.e. images or label maps). It contains:
         -mask_volume
         -rescale_volume
+        -get_histogram_percentiles
         -crop_volume
         -crop_volume_around_region
         -crop_volume_with_idx
+        -get_head_bounding_box
         -pad_volume
         -flip_volume
         -resample_volume
         -resample_volume_like
+        -get_resampling_coordinates
+        -get_resampling_plan
+        -get_resampling_operator
+        -apply_resampling_operators
         -get_ras_axes
         -align_volume_to_ref
         -blur_volume
@@ -20,6 +26,7 @@ These functions are sorted in five categories:
         -smooth_label_map
         -erode_label_map
         -get_largest_connected_component
+        -keep_largest_connected_component_per_class
         -compute_hard_volumes
         -compute_distance_map
 3- editing all volumes in a folder: functions are more or less the same as 1, but they now apply to all the volumes
@@ -78,11 +85,13 @@ import numpy as np
 import tensorflow as tf
 import keras.layers as KL
 from keras.models import Model
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from scipy.ndimage.filters import convolve
 from scipy.ndimage import label as scipy_label
 from scipy.interpolate import RegularGridInterpolator
 from scipy.ndimage.morphology import distance_transform_edt, binary_fill_holes
-from scipy.ndimage import binary_dilation, binary_erosion, gaussian_filter
+from scipy.ndimage import binary_dilation, binary_erosion, gaussian_filter, gaussian_filter1d
 
 # project imports
 from ext.lab2im import utils
@@ -145,7 +154,8 @@ def mask_volume(volume, mask=None, threshold=0.1, dilate=0, erode=0, fill_holes=
         return new_volume
 
 
-def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2, max_percentile=98, use_positive_only=False):
+def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2, max_percentile=98, use_positive_only=False,
+                   percentile_tolerance=None):
     """This function linearly rescales a volume between new_min and new_max.
     :param volume: a numpy array
     :param new_min: (optional) minimum value for the rescaled image.
@@ -155,27 +165,108 @@ def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2, max_percent
     :param max_percentile: (optional) percentile for estimating robust maximum of volume (float in [0,...100]),
     where 100 = np.max
     :param use_positive_only: (optional) whether to use only positive values when estimating the min and max percentile
+    :param percentile_tolerance: (optional) if not None, the robust minimum and maximum are estimated with histograms
+    (see get_histogram_percentiles) rather than with np.percentile, which sorts a copy of the whole volume. The error on
+    each of these values is then at most percentile_tolerance * (max(volume) - min(volume)). Default is None, where
+    percentiles are exact.
     :return: rescaled volume
     """
 
     # select only positive intensities
-    new_volume = volume.copy()
-    intensities = new_volume[new_volume > 0] if use_positive_only else new_volume.flatten()
+    intensities = volume[volume > 0] if use_positive_only else volume
 
     # define min and max intensities in original image for normalisation
-    robust_min = np.min(intensities) if min_percentile == 0 else np.percentile(intensities, min_percentile)
-    robust_max = np.max(intensities) if max_percentile == 100 else np.percentile(intensities, max_percentile)
+    if percentile_tolerance is None:
+        intensities = intensities.flatten()
+        robust_min = np.min(intensities) if min_percentile == 0 else np.percentile(intensities, min_percentile)
+        robust_max = np.max(intensities) if max_percentile == 100 else np.percentile(intensities, max_percentile)
+    else:
+        robust_min, robust_max = get_histogram_percentiles(intensities, [min_percentile, max_percentile],
+                                                           tolerance=percentile_tolerance)
 
     # trim values outside range
-    new_volume = np.clip(new_volume, robust_min, robust_max)
+    new_volume = np.clip(volume, robust_min, robust_max)
 
     # rescale image
     if robust_min != robust_max:
+        if np.issubdtype(new_volume.dtype, np.floating):  # new_volume is already a copy, so we can work in place
+            new_volume -= robust_min
+            new_volume *= (new_max - new_min) / (robust_max - robust_min)
+            new_volume += new_min
+            return new_volume
         return new_min + (new_volume - robust_min) / (robust_max - robust_min) * (new_max - new_min)
     else:  # avoid dividing by zero
         return np.zeros_like(new_volume)
 
 
+def get_histogram_percentiles(values, percentiles, tolerance=1e-3, n_bins=1024):
+    """Estimate percentiles of an array (with the same linear interpolation as np.percentile) without sorting it.
+    Each percentile is interpolated between two order statistics, which are first located in a histogram over the whole
+    range of values. The bins containing them are then refined with histograms restricted to these bins, until bins are
+    narrower than 2 * tolerance * (max - min). Order statistics are computed exactly when only a few values are left.
+    :param values: numpy array. This array is not copied.
+    :param percentiles: sequence of percentiles (floats in [0,...100]).
+    :param tolerance: (optional) maximum error on the estimated percentiles, as a fraction of the range of values.
+    Default is 1e-3.
+    :param n_bins: (optional) number of bins of each histogram. Default is 1024.
+    :return: a list with the estimated percentiles, in the same order as the given percentiles.
+    """
+
+    assert tolerance > 0, 'tolerance should be strictly positive, got %s' % tolerance
+    min_value = np.min(values)
+    max_value = np.max(values)
+    if min_value == max_value:
+        return [min_value] * len(percentiles)
+    max_width = 2 * tolerance * (max_value - min_value)
+    counts, edges = np.histogram(values, bins=n_bins, range=(min_value, max_value))
+    cumulated_counts = np.cumsum(counts)
+    values_in_bins = dict()
+
+    def get_order_statistic(rank):
+        # locate bin containing the value of the given rank
+        idx = np.searchsorted(cumulated_counts, rank, side='right')
+        lower = edges[idx]
+        upper = edges[idx + 1]
+        if upper - lower <= max_width:
+            return (lower + upper) / 2
+        rank = rank - (cumulated_counts[idx - 1] if idx > 0 else 0)
+        if idx not in values_in_bins:  # consecutive order statistics are often in the same bin
+            in_bin = (values >= lower) & ((values < upper) if idx < n_bins - 1 else (values <= upper))
+            values_in_bins[idx] = values[in_bin]
+        sub_values = values_in_bins[idx]
+
+        # refine bin until it is narrow enough, or until there are few enough values to get the exact order statistic
+        while (upper - lower > max_width) & (len(sub_values) > n_bins):
+            sub_counts, sub_edges = np.histogram(sub_values, bins=n_bins, range=(lower, upper))
+            sub_cumulated_counts = np.cumsum(sub_counts)
+            idx = np.searchsorted(sub_cumulated_counts, rank, side='right')
+            rank = rank - (sub_cumulated_counts[idx - 1] if idx > 0 else 0)
+            lower = sub_edges[idx]
+            upper = sub_edges[idx + 1]
+            sub_values = sub_values[(sub_values >= lower) & ((sub_values < upper) | (idx == n_bins - 1))]
+        if upper - lower > max_width:
+            return np.partition(sub_values, rank)[rank]
+        return (lower + upper) / 2
+
+    # interpolate between order statistics
+    n_values = np.size(values)
+    estimated_percentiles = list()
+    for percentile in percentiles:
+        if percentile == 0:
+            estimated_percentiles.append(min_value)
+        elif percentile == 100:
+            estimated_percentiles.append(max_value)
+        else:
+            position = percentile / 100 * (n_values - 1)
+            rank = int(np.floor(position))
+            estimate = get_order_statistic(rank)
+            if position > rank:
+                estimate = estimate + (position - rank) * (get_order_statistic(rank + 1) - estimate)
+            estimated_percentiles.append(estimate)
+
+    return estimated_percentiles
+
+
 def crop_volume(volume, cropping_margin=None, cropping_shape=None, aff=None, return_crop_idx=False, mode='center'):
     """Crop volume by a given margin, or to a given shape.
     :param volume: 2d or 3d numpy array (possibly with multiple channels)
@@ -421,6 +512,51 @@ def crop_volume_with_idx(volume, crop_idx, aff=None, n_dims=None, return_copy=Tr
         return new_volume
 
 
+def get_head_bounding_box(volume, margin=0, max_extent=None, superior_axis=2, downsampling=4):
+    """Find the bounding box of the head in a 3d image with a cheap foreground detection. The image is downsampled,
+    thresholded with Otsu's method, and we keep the largest connected component of the obtained mask.
+    :param volume: a 3d numpy array.
+    :param margin: (optional) margin (in voxels) added around the bounding box. Default is 0.
+    :param max_extent: (optional) maximum extent (in voxels) of the bounding box along superior_axis, measured
+    downwards from the top of the head. This enables to exclude the neck and shoulders from the bounding box.
+    :param superior_axis: (optional) axis pointing towards the top of the head, in which the index of voxels increases.
+    Default is 2, which corresponds to volumes aligned with align_volume_to_ref(aff_ref=np.eye(4)).
+    :param downsampling: (optional) downsampling factor used to detect the head. Default is 4.
+    :return: the cropping indices of the bounding box (in the order [lower_bound_dim_1, ..., upper_bound_dim_1, ...]),
+    or None if no foreground was found.
+    """
+
+    # threshold downsampled volume with Otsu's method (outliers are clipped to get a meaningful histogram)
+    vol = volume[::downsampling, ::downsampling, ::downsampling].astype('float32')
+    vol = np.clip(vol, np.min(vol), np.percentile(vol, 99.9))
+    hist, edges = np.histogram(vol, bins=256)
+    centres = (edges[:-1] + edges[1:]) / 2
+    weights_low = np.cumsum(hist)
+    weights_high = weights_low[-1] - weights_low
+    cumulated = np.cumsum(hist * centres)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means_diff = cumulated / weights_low - (cumulated[-1] - cumulated) / weights_high
+    between_variance = np.nan_to_num(weights_low * weights_high * means_diff ** 2)
+    mask = get_largest_connected_component(vol > edges[np.argmax(between_variance) + 1])
+    if not np.any(mask):
+        return None
+
+    # only keep the top of the mask if necessary
+    if max_extent is not None:
+        superior_idx = np.where(np.any(mask, axis=tuple(ax for ax in range(3) if ax != superior_axis)))[0]
+        lower_bound = superior_idx[-1] + 1 - int(np.ceil(max_extent / downsampling))
+        if lower_bound > 0:
+            mask = mask.copy()
+            mask[(slice(None),) * superior_axis + (slice(0, lower_bound),)] = False
+
+    # get bounding box in the space of the input volume
+    vol_shape = np.array(volume.shape[:3])
+    indices = np.where(mask)
+    min_idx = np.array([np.min(idx) for idx in indices]) * downsampling - margin
+    max_idx = (np.array([np.max(idx) for idx in indices]) + 1) * downsampling + margin
+    return np.concatenate([np.maximum(min_idx, 0), np.minimum(max_idx, vol_shape)])
+
+
 def pad_volume(volume, padding_shape, padding_value=0, aff=None, return_pad_idx=False):
     """Pad volume to a given shape
     :param volume: volume to be padded
@@ -501,7 +637,7 @@ def flip_volume(volume, axis=None, direction=None, aff=None, return_copy=True):
     return np.flip(new_volume, axis=axis)
 
 
-def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True):
+def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True, fast=True, n_threads=1):
     """This function resizes the voxels of a volume to a new provided size, while adjusting the header to keep the RAS
     :param volume: a numpy array
     :param aff: affine matrix of the volume
@@ -509,40 +645,37 @@ def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True
     :param interpolation: (optional) type of interpolation. Can be 'linear' or 'nearest'. Default is 'linear'.
     :param blur: (optional) whether to blur before resampling to avoid aliasing effects.
     Only used if the input volume is downsampled. Default is True.
+    :param fast: (optional) whether to resample the volume with separable 1d operators (see get_resampling_operator),
+    where blurring and interpolation are fused, instead of blurring and interpolating the whole volume with scipy.
+    Both give the same results, up to float precision. The operators are cached (see get_resampling_plan), so they are
+    only computed once for all the volumes with the same shape and voxel size. Integer volumes that need blurring
+    always use the scipy path, since gaussian_filter then rounds the blurred volume. Default is True.
+    :param n_threads: (optional) number of threads used by the fast path. Default is 1.
     :return: new volume and affine matrix
     """
 
     pixdim = np.sqrt(np.sum(aff * aff, axis=0))[:-1]
     new_vox_size = np.array(new_vox_size)
     factor = pixdim / new_vox_size
-    sigmas = 0.25 / factor
-    sigmas[factor > 1] = 0  # don't blur if upsampling
 
-    volume_filt = gaussian_filter(volume, sigmas) if blur else volume
+    if fast & (np.issubdtype(volume.dtype, np.floating) | (not blur) | np.all(factor > 1)):
+        operators = get_resampling_plan(tuple(volume.shape[:3]), tuple(np.round(pixdim, 6)),
+                                        tuple(np.broadcast_to(new_vox_size, 3).tolist()), interpolation, blur)
+        volume2 = apply_resampling_operators(volume, operators, n_threads=n_threads)
+        if interpolation == 'nearest':  # same output type as RegularGridInterpolator
+            dtype = volume.dtype if np.issubdtype(volume.dtype, np.floating) else 'float64'
+            volume2 = volume2.astype(dtype, copy=False)
 
-    # volume2 = zoom(volume_filt, factor, order=1, mode='reflect', prefilter=False)
-    x = np.arange(0, volume_filt.shape[0])
-    y = np.arange(0, volume_filt.shape[1])
-    z = np.arange(0, volume_filt.shape[2])
-
-    my_interpolating_function = RegularGridInterpolator((x, y, z), volume_filt, method=interpolation)
-
-    start = - (factor - 1) / (2 * factor)
-    step = 1.0 / factor
-    stop = start + step * np.ceil(volume_filt.shape * factor)
-
-    xi = np.arange(start=start[0], stop=stop[0], step=step[0])
-    yi = np.arange(start=start[1], stop=stop[1], step=step[1])
-    zi = np.arange(start=start[2], stop=stop[2], step=step[2])
-    xi[xi < 0] = 0
-    yi[yi < 0] = 0
-    zi[zi < 0] = 0
-    xi[xi > (volume_filt.shape[0] - 1)] = volume_filt.shape[0] - 1
-    yi[yi > (volume_filt.shape[1] - 1)] = volume_filt.shape[1] - 1
-    zi[zi > (volume_filt.shape[2] - 1)] = volume_filt.shape[2] - 1
-
-    xig, yig, zig = np.meshgrid(xi, yi, zi, indexing='ij', sparse=True)
-    volume2 = my_interpolating_function((xig, yig, zig))
+    else:
+        sigmas = 0.25 / factor
+        sigmas[factor > 1] = 0  # don't blur if upsampling
+        volume_filt = gaussian_filter(volume, sigmas) if blur else volume
+        x = np.arange(0, volume_filt.shape[0])
+        y = np.arange(0, volume_filt.shape[1])
+        z = np.arange(0, volume_filt.shape[2])
+        my_interpolating_function = RegularGridInterpolator((x, y, z), volume_filt, method=interpolation)
+        xig, yig, zig = np.meshgrid(*get_resampling_coordinates(volume.shape[:3], factor), indexing='ij', sparse=True)
+        volume2 = my_interpolating_function((xig, yig, zig))
 
     aff2 = aff.copy()
     for c in range(3):
@@ -552,18 +685,32 @@ def resample_volume(volume, aff, new_vox_size, interpolation='linear', blur=True
     return volume2, aff2
 
 
-def resample_volume_like(vol_ref, aff_ref, vol_flo, aff_flo, interpolation='linear'):
+def resample_volume_like(vol_ref, aff_ref, vol_flo, aff_flo, interpolation='linear', fast=True, n_threads=1):
     """This function reslices a floating image to the space of a reference image
     :param vol_ref: a numpy array with the reference volume
     :param aff_ref: affine matrix of the reference volume
     :param vol_flo: a numpy array with the floating volume
     :param aff_flo: affine matrix of the floating volume
     :param interpolation: (optional) type of interpolation. Can be 'linear' or 'nearest'. Default is 'linear'.
+    :param fast: (optional) whether to use separable 1d operators (see get_resampling_operator) when the voxel axes of
+    the two volumes are aligned (i.e. when the transform between voxel grids is only a scaling and a translation).
+    Otherwise, the floating volume is interpolated at all the voxels of the reference grid. Default is True.
+    :param n_threads: (optional) number of threads used by the fast path. Default is 1.
     :return: resliced volume
     """
 
     T = np.matmul(np.linalg.inv(aff_flo), aff_ref)
 
+    # axes are aligned, so the coordinates along each axis only depend on the corresponding reference axis
+    if fast & (np.max(np.abs(T[:3, :3] - np.diag(np.diag(T[:3, :3])))) < 1e-9):
+        operators = [get_resampling_operator(vol_flo.shape[i], T[i, i] * np.arange(vol_ref.shape[i]) + T[i, 3],
+                                             interpolation=interpolation, fill_outside=True) for i in range(3)]
+        result = apply_resampling_operators(vol_flo, operators, n_threads=n_threads)
+        if interpolation == 'nearest':  # same output type as RegularGridInterpolator
+            dtype = vol_flo.dtype if np.issubdtype(vol_flo.dtype, np.floating) else 'float64'
+            result = result.astype(dtype, copy=False)
+        return result.reshape(vol_ref.shape)
+
     xf = np.arange(0, vol_flo.shape[0])
     yf = np.arange(0, vol_flo.shape[1])
     zf = np.arange(0, vol_flo.shape[2])
@@ -588,6 +735,149 @@ def resample_volume_like(vol_ref, aff_ref, vol_flo, aff_flo, interpolation='line
     return result.reshape(vol_ref.shape)
 
 
+def get_resampling_coordinates(shape, factor):
+    """Compute the coordinates where a volume is interpolated when its voxels are resized by the given factors.
+    :param shape: shape of the volume (excluding channels).
+    :param factor: ratio between the old and new voxel sizes along each axis.
+    :return: a list with a 1d numpy array of coordinates (in voxels of the input volume) for each axis.
+    """
+
+    factor = np.array(factor)
+    start = - (factor - 1) / (2 * factor)
+    step = 1.0 / factor
+    stop = start + step * np.ceil(np.array(shape) * factor)
+
+    coords = list()
+    for i in range(len(shape)):
+        coords_axis = np.arange(start=start[i], stop=stop[i], step=step[i])
+        coords_axis[coords_axis < 0] = 0
+        coords_axis[coords_axis > (shape[i] - 1)] = shape[i] - 1
+        coords.append(coords_axis)
+
+    return coords
+
+
+@lru_cache(maxsize=64)
+def get_resampling_plan(shape, pixdim, new_vox_size, interpolation='linear', blur=True):
+    """Build the 1d operators (see get_resampling_operator) used by resample_volume to resize the voxels of a volume.
+    Plans only depend on the geometry of the volume, so they are cached and reused for all the volumes with the same
+    shape and voxel size (e.g. scans acquired with the same protocol).
+    :param shape: tuple with the shape of the volume (excluding channels).
+    :param pixdim: tuple with the voxel size of the volume. This should be rounded (e.g. to 1e-6mm), so that voxel sizes
+    computed from slightly different headers share the same plan.
+    :param new_vox_size: tuple with the new voxel size.
+    :param interpolation: (optional) type of interpolation. Can be 'linear' or 'nearest'. Default is 'linear'.
+    :param blur: (optional) whether to blur before resampling to avoid aliasing effects. Default is True.
+    :return: a tuple of (indices, weights) tuples, one per axis. These arrays are read-only, since they are shared.
+    """
+
+    factor = np.array(pixdim) / np.array(new_vox_size)
+    sigmas = 0.25 / factor
+    sigmas[(factor > 1) | (not blur)] = 0  # don't blur if upsampling
+
+    operators = list()
+    for length, coords, sigma in zip(shape, get_resampling_coordinates(shape, factor), sigmas):
+        indices, weights = get_resampling_operator(length, coords, sigma, interpolation)
+        indices.setflags(write=False)
+        weights.setflags(write=False)
+        operators.append((indices, weights))
+
+    return tuple(operators)
+
+
+def get_resampling_operator(length, coords, sigma=0., interpolation='linear', fill_outside=False):
+    """Build the 1d operator that blurs a signal with a gaussian kernel (exactly as scipy's gaussian_filter, which is
+    separable), and then interpolates the blurred signal at the provided coordinates (exactly as RegularGridInterpolator
+    along one axis). Both steps are linear, so they are fused into a single sparse operator.
+    :param length: length of the input signal.
+    :param coords: 1d numpy array with the coordinates where to interpolate the signal.
+    :param sigma: (optional) standard deviation of the gaussian kernel. Default is 0, where no blurring is applied.
+    :param interpolation: (optional) type of interpolation. Can be 'linear' or 'nearest'. Default is 'linear'.
+    :param fill_outside: (optional) whether to give a value of zero to coordinates outside [0, length - 1]. Otherwise,
+    coordinates are assumed to be within these bounds. Default is False.
+    :return: two numpy arrays of shape [len(coords), n_taps] with indices and weights, such that the value at coords[i]
+    is sum_k weights[i, k] * signal[indices[i, k]].
+    """
+
+    # interpolation operator, with the same conventions as RegularGridInterpolator
+    coords = np.asarray(coords, dtype='float64')
+    lower = np.clip(np.floor(coords), 0, max(length - 2, 0)).astype('int64')
+    frac = coords - lower
+    if interpolation == 'nearest':
+        indices = np.where(frac <= .5, lower, lower + 1)[:, np.newaxis]
+        weights = np.ones(indices.shape)
+    elif interpolation == 'linear':
+        indices = np.stack([lower, lower + 1], axis=-1)
+        weights = np.stack([1 - frac, frac], axis=-1)
+    else:
+        raise Exception("interpolation should be 'linear' or 'nearest', got %s" % interpolation)
+    indices = np.minimum(indices, length - 1)
+    if fill_outside:
+        weights[(coords < 0) | (coords > length - 1)] = 0
+
+    # compose with the blurring operator, which is obtained by blurring the identity (same boundary conditions)
+    if sigma > 1e-15:
+        operator = np.zeros((len(coords), length))
+        np.add.at(operator, (np.arange(len(coords))[:, np.newaxis], indices), weights)
+        operator = np.matmul(operator, gaussian_filter1d(np.eye(length), sigma, axis=0))
+        n_taps = max(int(np.max(np.sum(operator != 0, axis=1))), 1)
+        indices = np.argsort(operator == 0, axis=1, kind='stable')[:, :n_taps]
+        weights = np.take_along_axis(operator, indices, axis=1)
+
+    return indices, weights
+
+
+def apply_resampling_operators(volume, operators, n_threads=1):
+    """Apply 1d operators (see get_resampling_operator) along the first axes of a volume, one axis after the other.
+    Each pass is computed in parallel over slices of the volume.
+    :param volume: a numpy array, with possible channels in the last axes.
+    :param operators: list of (indices, weights) tuples, one per axis to process.
+    :param n_threads: (optional) number of threads. Default is 1.
+    :return: the resampled volume. It is of type float64, unless all operators are made of unit weights (i.e. nearest
+    interpolation without blurring and within bounds), in which case the input type is kept.
+    """
+
+    n_axes = len(operators)
+
+    # process first the axes that shrink the volume the most, to reduce the amount of work for the next passes
+    for axis in sorted(range(n_axes), key=lambda a: operators[a][0].shape[0] / volume.shape[a]):
+        indices, weights = operators[axis]
+
+        # nearest neighbour without blurring only needs a gather
+        if (indices.shape[1] == 1) & np.all(weights == 1):
+            if (len(indices) != volume.shape[axis]) or np.any(indices[:, 0] != np.arange(volume.shape[axis])):
+                volume = np.take(volume, indices[:, 0], axis=axis)
+            continue
+
+        # slices are taken along the largest other axis, and are processed in parallel
+        slice_axis = max([a for a in range(n_axes) if a != axis], key=lambda a: volume.shape[a])
+        new_shape = list(volume.shape)
+        new_shape[axis] = len(indices)
+        new_volume = np.empty(new_shape, dtype=np.result_type(volume.dtype, weights.dtype))
+        weight_shape = [-1 if a == axis else 1 for a in range(volume.ndim)]
+
+        def process_slices(slices):
+            idx = tuple(slices if a == slice_axis else slice(None) for a in range(volume.ndim))
+            chunk = volume[idx]
+            result = np.take(chunk, indices[:, 0], axis=axis) * weights[:, 0].reshape(weight_shape)
+            for k in range(1, indices.shape[1]):
+                result += np.take(chunk, indices[:, k], axis=axis) * weights[:, k].reshape(weight_shape)
+            new_volume[idx] = result
+
+        n_chunks = min(volume.shape[slice_axis], 4 * n_threads)
+        bounds = np.linspace(0, volume.shape[slice_axis], n_chunks + 1).astype('int')
+        chunks = [slice(bounds[i], bounds[i + 1]) for i in range(n_chunks)]
+        if n_threads > 1:
+            with ThreadPoolExecutor(n_threads) as executor:
+                list(executor.map(process_slices, chunks))
+        else:
+            for chunk in chunks:
+                process_slices(chunk)
+        volume = new_volume
+
+    return volume
+
+
 def get_ras_axes(aff, n_dims=3):
     """This function finds the RAS axes corresponding to each dimension of a volume, based on its affine matrix.
     :param aff: affine matrix Can be a 2d numpy array of size n_dims*n_dims, n_dims+1*n_dims+1, or n_dims*n_dims+1.
@@ -956,6 +1246,55 @@ def get_largest_connected_component(mask, structure=None):
     return components == np.argmax(np.bincount(components.flat)[1:]) + 1 if n_components > 0 else mask.copy()
 
 
+def keep_largest_connected_component_per_class(posteriors, classes, threshold=0.25, structure=None, n_threads=1):
+    """Reset posteriors to zero outside the largest connected component of each class, where a class is a group of
+    channels. The mask of a class is obtained by thresholding all its channels, and it is the same as the one obtained
+    with get_largest_connected_component. However, the bounding boxes of all classes are obtained in a single pass, and
+    connected components are only computed within these bounding boxes, which is much faster than labelling the whole
+    volume for each class.
+    :param posteriors: array of posteriors with channels in the last axis, of shape [dim1, dim2, (dim3), n_channels].
+    This array is modified in place.
+    :param classes: array of length n_channels, giving the class of each channel. Channels of class 0 are not modified.
+    :param threshold: (optional) threshold used to compute the masks of the classes. Default is 0.25.
+    :param structure: (optional) numpy array defining the connectivity.
+    :param n_threads: (optional) number of threads used to process the different classes in parallel. Default is 1.
+    :return: the modified posteriors
+    """
+
+    n_dims = len(posteriors.shape) - 1
+    classes = np.asarray(classes)
+    assert len(classes) == posteriors.shape[-1], 'classes should have as many values as the number of channels'
+
+    # get extent of each channel along each axis
+    above_threshold = posteriors > threshold
+    extents = [np.any(above_threshold, axis=tuple(a for a in range(n_dims) if a != axis)) for axis in range(n_dims)]
+
+    # voxels to keep, this is updated within the bounding box of each class
+    keep = np.zeros_like(above_threshold)
+    keep[..., classes == 0] = True
+
+    def process_class(indices):
+        nonzero_axes = [np.where(np.any(extent[:, indices], axis=-1))[0] for extent in extents]
+        if all([len(nonzero) > 0 for nonzero in nonzero_axes]):
+            bbox = tuple(slice(nonzero[0], nonzero[-1] + 1) for nonzero in nonzero_axes)
+            mask = get_largest_connected_component(np.any(above_threshold[bbox][..., indices], axis=-1), structure)
+            keep_bbox = keep[bbox]
+            for idx in indices:
+                keep_bbox[..., idx] = mask
+
+    list_indices = [np.where(classes == c)[0] for c in np.unique(classes) if c != 0]
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as executor:
+            list(executor.map(process_class, list_indices))
+    else:
+        for indices in list_indices:
+            process_class(indices)
+    del above_threshold
+
+    posteriors *= keep
+    return posteriors
+
+
 def compute_hard_volumes(labels, voxel_volume=1., label_list=None, skip_background=True):
     """Compute hard volumes in a label map.
     :param labels: a label map
@@ -3,11 +3,16 @@ This file contains all the utilities used in that project. They are classified i
 1- loading/saving functions:
     -load_volume
     -save_volume
+    -GzipWriter
+    -save_posteriors
+    -load_posteriors
+    -get_smallest_int_dtype
     -get_volume_info
     -get_list_labels
     -load_array_if_path
     -write_pickle
     -read_pickle
+    -get_file_hash
     -write_model_summary
 2- reformatting functions
     -reformat_to_list
@@ -33,12 +38,16 @@ This file contains all the utilities used in that project. They are classified i
 6- miscellaneous
     -infer
     -LoopInfo
+    -Profiler
     -get_mapping_lut
     -build_training_generator
     -find_closest_number_divisible_by_m
     -build_binary_structure
     -draw_value_from_distribution
     -build_exp
+    -run_pipeline
+    -get_memory_usage
+    -get_peak_memory_usage
 
 
 If you use this code, please cite the first SynthSeg paper:
@@ -57,23 +66,34 @@ License.
 
 
 import os
+import sys
+import io
 import glob
+import gzip
+import json
 import math
 import time
+import bisect
 import pickle
+import hashlib
+import threading
+import traceback
+import weakref
 import numpy as np
 import nibabel as nib
 import tensorflow as tf
 import keras.layers as KL
 import keras.backend as K
 from datetime import timedelta
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
 from scipy.ndimage.morphology import distance_transform_edt
 
 
 # ---------------------------------------------- loading/saving functions ----------------------------------------------
 
 
-def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None):
+def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None, mmap=None):
     """
     Load volume file.
     :param path_volume: path of the volume to load. Can either be a nii, nii.gz, mgz, or npz format.
@@ -81,19 +101,29 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
     2) the volume is associated with an identity affine matrix and blank header.
     :param im_only: (optional) if False, the function also returns the affine matrix and header of the volume.
     :param squeeze: (optional) whether to squeeze the volume when loading.
-    :param dtype: (optional) if not None, convert the loaded volume to this numpy dtype.
+    :param dtype: (optional) if not None, convert the loaded volume to this numpy dtype. In this case, the data is read
+    in its on-disk type, and is only converted to float if it has to be scaled (i.e. non-trivial scl_slope/scl_inter).
+    Otherwise, the volume is returned as float64, as given by nibabel's get_fdata.
     :param aff_ref: (optional) If not None, the loaded volume is aligned to this affine matrix.
     The returned affine matrix is also given in this new space. Must be a numpy array of dimension 4x4.
+    :param mmap: (optional) whether to memory-map uncompressed files (e.g. nii). If True, the returned volume is a
+    read-only memory map when dtype is given and matches the on-disk type of unscaled data. If False, data is always
+    read in memory. Default is None, where nibabel's default is kept (uncompressed files are memory-mapped in
+    copy-on-write mode).
     :return: the volume, with corresponding affine matrix and header if im_only is False.
     """
     assert path_volume.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file: %s' % path_volume
 
     if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
-        x = nib.load(path_volume)
-        if squeeze:
-            volume = np.squeeze(x.get_fdata())
-        else:
+        x = nib.load(path_volume) if mmap is None else nib.load(path_volume, mmap='r' if mmap else False)
+        if dtype is None:
             volume = x.get_fdata()
+        elif (getattr(x.dataobj, 'slope', 1) == 1) & (getattr(x.dataobj, 'inter', 0) == 0):
+            volume = np.asarray(x.dataobj)  # unscaled data, read in its on-disk type
+        else:
+            volume = x.get_fdata(dtype='float32' if np.dtype(dtype) == np.float32 else 'float64')
+        if squeeze:
+            volume = np.squeeze(volume)
         aff = x.affine
         header = x.header
     else:  # npz
@@ -103,9 +133,9 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
         aff = np.eye(4)
         header = nib.Nifti1Header()
     if dtype is not None:
-        if 'int' in dtype:
+        if (np.dtype(dtype).kind in 'iu') & (volume.dtype.kind == 'f'):
             volume = np.round(volume)
-        volume = volume.astype(dtype=dtype)
+        volume = volume.astype(dtype=dtype, copy=False)
 
     # align image to reference affine matrix
     if aff_ref is not None:
@@ -119,7 +149,8 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
         return volume, aff, header
 
 
-def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
+def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3, compression_level=None, n_threads=1,
+                slope=None):
     """
     Save a volume.
     :param volume: volume to save
@@ -131,6 +162,11 @@ def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
     :param dtype: (optional) numpy dtype for the saved volume.
     :param n_dims: (optional) number of dimensions, to avoid confusion in multi-channel case. Default is None, where
     n_dims is automatically inferred.
+    :param compression_level: (optional) gzip compression level (from 0 to 9) used for nii.gz files.
+    Default is None, where nibabel's default level is used.
+    :param n_threads: (optional) number of threads used to compress nii.gz files (see GzipWriter). Default is 1.
+    :param slope: (optional) scaling factor saved in the header (scl_slope), so that readers multiply the saved values
+    by this factor. Default is None, where no scaling is saved.
     """
 
     mkdir(os.path.dirname(path))
@@ -145,9 +181,9 @@ def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
         elif aff is None:
             aff = np.eye(4)
         if dtype is not None:
-            if 'int' in dtype:
+            if ('int' in dtype) & (not np.issubdtype(volume.dtype, np.integer)):
                 volume = np.round(volume)
-            volume = volume.astype(dtype=dtype)
+            volume = volume.astype(dtype=dtype, copy=False)
             nifty = nib.Nifti1Image(volume, aff, header)
             nifty.set_data_dtype(dtype)
         else:
@@ -157,10 +193,205 @@ def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
                 n_dims, _ = get_dims(volume.shape)
             res = reformat_to_list(res, length=n_dims, dtype=None)
             nifty.header.set_zooms(res)
-        nib.save(nifty, path)
+        if slope is not None:
+            nifty.header.set_slope_inter(slope, 0)
+        if path.endswith('.nii.gz') & ((compression_level is not None) | (n_threads > 1)):
+            with GzipWriter(path, compression_level=compression_level, n_threads=n_threads) as f:
+                nifty.to_file_map(nib.Nifti1Image.make_file_map({'image': f}))
+        else:
+            nib.save(nifty, path)
+
 
+class GzipWriter:
+    """File-like object that writes a gzip file, where the data is split into blocks that are compressed independently
+    (possibly by several threads) and written as consecutive gzip members. The result is still a valid gzip file, which
+    is read as a single stream by gzip, zlib, nibabel, and FreeSurfer.
+    Example:
+    with GzipWriter('volume.nii.gz', compression_level=6, n_threads=4) as f:
+        f.write(data)
+    """
+
+    def __init__(self, path, compression_level=None, n_threads=1, block_size=2 ** 22):
+        """
+        :param path: path of the gzip file to write.
+        :param compression_level: (optional) compression level, from 0 (no compression) to 9 (best compression).
+        Default is None, where the same level as nibabel is used (1).
+        :param n_threads: (optional) number of threads compressing blocks in parallel. Default is 1.
+        :param block_size: (optional) size in bytes of the compressed blocks. Default is 4MB.
+        """
+        self.compression_level = 1 if compression_level is None else compression_level
+        assert 0 <= self.compression_level <= 9, 'compression_level should be between 0 and 9'
+        self.n_threads = n_threads
+        self.block_size = block_size
+        self.file = open(path, 'wb')
+        self.executor = ThreadPoolExecutor(n_threads) if n_threads > 1 else None
+        self.buffer = bytearray()
+        self.pending = deque()
+        self.position = 0
+
+    def write(self, data):
+        data = memoryview(data).cast('B')
+        self.buffer += data
+        self.position += data.nbytes
+        if len(self.buffer) >= self.block_size:
+            n_bytes = len(self.buffer) - len(self.buffer) % self.block_size
+            for start in range(0, n_bytes, self.block_size):
+                self.compress_block(bytes(self.buffer[start:start + self.block_size]))
+            del self.buffer[:n_bytes]
+        return data.nbytes
+
+    def compress_block(self, block):
+        if self.executor is None:
+            self.file.write(gzip.compress(block, self.compression_level))
+        else:
+            self.pending.append(self.executor.submit(gzip.compress, block, self.compression_level))
+            while len(self.pending) > 2 * self.n_threads:  # bound the number of blocks kept in memory
+                self.file.write(self.pending.popleft().result())
+
+    def read(self, *args):
+        raise io.UnsupportedOperation('GzipWriter is write-only')
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=0):
+        # data is streamed, so we can only "seek" to the current position
+        new_position = offset if whence == 0 else self.position + offset if whence == 1 else None
+        if new_position != self.position:
+            raise io.UnsupportedOperation('GzipWriter can only write sequentially')
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self.file.closed:
+            return
+        if (len(self.buffer) > 0) | (self.position == 0):
+            self.compress_block(bytes(self.buffer))
+            self.buffer = bytearray()
+        while self.pending:
+            self.file.write(self.pending.popleft().result())
+        if self.executor is not None:
+            self.executor.shutdown()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def save_posteriors(posteriors, aff, header, path, posteriors_format='float32', labels=None, top_k=4,
+                    compression_level=None, n_threads=1):
+    """Save posteriors in a dense or compact format. All formats can be read back as dense posteriors with
+    load_posteriors.
+    :param posteriors: numpy array of shape [dim1, dim2, dim3, n_channels], where the first channel is the background.
+    :param aff: affine matrix of the posteriors.
+    :param header: header of the posteriors. Not used for the topk format.
+    :param path: path where to save the posteriors. Must be a npz file for the topk format.
+    :param posteriors_format: (optional) format of the saved posteriors. Can be:
+    'float32': dense volume of float32 probabilities.
+    'uint8' or 'uint16': dense volume, where probabilities are quantized to 8 or 16 bits. The quantization step is saved
+    in the header (scl_slope), so that any nifti reader directly gives probabilities, with an error of at most half a
+    step (0.5/255 or 0.5/65535).
+    'topk': npz file, where only the top_k largest probabilities of each voxel are kept (quantized to 16 bits), along
+    with their channel indices. Only voxels where the background probability is not 1 after quantization are stored.
+    Default is 'float32'.
+    :param labels: (optional) label values corresponding to the channels, which are saved in topk files.
+    :param top_k: (optional) number of probabilities kept for each voxel in the topk format. Default is 4.
+    :param compression_level: (optional) gzip compression level of nii.gz files (see save_volume).
+    :param n_threads: (optional) number of threads used to compress nii.gz files (see save_volume).
+    """
 
-def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels=10):
+    if posteriors_format == 'float32':
+        save_volume(posteriors, aff, header, path, dtype='float32', compression_level=compression_level,
+                    n_threads=n_threads)
+
+    elif posteriors_format in ['uint8', 'uint16']:
+        max_value = np.iinfo(posteriors_format).max
+        quantized = np.rint(np.clip(posteriors, 0, 1) * max_value).astype(posteriors_format)
+        save_volume(quantized, aff, header, path, dtype=posteriors_format, compression_level=compression_level,
+                    n_threads=n_threads, slope=1. / max_value)
+
+    elif posteriors_format == 'topk':
+        assert path.endswith('.npz'), 'topk posteriors should be saved as npz files, got %s' % path
+        max_value = np.iinfo('uint16').max
+        n_channels = posteriors.shape[-1]
+        top_k = min(top_k, n_channels)
+
+        # only keep voxels where the background probability is not 1 after quantization
+        flat_posteriors = posteriors.reshape([-1, n_channels])
+        mask = np.rint(flat_posteriors[:, 0] * max_value) < max_value
+        masked_posteriors = flat_posteriors[mask]
+
+        # get the top_k largest probabilities of each voxel, and their channel indices
+        indices = np.argpartition(masked_posteriors, n_channels - top_k, axis=-1)[:, n_channels - top_k:]
+        probabilities = np.take_along_axis(masked_posteriors, indices, axis=-1)
+        probabilities = np.rint(np.clip(probabilities, 0, 1) * max_value).astype('uint16')
+
+        mkdir(os.path.dirname(path))
+        np.savez_compressed(path,
+                            shape=np.array(posteriors.shape),
+                            affine=np.eye(4) if aff is None else np.array(aff),
+                            labels=np.arange(n_channels) if labels is None else np.array(labels),
+                            mask=np.packbits(mask),
+                            indices=indices.astype(get_smallest_int_dtype([0, n_channels - 1])),
+                            probabilities=probabilities,
+                            slope=np.array(1. / max_value))
+
+    else:
+        raise Exception("posteriors_format should be 'float32', 'uint8', 'uint16', or 'topk', "
+                        "got %s" % posteriors_format)
+
+
+def load_posteriors(path_posteriors, im_only=True):
+    """Load posteriors saved by save_posteriors in any format, and rebuild them as dense float32 posteriors.
+    :param path_posteriors: path of the posteriors. Can be a nii, nii.gz, or mgz file (with float32 or quantized
+    probabilities), or a npz file saved with the topk format.
+    :param im_only: (optional) if False, the function also returns the affine matrix and the label values of the
+    channels (None for nifti files, since they don't store them).
+    :return: numpy array of posteriors of shape [dim1, dim2, dim3, n_channels], with corresponding affine matrix and
+    labels if im_only is False.
+    """
+
+    if path_posteriors.endswith('.npz'):
+        data = np.load(path_posteriors)
+        shape = data['shape']
+        n_voxels = int(np.prod(shape[:-1]))
+        mask = np.unpackbits(data['mask'], count=n_voxels).astype('bool')
+
+        # voxels outside the mask only have background, and the others get their top_k probabilities back
+        posteriors = np.zeros([n_voxels, shape[-1]], dtype='float32')
+        posteriors[np.logical_not(mask), 0] = 1
+        voxel_indices = np.flatnonzero(mask)[:, np.newaxis]
+        posteriors[voxel_indices, data['indices']] = data['probabilities'] * data['slope'].astype('float32')
+        posteriors = posteriors.reshape(shape)
+        aff = data['affine']
+        labels = data['labels']
+
+    else:
+        posteriors, aff, _ = load_volume(path_posteriors, im_only=False, squeeze=False, dtype='float32')
+        labels = None
+
+    if im_only:
+        return posteriors
+    else:
+        return posteriors, aff, labels
+
+
+def get_smallest_int_dtype(values):
+    """Return the smallest integer numpy dtype among uint8, int16, and int32 that can represent all the given values.
+    This is typically used to save label maps with the labels as values."""
+    values = np.asarray(values)
+    for dtype in ['uint8', 'int16', 'int32']:
+        if (np.min(values) >= np.iinfo(dtype).min) & (np.max(values) <= np.iinfo(dtype).max):
+            return dtype
+    return 'int64'
+
+
+def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels=10, dtype=None, mmap=None):
     """
     Gather information about a volume: shape, affine matrix, number of dimensions and channels, header, and resolution.
     :param path_volume: path of the volume to get information form.
@@ -168,14 +399,21 @@ def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels
     :param aff_ref: (optional) If not None, the loaded volume is aligned to this affine matrix.
     All info relative to the volume is then given in this new space. Must be a numpy array of dimension 4x4.
     :param max_channels: maximum possible number of channels for the input volume.
+    :param dtype: (optional) numpy dtype of the returned volume (see load_volume). Default is None (float64).
+    :param mmap: (optional) whether to memory-map the returned volume (see load_volume). Default is nibabel's default.
     :return: volume (if return_volume is true), and corresponding info. If aff_ref is not None, the returned aff is
     the original one, i.e. the affine of the image before being aligned to aff_ref.
     """
-    # read image
-    im, aff, header = load_volume(path_volume, im_only=False)
+    # read image (only read the header if the volume is not needed)
+    if return_volume | path_volume.endswith('.npz'):
+        im, aff, header = load_volume(path_volume, im_only=False, dtype=dtype, mmap=mmap)
+        im_shape = list(im.shape)
+    else:
+        x = nib.load(path_volume)
+        im, aff, header = None, x.affine, x.header
+        im_shape = [s for s in x.shape if s != 1]  # same as the shape of the squeezed volume
 
     # understand if image is multichannel
-    im_shape = list(im.shape)
     n_dims, n_channels = get_dims(im_shape, max_channels=max_channels)
     im_shape = im_shape[:n_dims]
 
@@ -192,7 +430,8 @@ def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels
         from ext.lab2im import edit_volumes  # the import is done here to avoid import loops
         ras_axes = edit_volumes.get_ras_axes(aff, n_dims=n_dims)
         ras_axes_ref = edit_volumes.get_ras_axes(aff_ref, n_dims=n_dims)
-        im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=aff_ref, n_dims=n_dims)
+        if return_volume:
+            im = edit_volumes.align_volume_to_ref(im, aff, aff_ref=aff_ref, n_dims=n_dims)
         im_shape = np.array(im_shape)
         data_res = np.array(data_res)
         im_shape[ras_axes_ref] = im_shape[ras_axes]
@@ -307,6 +546,15 @@ def read_pickle(filepath):
         return unpickler.load()
 
 
+def get_file_hash(filepath, block_size=2 ** 20):
+    """ compute the sha256 hash of the content of a file, which is read by blocks of block_size bytes"""
+    file_hash = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(block_size), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
 def write_model_summary(model, filepath='./model_summary.txt', line_length=150):
     """Write the summary of a keras model at a given path, with a given length for each line"""
     with open(filepath, 'w') as fh:
@@ -891,6 +1139,123 @@ class LoopInfo:
                 print(self.text + ' {}'.format(iteration))
 
 
+class Profiler:
+    """
+    Class to record the wall time and the peak resident memory of the different stages of a pipeline, for each subject.
+    Call start at the beginning of a sequence of stages for a subject, and then lap at the end of each stage.
+    Each lap is written as a line of a json-lines file, with the following format:
+    {"subject": subject, "stage": stage, "time": seconds, "memory": MB, "peak_memory": MB, "peak_memory_increase": MB}
+    where memory is the resident memory of the process at the end of the stage (in MB, rounded to 1MB), peak_memory is
+    the highest resident memory of the process during the stage, and peak_memory_increase is how much higher it is
+    than at the beginning of the stage. The resident memory is sampled every sampling_interval seconds by a background
+    thread (see get_memory_usage), so short spikes can be missed. It is the memory of the whole process: if stages of
+    several subjects run at the same time (e.g. with prefetching or writing threads), the peak of a stage includes the
+    memory used by the other stages running concurrently. Memory values are None on systems without /proc (e.g. macOS).
+    Profiling is disabled if no output file is given and records are not kept, in which case all methods do nothing.
+    This class is thread-safe, as long as a subject is not processed by several threads at the same time.
+    """
+
+    def __init__(self, path_profile=None, keep_records=False, sampling_interval=0.05):
+        """
+        :param path_profile: (optional) path of the json-lines file where laps are written. Laps are appended to this
+        file if it already exists. Default is None, where laps are not written.
+        :param keep_records: (optional) whether to record laps in memory even if path_profile is None, so that they can
+        be read from the records attribute (a dictionary with the laps of each stage). Default is False.
+        :param sampling_interval: (optional) interval in seconds between two measures of the resident memory.
+        """
+        self.path_profile = path_profile
+        self.enabled = (path_profile is not None) | keep_records
+        self.sampling_interval = sampling_interval
+        self.lock = threading.Lock()
+        self.last_laps = dict()
+        self.records = dict()
+        # memory samples as (sample index, memory) with strictly decreasing memory, so that the peak memory since a
+        # given sample is the memory of the first sample with a higher or equal index (memory is rounded to 1MB, so
+        # that this list is never longer than the peak memory in MB)
+        self.samples = list()
+        self.n_samples = 0
+        self.sampler = None
+        if path_profile is not None:
+            mkdir(os.path.dirname(os.path.abspath(path_profile)))
+
+    def sample_memory(self):
+        """Measure the current resident memory (rounded to 1MB), and return it with the index of this sample."""
+        memory = get_memory_usage()
+        if memory is None:
+            return None, None
+        memory = round(memory)
+        with self.lock:
+            while (len(self.samples) > 0) and (self.samples[-1][1] <= memory):
+                self.samples.pop()
+            self.samples.append((self.n_samples, memory))
+            self.n_samples += 1
+            return self.n_samples - 1, memory
+
+    def start(self, subject):
+        if self.enabled:
+            with self.lock:
+                if (self.sampler is None) & (get_memory_usage() is not None):
+                    self.sampler = threading.Thread(target=sample_memory_in_background,
+                                                    args=(weakref.ref(self), self.sampling_interval), daemon=True)
+                    self.sampler.start()
+            sample = self.sample_memory()
+            with self.lock:
+                self.last_laps[subject] = (time.time(), *sample)
+
+    def lap(self, subject, stage, **info):
+        """Record the time and memory since the last lap (or start) of the subject, with optional additional info."""
+        if not self.enabled:
+            return
+        now, (sample_idx, memory) = time.time(), self.sample_memory()
+        with self.lock:
+            previous, previous_sample_idx, previous_memory = self.last_laps.get(subject, (now, sample_idx, memory))
+            self.last_laps[subject] = (now, sample_idx, memory)
+            if memory is not None:
+                peak_memory = max(self.samples[bisect.bisect_left(self.samples, (previous_sample_idx,))][1], memory)
+                peak_memory_increase = peak_memory - previous_memory
+            else:
+                peak_memory = peak_memory_increase = None
+            record = {'subject': subject, 'stage': stage, 'time': now - previous, 'memory': memory,
+                      'peak_memory': peak_memory, 'peak_memory_increase': peak_memory_increase, **info}
+            self.records.setdefault(stage, list()).append(record)
+            if self.path_profile is not None:
+                with open(self.path_profile, 'a') as f:
+                    f.write(json.dumps(record, default=str) + '\n')
+
+    def get_stage_times(self):
+        """Return a dictionary with the total time spent in each stage, summed over all subjects."""
+        with self.lock:
+            return {stage: float(np.sum([record['time'] for record in records]))
+                    for stage, records in self.records.items()}
+
+    def print_summary(self):
+        """Print a table with time and memory statistics for each stage, in the order where stages were first run.
+        Nothing is printed if laps are not written to a file."""
+        if self.path_profile is None:
+            return
+        with self.lock:
+            print('\n{:<15}{:>8}{:>12}{:>12}{:>12}{:>12}{:>16}'.format(
+                'stage', 'count', 'mean (s)', 'median (s)', 'max (s)', 'total (s)', 'peak mem (MB)'))
+            for stage, records in self.records.items():
+                times = np.array([record['time'] for record in records])
+                peak_memory = max([record['peak_memory'] or 0. for record in records])
+                print('{:<15}{:>8}{:>12.3f}{:>12.3f}{:>12.3f}{:>12.3f}{:>16.1f}'.format(
+                    stage, len(times), np.mean(times), np.median(times), np.max(times), np.sum(times), peak_memory))
+            print('peak mem: resident memory of the whole process, including concurrent stages (e.g. prefetching)')
+            print('profiling results saved in ' + self.path_profile)
+
+
+def sample_memory_in_background(profiler_ref, sampling_interval):
+    """Regularly sample the resident memory for a Profiler, until this profiler is deleted."""
+    while True:
+        profiler = profiler_ref()
+        if profiler is None:
+            return
+        profiler.sample_memory()
+        del profiler
+        time.sleep(sampling_interval)
+
+
 def get_mapping_lut(source, dest=None):
     """This functions returns the look-up table to map a list of N values (source) to another list (dest).
     If the second list is not given, we assume it is equal to [0, ..., N-1]."""
@@ -1055,3 +1420,99 @@ def build_exp(x, first, last, fix_point):
     b = first - last
     c = - (1 / fix_point[0]) * np.log((fix_point[1] - last) / (first - last))
     return a + b * np.exp(-c * x)
+
+
+def run_pipeline(items, read_fn, process_fn, write_fn, n_prefetch=0, n_writers=0):
+    """
+    Run a bounded read -> process -> write pipeline over a list of items. Reading and writing are performed by
+    background thread pools, such that they overlap with process_fn, which always runs in the calling thread (this is
+    where network inference should happen). At most n_prefetch items are read in advance, and at most n_writers items
+    wait to be written, so that memory usage remains bounded.
+    :param items: list of items to process (e.g. subject indices).
+    :param read_fn: function taking an item and returning the inputs of process_fn.
+    :param process_fn: function taking an item and the output of read_fn, and returning the inputs of write_fn.
+    :param write_fn: function taking an item and the output of process_fn, and returning the final result for this item.
+    :param n_prefetch: (optional) number of items to read in advance in background threads. Default is 0, where items
+    are read sequentially in the calling thread.
+    :param n_writers: (optional) number of background threads used to write items. Default is 0, where items are
+    written sequentially in the calling thread.
+    :return: a generator yielding (item, result, error) tuples in the same order as items. error is None if everything
+    went well, otherwise it is the formatted traceback of the exception raised while handling this item (result is then
+    None). Errors do not stop the pipeline.
+    """
+
+    def submit(executor, fn, *args):
+        if executor is not None:
+            return executor.submit(fn, *args)
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def format_error(e):
+        return ''.join(traceback.format_exception(type(e), e, e.__traceback__))
+
+    def collect(item, future):
+        e = future.exception()
+        return (item, None, format_error(e)) if e is not None else (item, future.result(), None)
+
+    items = list(items)
+    readers = ThreadPoolExecutor(max_workers=n_prefetch) if n_prefetch > 0 else None
+    writers = ThreadPoolExecutor(max_workers=n_writers) if n_writers > 0 else None
+    pending_reads = deque()
+    pending_writes = deque()
+    next_read = 0
+
+    try:
+        for idx, item in enumerate(items):
+
+            # keep up to n_prefetch reads in flight ahead of the current item
+            while (next_read < len(items)) & (next_read <= idx + n_prefetch):
+                pending_reads.append(submit(readers, read_fn, items[next_read]))
+                next_read += 1
+
+            # process current item in calling thread, and send the results to the writers
+            read_future = pending_reads.popleft()
+            if read_future.exception() is not None:
+                write_future = read_future
+            else:
+                write_future = submit(None, process_fn, item, read_future.result())
+                if write_future.exception() is None:
+                    write_future = submit(writers, write_fn, item, write_future.result())
+            del read_future
+            pending_writes.append((item, write_future))
+
+            # yield finished items in order, while keeping at most n_writers items in the writing queue
+            while len(pending_writes) > n_writers:
+                yield collect(*pending_writes.popleft())
+
+        while len(pending_writes) > 0:
+            yield collect(*pending_writes.popleft())
+
+    finally:
+        for executor in [readers, writers]:
+            if executor is not None:
+                executor.shutdown(wait=True)
+
+
+def get_memory_usage():
+    """Return the current resident memory of the process in MB, or None on systems without /proc (e.g. macOS or
+    Windows). Contrarily to get_peak_memory_usage, this can be used to measure the memory of a part of a program."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def get_peak_memory_usage():
+    """Return the peak resident memory of the current process in MB, or None on systems where it is not available
+    (the resource module only exists on Unix systems, so it is not imported at the top of this file)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / 1024 ** 2 if sys.platform == 'darwin' else peak / 1024  # bytes on macOS, kilobytes on Linux
@@ -0,0 +1,84 @@
+"""
+This script benchmarks the SynthSeg inference pipeline on synthetic images with randomly initialised networks, on CPU.
+For example, to benchmark the fast and default modes on 1mm isotropic images, and to compare them to a previous run:
+python scripts/commands/SynthSeg_benchmark.py --out /tmp/benchmark --cases 1mm --modes fast default \
+--baseline /path/to/previous/results.json
+To check that running again on an unchanged folder with a manifest skips all subjects and gives the same csv files:
+python scripts/commands/SynthSeg_benchmark.py --out /tmp/benchmark --check_rerun
+To check that the lean mode gives the same posteriors as keras on a random network:
+python scripts/commands/SynthSeg_benchmark.py --check_lean
+See SynthSeg/benchmark.py for all the available cases and modes.
+
+If you use this code, please cite one of the SynthSeg papers:
+https://github.com/BBillot/SynthSeg/blob/master/bibtex.bib
+
+Copyright 2020 Benjamin Billot
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+https://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under the
+License.
+"""
+
+# python imports
+import os
+import sys
+from argparse import ArgumentParser
+
+# add main folder to python path and import ./SynthSeg/benchmark.py
+synthseg_home = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
+sys.path.append(synthseg_home)
+os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+from SynthSeg.benchmark import run_benchmark, check_manifest_rerun, check_lean_model, BENCHMARK_CASES, BENCHMARK_MODES
+
+
+# parse arguments
+parser = ArgumentParser(description="SynthSeg benchmark", epilog='\n')
+parser.add_argument("--out", help="Folder where synthetic images, random networks, and results are written.")
+parser.add_argument("--cases", nargs='+', help="(optional) Cases to benchmark, among: %s. Default is all of them."
+                                               % ', '.join(BENCHMARK_CASES.keys()))
+parser.add_argument("--modes", nargs='+', help="(optional) Modes to benchmark, among: %s. Default is all of them."
+                                               % ', '.join(BENCHMARK_MODES.keys()))
+parser.add_argument("--repeats", type=int, default=1, help="(optional) Number of repetitions of each run. "
+                    "Default is 1.")
+parser.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1.")
+parser.add_argument("--results", help="(optional) Path of the output json file. Default is <out>/results.json.")
+parser.add_argument("--baseline", help="(optional) Results of a previous benchmark to compare with.")
+parser.add_argument("--tolerance", type=float, default=0.2, help="(optional) Relative increase of time or memory "
+                    "above which a regression is flagged. Default is 0.2.")
+parser.add_argument("--check_rerun", action="store_true", help="(optional) Instead of benchmarking, check that "
+                    "running again on an unchanged folder with a manifest skips all subjects and writes the same csv "
+                    "files.")
+parser.add_argument("--check_lean", action="store_true", help="(optional) Instead of benchmarking, check that the "
+                    "lean mode gives the same posteriors as keras on a random network.")
+args = vars(parser.parse_args())
+
+# check the lean mode, and exit with an error if posteriors differ
+if args['check_lean']:
+    problems = check_lean_model()
+    sys.exit(1 if len(problems) > 0 else 0)
+
+# check for no arguments
+if args['out'] is None:
+    parser.print_help()
+    sys.exit(1)
+
+# check reruns with a manifest, and exit with an error if problems were found
+if args['check_rerun']:
+    problems = check_manifest_rerun(benchmark_dir=args['out'], n_threads=args['threads'])
+    sys.exit(1 if len(problems) > 0 else 0)
+
+# run benchmark, and exit with an error if regressions were found
+_, regressions = run_benchmark(benchmark_dir=args['out'],
+                               cases=args['cases'],
+                               modes=args['modes'],
+                               n_repeats=args['repeats'],
+                               n_threads=args['threads'],
+                               path_results=args['results'],
+                               path_baseline=args['baseline'],
+                               tolerance=args['tolerance'])
+if len(regressions) > 0:
+    sys.exit(1)
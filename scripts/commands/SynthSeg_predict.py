@@ -23,9 +23,8 @@ from argparse import ArgumentParser
 # add main folder to python path and import ./SynthSeg/predict_synthseg.py
 synthseg_home = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
 sys.path.append(synthseg_home)
-model_dir = os.path.join(synthseg_home, 'models')
-labels_dir = os.path.join(synthseg_home, 'data/labels_classes_priors')
 from SynthSeg.predict_synthseg import predict
+from SynthSeg.predict_service import get_predict_arguments
 
 
 # parse arguments
@@ -35,8 +34,28 @@ parser = ArgumentParser(description="SynthSeg", epilog='\n')
 parser.add_argument("--i", help="Image(s) to segment. Can be a path to an image or to a folder.")
 parser.add_argument("--o", help="Segmentation output(s). Must be a folder if --i designates a folder.")
 parser.add_argument("--parc", action="store_true", help="(optional) Whether to perform cortex parcellation.")
+parser.add_argument("--parc_margin", type=int, default=None, help="(optional) Only run the parcellation network "
+                    "on the bounding box of the cortex, expanded by this margin (in voxels), e.g. 16. Default is to "
+                    "parcellate the whole volume.")
 parser.add_argument("--robust", action="store_true", help="(optional) Whether to use robust predictions (slower).")
+parser.add_argument("--auto_crop", type=int, default=None, help="(optional) Crop images around the head, which is "
+                    "detected by thresholding, with this margin (in voxels, e.g. 16). This excludes the neck, "
+                    "shoulders and background of large fields of view. Cannot be used with --crop.")
+parser.add_argument("--canonical", nargs='+', type=int, default=None, help="(optional) Snap the padded shapes of "
+                    "the inputs to canonical sizes, so that images of different shapes are processed with the same "
+                    "network input shape. Either one number (sizes are rounded up to multiples of it, e.g. 64), or a "
+                    "list of sizes (e.g. 160 192 224 256). All must be divisible by 32.")
+parser.add_argument("--lean", action="store_true", help="(optional) Run the networks layer by layer, and release "
+                    "intermediate tensors as soon as possible, to reduce memory usage.")
+parser.add_argument("--slab", type=int, default=None, help="(optional) With --lean, run the convolutional layers on "
+                    "slabs of this size (in voxels, e.g. 64) along the first axis, to further reduce memory usage.")
 parser.add_argument("--fast", action="store_true", help="(optional) Bypass some postprocessing for faster predictions.")
+parser.add_argument("--compact", action="store_true", help="(optional) With --fast and without --post, compute the "
+                    "segmentations and volumes inside the network, which avoids copying the posteriors out of it. "
+                    "Subjects whose brain mask has several connected components are predicted again with posteriors, "
+                    "which costs a second full inference for each of them. Their number is printed at the end, and "
+                    "the fallback rate and its time are reported by the compact mode of the benchmark (see "
+                    "SynthSeg/benchmark.py).")
 parser.add_argument("--ct", action="store_true", help="(optional) Clip intensities to [0,80] for CT scans.")
 parser.add_argument("--vol", help="(optional) Path to output CSV file with volumes (mm3) for all regions and subjects.")
 parser.add_argument("--qc", help="(optional) Path to output CSV file with qc scores for all subjects.")
@@ -45,6 +64,38 @@ parser.add_argument("--resample", help="(optional) Resampled image(s). Must be a
 parser.add_argument("--crop", nargs='+', type=int, help="(optional) Size of 3D patches to analyse. Default is 192.")
 parser.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1.")
 parser.add_argument("--cpu", action="store_true", help="(optional) Enforce running with CPU rather than GPU.")
+parser.add_argument("--prefetch", type=int, default=0, help="(optional) Number of images to read in advance while "
+                    "the network is running. Default is 0.")
+parser.add_argument("--writers", type=int, default=0, help="(optional) Number of threads to postprocess and write "
+                    "outputs while the network is running. Default is 0.")
+parser.add_argument("--batch", type=int, default=1, help="(optional) Maximum number of images with the same "
+                    "shape to segment at once. Default is 1.")
+parser.add_argument("--batch_voxels", type=int, default=None, help="(optional) Maximum number of voxels in a batch, "
+                    "to limit memory usage when --batch is used.")
+parser.add_argument("--model_cache", help="(optional) Folder where to cache the built networks, which makes the "
+                    "start-up faster for the next runs with the same options.")
+parser.add_argument("--tile", nargs='+', type=int, help="(optional) Size of overlapping tiles to segment the "
+                    "images piece by piece, which limits memory usage. Not compatible with --qc.")
+parser.add_argument("--tile_overlap", nargs='+', type=int, default=32, help="(optional) Overlap between tiles in "
+                    "voxels. Default is 32.")
+parser.add_argument("--tile_blending", default='gaussian', help="(optional) Blending of the tile predictions, can be "
+                    "gaussian or linear. Default is gaussian.")
+parser.add_argument("--manifest", help="(optional) Path to a json-lines manifest recording the inputs, options, and "
+                    "outputs of segmented subjects. If given, only subjects whose inputs, options or outputs have "
+                    "changed are segmented again.")
+parser.add_argument("--profile", help="(optional) Path to a json-lines file where the time and peak memory of each "
+                    "stage are recorded for each subject.")
+parser.add_argument("--compression", type=int, default=None, help="(optional) Gzip compression level of nii.gz "
+                    "outputs, from 0 (fastest) to 9 (smallest). Default is the same as nibabel (1).")
+parser.add_argument("--compression_threads", type=int, default=1, help="(optional) Number of threads used to "
+                    "compress each nii.gz output. Default is 1.")
+parser.add_argument("--uncompressed", action="store_true", help="(optional) Write .nii outputs instead of .nii.gz, "
+                    "e.g. when writing to local scratch.")
+parser.add_argument("--post_format", default='float32', help="(optional) Format of the posteriors, can be float32, "
+                    "uint8 or uint16 (quantized probabilities), or topk (k most probable labels per voxel in a .npz "
+                    "archive, see utils.load_posteriors). Default is float32.")
+parser.add_argument("--post_topk", type=int, default=4, help="(optional) Number of labels kept per voxel with "
+                    "--post_format topk. Default is 4.")
 parser.add_argument("--v1", action="store_true", help="(optional) Use SynthSeg 1.0 (updated 25/06/22).")
 
 # check for no arguments
@@ -80,57 +131,8 @@ else:
 tf.config.threading.set_inter_op_parallelism_threads(args['threads'])
 tf.config.threading.set_intra_op_parallelism_threads(args['threads'])
 
-# path models
-if args['robust']:
-    args['path_model_segmentation'] = os.path.join(model_dir, 'synthseg_robust_2.0.h5')
-else:
-    args['path_model_segmentation'] = os.path.join(model_dir, 'synthseg_2.0.h5')
-args['path_model_parcellation'] = os.path.join(model_dir, 'synthseg_parc_2.0.h5')
-args['path_model_qc'] = os.path.join(model_dir, 'synthseg_qc_2.0.h5')
-
-# path labels
-args['labels_segmentation'] = os.path.join(labels_dir, 'synthseg_segmentation_labels_2.0.npy')
-args['labels_denoiser'] = os.path.join(labels_dir, 'synthseg_denoiser_labels_2.0.npy')
-args['labels_parcellation'] = os.path.join(labels_dir, 'synthseg_parcellation_labels.npy')
-args['labels_qc'] = os.path.join(labels_dir, 'synthseg_qc_labels_2.0.npy')
-args['names_segmentation_labels'] = os.path.join(labels_dir, 'synthseg_segmentation_names_2.0.npy')
-args['names_parcellation_labels'] = os.path.join(labels_dir, 'synthseg_parcellation_names.npy')
-args['names_qc_labels'] = os.path.join(labels_dir, 'synthseg_qc_names_2.0.npy')
-args['topology_classes'] = os.path.join(labels_dir, 'synthseg_topological_classes_2.0.npy')
-args['n_neutral_labels'] = 19
-
-# use previous model if needed
-if args['v1']:
-    args['path_model_segmentation'] = os.path.join(model_dir, 'synthseg_1.0.h5')
-    args['labels_segmentation'] = args['labels_segmentation'].replace('_2.0.npy', '.npy')
-    args['labels_qc'] = args['labels_qc'].replace('_2.0.npy', '.npy')
-    args['names_segmentation_labels'] = args['names_segmentation_labels'].replace('_2.0.npy', '.npy')
-    args['names_qc_labels'] = args['names_qc_labels'].replace('_2.0.npy', '.npy')
-    args['topology_classes'] = args['topology_classes'].replace('_2.0.npy', '.npy')
-    args['n_neutral_labels'] = 18
+# get the paths of the models and labels, in the same way as for SynthSeg/predict_service.py
+job = {key: value for key, value in args.items() if key not in ['threads', 'cpu', 'model_cache']}
 
 # run prediction
-predict(path_images=args['i'],
-        path_segmentations=args['o'],
-        path_model_segmentation=args['path_model_segmentation'],
-        labels_segmentation=args['labels_segmentation'],
-        robust=args['robust'],
-        fast=args['fast'],
-        v1=args['v1'],
-        do_parcellation=args['parc'],
-        n_neutral_labels=args['n_neutral_labels'],
-        names_segmentation=args['names_segmentation_labels'],
-        labels_denoiser=args['labels_denoiser'],
-        path_posteriors=args['post'],
-        path_resampled=args['resample'],
-        path_volumes=args['vol'],
-        path_model_parcellation=args['path_model_parcellation'],
-        labels_parcellation=args['labels_parcellation'],
-        names_parcellation=args['names_parcellation_labels'],
-        path_model_qc=args['path_model_qc'],
-        labels_qc=args['labels_qc'],
-        path_qc_scores=args['qc'],
-        names_qc=args['names_qc_labels'],
-        cropping=args['crop'],
-        topology_classes=args['topology_classes'],
-        ct=args['ct'])
+predict(**get_predict_arguments(job, synthseg_home, n_threads=args['threads']), path_model_cache=args['model_cache'])
@@ -0,0 +1,58 @@
+"""
+This script launches a long-running local SynthSeg service, where networks are only loaded once.
+Jobs are then submitted over HTTP, for example with:
+curl -X POST http://127.0.0.1:8000/jobs \
+-d '{"i": "/path/to/image.nii.gz", "o": "/path/to/seg.nii.gz", "vol": "/path/to/vol.csv"}'
+See SynthSeg/predict_service.py for all the available endpoints.
+
+If you use this code, please cite one of the SynthSeg papers:
+https://github.com/BBillot/SynthSeg/blob/master/bibtex.bib
+
+Copyright 2020 Benjamin Billot
+
+Licensed under the Apache License, Version 2.0 (the "License"); you may not use this file except in
+compliance with the License. You may obtain a copy of the License at
+https://www.apache.org/licenses/LICENSE-2.0
+Unless required by applicable law or agreed to in writing, software distributed under the License is
+distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+implied. See the License for the specific language governing permissions and limitations under the
+License.
+"""
+
+# python imports
+import os
+import sys
+from argparse import ArgumentParser
+
+# add main folder to python path and import ./SynthSeg/predict_service.py
+synthseg_home = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(sys.argv[0]))))
+sys.path.append(synthseg_home)
+from SynthSeg.predict_service import SegmentationService
+
+
+# parse arguments
+parser = ArgumentParser(description="SynthSeg service", epilog='\n')
+parser.add_argument("--host", default='127.0.0.1', help="(optional) Host of the service. Default is 127.0.0.1.")
+parser.add_argument("--port", type=int, default=8000, help="(optional) Port of the service. Default is 8000.")
+parser.add_argument("--model_cache", help="(optional) Folder where to cache the built networks on disk.")
+parser.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1.")
+parser.add_argument("--cpu", action="store_true", help="(optional) Enforce running with CPU rather than GPU.")
+args = vars(parser.parse_args())
+
+# enforce CPU processing if necessary
+if args['cpu']:
+    print('using CPU, hiding all CUDA_VISIBLE_DEVICES')
+    os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
+
+# limit the number of threads to be used if running on CPU
+import tensorflow as tf
+if args['threads'] == 1:
+    print('using 1 thread')
+else:
+    print('using %s threads' % args['threads'])
+tf.config.threading.set_inter_op_parallelism_threads(args['threads'])
+tf.config.threading.set_intra_op_parallelism_threads(args['threads'])
+
+# run service
+service = SegmentationService(synthseg_home, path_model_cache=args['model_cache'], n_threads=args['threads'])
+service.serve(host=args['host'], port=args['port'])
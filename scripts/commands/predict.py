@@ -73,5 +73,17 @@ parser.add_argument("--incorrect_labels", type=str, default=None, dest="list_inc
 parser.add_argument("--correct_labels", type=str, default=None, dest="list_correct_labels",
                     help="path list correct labels.")
 
+# Profiling parameters
+parser.add_argument("--profile", type=str, default=None, dest="path_profile",
+                    help="json-lines file where the time and peak memory of each stage are recorded for each subject.")
+
+# Output parameters
+parser.add_argument("--compression", type=int, default=None, dest="compression_level",
+                    help="gzip compression level of nii.gz outputs, from 0 (fastest) to 9 (smallest).")
+parser.add_argument("--compression_threads", type=int, default=1, dest="compression_threads",
+                    help="number of threads used to compress each nii.gz output.")
+parser.add_argument("--uncompressed", action='store_true', dest="uncompressed",
+                    help="write .nii outputs instead of .nii.gz, e.g. when writing to local scratch.")
+
 args = parser.parse_args()
 predict(**vars(args))